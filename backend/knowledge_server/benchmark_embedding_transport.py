@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Date  : 2025/9/24
+# @File  : benchmark_embedding_transport.py
+# @Desc  : 对比embedding接口两种返回格式在客户端的解析开销：JSON浮点数组 vs base64(float32字节)
+#          模拟每1万个分块的响应体，统计CPU时间、峰值内存和响应体大小，不会调用embedding接口
+# 用法: python benchmark_embedding_transport.py --chunks 10000 --dim 1024
+
+import argparse
+import base64
+import json
+import time
+import tracemalloc
+import numpy as np
+from embedding_utils import decode_embedding
+
+
+def build_payloads(chunks, dim, batch_size):
+    """
+    按接口批量大小构造两种格式的响应体（bytes）
+    """
+    rng = np.random.default_rng(42)
+    float_bodies, base64_bodies = [], []
+    for begin in range(0, chunks, batch_size):
+        vectors = rng.standard_normal((min(batch_size, chunks - begin), dim)).astype(np.float32)
+        float_bodies.append(json.dumps({"data": [
+            {"index": i, "embedding": v.tolist()} for i, v in enumerate(vectors)
+        ]}).encode("utf-8"))
+        base64_bodies.append(json.dumps({"data": [
+            {"index": i, "embedding": base64.b64encode(v.astype("<f4").tobytes()).decode("ascii")}
+            for i, v in enumerate(vectors)
+        ]}).encode("utf-8"))
+    return float_bodies, base64_bodies
+
+
+def parse_float(bodies):
+    """
+    旧路径：JSON浮点数组 -> dict -> Python float列表（再交给chroma时转numpy）
+    """
+    embeddings = []
+    for body in bodies:
+        for one in json.loads(body)["data"]:
+            embeddings.append(one["embedding"])
+    return np.asarray(embeddings, dtype=np.float32)
+
+
+def parse_base64(bodies):
+    """
+    新路径：base64 -> 直接frombuffer为float32数组，按批次拼接
+    """
+    parts = []
+    for body in bodies:
+        items = json.loads(body)["data"]
+        parts.append(np.vstack([decode_embedding(one["embedding"]) for one in items]))
+    return np.concatenate(parts)
+
+
+def measure(name, func, bodies):
+    # 计时和测内存分两遍跑，tracemalloc本身会显著拖慢大量小对象的分配
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    result = func(bodies)
+    wall_ms = (time.perf_counter() - wall_start) * 1000
+    cpu_ms = (time.process_time() - cpu_start) * 1000
+    tracemalloc.start()
+    func(bodies)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    size_mb = sum(len(b) for b in bodies) / 1024 / 1024
+    print(f"{name:<8} 响应体={size_mb:8.1f}MB  CPU={cpu_ms:9.1f}ms  耗时={wall_ms:9.1f}ms  峰值内存={peak / 1024 / 1024:8.1f}MB")
+    return result
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="embedding返回格式解析开销对比")
+    arg_parser.add_argument("--chunks", type=int, default=10000)
+    arg_parser.add_argument("--dim", type=int, default=1024)
+    arg_parser.add_argument("--batch_size", type=int, default=10)
+    args = arg_parser.parse_args()
+
+    float_bodies, base64_bodies = build_payloads(args.chunks, args.dim, args.batch_size)
+    print(f"分块数={args.chunks}  维度={args.dim}  每批={args.batch_size}")
+    a = measure("float", parse_float, float_bodies)
+    b = measure("base64", parse_base64, base64_bodies)
+    assert a.shape == b.shape and np.allclose(a, b, atol=1e-6), "两种格式解码结果不一致"
+
+
+if __name__ == '__main__':
+    main()
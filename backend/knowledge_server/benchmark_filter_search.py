@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Date  : 2025/9/20
+# @File  : benchmark_filter_search.py
+# @Desc  : 压测元数据过滤检索的开销：一个租户collection里放10万+分块，对比不过滤、按file_id/folder_id/file_type过滤的检索延迟
+#          用随机向量代替真实embedding，不会调用embedding接口
+# 用法: python benchmark_filter_search.py --chunks 100000 --files 1000 --dim 1024
+
+import argparse
+import shutil
+import tempfile
+import time
+import numpy as np
+import chromadb
+from chromadb.config import Settings
+from embedding_utils import build_metadata_filter
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def build_collection(client, chunks, files, folders, dim, batch_size=5000):
+    """
+    构造一个租户collection：chunks个分块平均分给files个文件，文件平均分到folders个文件夹
+    """
+    col = client.get_or_create_collection("bench_tenant", metadata={"hnsw:space": "cosine"})
+    rng = np.random.default_rng(42)
+    file_types = ["pdf", "docx", "txt", "pptx"]
+    chunks_per_file = max(1, chunks // files)
+    start = time.time()
+    for begin in range(0, chunks, batch_size):
+        end = min(begin + batch_size, chunks)
+        embeddings = rng.random((end - begin, dim), dtype=np.float32)
+        metas = []
+        ids = []
+        for i in range(begin, end):
+            file_id = i // chunks_per_file
+            metas.append({
+                "file_id": file_id,
+                "folder_id": file_id % folders,
+                "file_type": file_types[file_id % len(file_types)],
+                "user_id": 1,
+            })
+            ids.append(f"{file_id}_{i % chunks_per_file}")
+        col.add(embeddings=embeddings, metadatas=metas, documents=[f"chunk {i}" for i in ids], ids=ids)
+    print(f"写入 {chunks} 个分块耗时 {time.time() - start:.1f}s")
+    return col
+
+
+def run_case(col, name, where, dim, queries, topk):
+    rng = np.random.default_rng(7)
+    latencies = []
+    for _ in range(queries):
+        q = rng.random((1, dim), dtype=np.float32)
+        start = time.perf_counter()
+        kwargs = {"where": where} if where else {}
+        col.query(query_embeddings=q, n_results=topk, include=["metadatas", "distances"], **kwargs)
+        latencies.append((time.perf_counter() - start) * 1000)
+    print(f"{name:<28} p50={_percentile(latencies, 0.5):8.2f}ms  p95={_percentile(latencies, 0.95):8.2f}ms")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="元数据过滤检索压测")
+    arg_parser.add_argument("--chunks", type=int, default=100000)
+    arg_parser.add_argument("--files", type=int, default=1000)
+    arg_parser.add_argument("--folders", type=int, default=50)
+    arg_parser.add_argument("--dim", type=int, default=1024)
+    arg_parser.add_argument("--queries", type=int, default=50)
+    arg_parser.add_argument("--topk", type=int, default=3)
+    args = arg_parser.parse_args()
+
+    db_dir = tempfile.mkdtemp(prefix="bench_filter_")
+    try:
+        client = chromadb.PersistentClient(path=db_dir, settings=Settings(anonymized_telemetry=False))
+        col = build_collection(client, args.chunks, args.files, args.folders, args.dim)
+        cases = [
+            ("不过滤", None),
+            ("file_id=单值", build_metadata_filter(file_id=1)),
+            ("file_id in 10个", build_metadata_filter(file_id=list(range(10)))),
+            ("file_id in 100个", build_metadata_filter(file_id=list(range(100)))),
+            ("folder_id=单值", build_metadata_filter(folder_id=3)),
+            ("file_type=单值", build_metadata_filter(file_type="pdf")),
+            ("folder_id+file_type", build_metadata_filter(folder_id=3, file_type=["pdf", "txt"])),
+        ]
+        for name, where in cases:
+            run_case(col, name, where, args.dim, args.queries, args.topk)
+
+        # 对比：每个文件单独一个小collection（现在main_api的做法）
+        small = client.get_or_create_collection("bench_single_file", metadata={"hnsw:space": "cosine"})
+        chunks_per_file = max(1, args.chunks // args.files)
+        rng = np.random.default_rng(1)
+        small.add(embeddings=rng.random((chunks_per_file, args.dim), dtype=np.float32),
+                  ids=[str(i) for i in range(chunks_per_file)])
+        run_case(small, "单文件独立collection", None, args.dim, args.queries, args.topk)
+    finally:
+        shutil.rmtree(db_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,14 +12,16 @@ import copy
 import json
 import logging
 import requests
-import numpy as np
 import pickle
 import hashlib
 from functools import wraps
 import string
-import chromadb  #pip install chromadb
-from chromadb.config import Settings
-from openai import OpenAI
+import base64
+import threading
+import contextlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+# chromadb、openai、numpy导入很慢（秒级），在第一次使用时才导入，见main.py中的后台预热
 from dotenv import load_dotenv
 # 加载环境变量
 load_dotenv()
@@ -27,6 +29,496 @@ load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# 部署角色：all(单进程读写，默认) / writer(唯一写进程) / reader(只读检索进程，可多worker)
+KNOWLEDGE_ROLE = os.getenv("KNOWLEDGE_ROLE", "all").lower()
+# reader 最多间隔多少秒检查一次写版本，即读到新数据的最大延迟
+READER_REFRESH_SECONDS = float(os.getenv("READER_REFRESH_SECONDS", "5"))
+# 写进程每次修改索引后更新的版本文件，放在chromadb目录下
+WRITE_VERSION_FILE = "write_version"
+
+# collection常驻内存预算（MB），0表示不限制，只记录访问频率和加载耗时
+RESIDENCY_MEMORY_BUDGET_MB = int(os.getenv("RESIDENCY_MEMORY_BUDGET_MB", "0"))
+
+# 每个db_dir共用一个client，reader在写版本变化后重建client
+_CLIENTS: Dict[str, Dict[str, Any]] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def read_write_version(db_dir: str) -> int:
+    """
+    读取db_dir下写进程记录的版本号，不存在时为0
+    """
+    try:
+        with open(os.path.join(db_dir, WRITE_VERSION_FILE), "r") as f:
+            return int(f.read().strip() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def bump_write_version(db_dir: str) -> int:
+    """
+    写进程修改索引后调用，版本号+1；先写临时文件再原子替换，reader不会读到半截内容
+    """
+    with _CLIENTS_LOCK:
+        version = read_write_version(db_dir) + 1
+        version_file = os.path.join(db_dir, WRITE_VERSION_FILE)
+        tmp_file = f"{version_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            f.write(str(version))
+        os.replace(tmp_file, version_file)
+    return version
+
+
+def _drop_chroma_system(db_dir: str):
+    """
+    丢弃chromadb为db_dir缓存的system（按持久化目录缓存），下次打开PersistentClient时重新从磁盘加载索引；
+    其它目录的client和索引不受影响。调用方需持有_CLIENTS_LOCK
+    """
+    from chromadb.api.shared_system_client import SharedSystemClient
+    SharedSystemClient._identifier_to_system.pop(db_dir, None)
+    SharedSystemClient._identifier_to_refcount.pop(db_dir, None)
+
+
+def get_chroma_client(db_dir: str):
+    """
+    获取db_dir对应的PersistentClient。
+    reader角色每隔READER_REFRESH_SECONDS检查写版本，版本变化时重新打开client，
+    这样其它进程写入的数据最多延迟READER_REFRESH_SECONDS秒可见。
+    """
+    now = time.time()
+    with _CLIENTS_LOCK:
+        entry = _CLIENTS.get(db_dir)
+        if entry is not None:
+            if KNOWLEDGE_ROLE != "reader" or now - entry["checked_at"] < READER_REFRESH_SECONDS:
+                return entry["client"]
+            entry["checked_at"] = now
+            version = read_write_version(db_dir)
+            if version == entry["version"]:
+                return entry["client"]
+            logger.info(f"检测到写版本变化 {entry['version']} -> {version}，重新加载chromadb: {db_dir}")
+            # 丢弃db_dir缓存的system，让PersistentClient重新从磁盘加载索引
+            _drop_chroma_system(db_dir)
+        else:
+            version = read_write_version(db_dir)
+        import chromadb  #pip install chromadb
+        from chromadb.config import Settings
+        settings = {"anonymized_telemetry": False}
+        if RESIDENCY_MEMORY_BUDGET_MB > 0:
+            # chromadb按python segment实现时（0.x）由它自己按LRU限制已加载索引的内存；1.x的rust实现不读这两个配置，由ResidencyManager管理
+            settings.update(chroma_segment_cache_policy="LRU",
+                            chroma_memory_limit_bytes=RESIDENCY_MEMORY_BUDGET_MB * 1024 * 1024)
+        client = chromadb.PersistentClient(path=db_dir, settings=Settings(**settings))
+        _CLIENTS[db_dir] = {"client": client, "version": version, "checked_at": now}
+        return client
+
+
+def reload_chroma_client(db_dir: str):
+    """
+    丢弃db_dir当前的client及其已加载的索引，下次get_chroma_client时重新打开，其它目录不受影响
+    """
+    with _CLIENTS_LOCK:
+        _CLIENTS.pop(db_dir, None)
+        _drop_chroma_system(db_dir)
+
+
+# 逻辑collection名 -> chromadb中实际的collection名，重新embedding迁移完成后原子切换，放在chromadb目录下
+ALIAS_FILE = "collection_aliases.json"
+_ALIASES: Dict[str, Dict[str, Any]] = {}  # db_dir -> {"mtime", "aliases"}
+
+
+def read_aliases(db_dir: str) -> Dict[str, str]:
+    """
+    读取别名表，按文件修改时间缓存，其它进程切换别名后立即可见
+    """
+    path = os.path.join(db_dir, ALIAS_FILE)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    cached = _ALIASES.get(db_dir)
+    if cached is not None and cached["mtime"] == mtime:
+        return cached["aliases"]
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            aliases = json.load(f)
+    except (FileNotFoundError, ValueError):
+        aliases = {}
+    _ALIASES[db_dir] = {"mtime": mtime, "aliases": aliases}
+    return aliases
+
+
+def set_alias(db_dir: str, collection: str, physical: Optional[str]):
+    """
+    设置（physical为None或与collection相同时删除）逻辑collection的别名，先写临时文件再原子替换
+    """
+    with _CLIENTS_LOCK:
+        aliases = dict(read_aliases(db_dir))
+        if physical is None or physical == collection:
+            aliases.pop(collection, None)
+        else:
+            aliases[collection] = physical
+        path = os.path.join(db_dir, ALIAS_FILE)
+        tmp_file = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(aliases, f, ensure_ascii=False)
+        os.replace(tmp_file, path)
+        _ALIASES.pop(db_dir, None)
+
+
+def resolve_collection(db_dir: str, collection: str) -> str:
+    return read_aliases(db_dir).get(collection, collection)
+
+
+# 写入和切换（迁移切别名、重建索引）互斥：切换时等正在进行的写入结束，新的写入等切换完成
+_WRITE_COND = threading.Condition()
+_ACTIVE_WRITES: Dict[tuple, int] = {}
+_SWAPPING: set = set()
+
+
+@contextlib.contextmanager
+def collection_write(db_dir: str, collection: str):
+    key = (db_dir, collection)
+    with _WRITE_COND:
+        while key in _SWAPPING:
+            _WRITE_COND.wait()
+        _ACTIVE_WRITES[key] = _ACTIVE_WRITES.get(key, 0) + 1
+    try:
+        yield
+    finally:
+        with _WRITE_COND:
+            _ACTIVE_WRITES[key] -= 1
+            if not _ACTIVE_WRITES[key]:
+                _ACTIVE_WRITES.pop(key)
+            _WRITE_COND.notify_all()
+
+
+@contextlib.contextmanager
+def collection_swap(db_dir: str, collection: str):
+    key = (db_dir, collection)
+    with _WRITE_COND:
+        while key in _SWAPPING:
+            _WRITE_COND.wait()
+        _SWAPPING.add(key)
+        while _ACTIVE_WRITES.get(key):
+            _WRITE_COND.wait()
+    try:
+        yield
+    finally:
+        with _WRITE_COND:
+            _SWAPPING.discard(key)
+            _WRITE_COND.notify_all()
+
+
+# 检索结果缓存的内存上限（字节），0表示关闭缓存
+SEARCH_CACHE_MAX_BYTES = int(os.getenv("SEARCH_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# 每个collection的写版本，任何插入/删除都会+1，作为检索缓存key的一部分
+_COLLECTION_VERSIONS: Dict[tuple, int] = {}
+
+
+def get_collection_version(db_dir: str, collection: str) -> int:
+    return _COLLECTION_VERSIONS.get((db_dir, collection), 0)
+
+
+def bump_collection_version(db_dir: str, collection: str) -> int:
+    with _CLIENTS_LOCK:
+        version = _COLLECTION_VERSIONS.get((db_dir, collection), 0) + 1
+        _COLLECTION_VERSIONS[(db_dir, collection)] = version
+    return version
+
+
+class SearchResultCache(object):
+    """
+    检索结果的LRU缓存，按结果序列化后的大小限制总内存。
+    key中包含collection写版本，写入/删除后旧结果自然失效，不会返回过期结果。
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[tuple, tuple]" = OrderedDict()  # key -> (result, size)
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(item[0])
+
+    def put(self, key, result):
+        if self.max_bytes <= 0:
+            return
+        size = len(json.dumps(result, ensure_ascii=False, default=str).encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            self._data[key] = (copy.deepcopy(result), size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and self._data:
+                _, (_, evicted_size) = self._data.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+search_cache = SearchResultCache(SEARCH_CACHE_MAX_BYTES)
+
+
+# 启动时预加载的collection，逗号分隔
+RESIDENCY_PRELOAD = [c.strip() for c in os.getenv("RESIDENCY_PRELOAD", "").split(",") if c.strip()]
+# 启用内存预算时，启动时再按访问次数预加载前N个collection
+RESIDENCY_PRELOAD_TOP_N = int(os.getenv("RESIDENCY_PRELOAD_TOP_N", "20"))
+# 访问次数、加载耗时持久化文件，重启后按它决定预加载哪些collection
+RESIDENCY_STATS_FILE = os.getenv("RESIDENCY_STATS_FILE", "cache/residency_stats.json")
+# 两次淘汰（重新打开client）的最小间隔，避免抖动
+RESIDENCY_EVICT_INTERVAL_SECONDS = float(os.getenv("RESIDENCY_EVICT_INTERVAL_SECONDS", "60"))
+RESIDENCY_SAVE_INTERVAL_SECONDS = float(os.getenv("RESIDENCY_SAVE_INTERVAL_SECONDS", "30"))
+
+
+def estimate_index_bytes(count: int, dim: int, m: int = 16) -> int:
+    """
+    估算一个collection的HNSW索引加载后的内存：每条向量dim个float32 + 双层邻接表约2*M个int + 少量固定开销
+    """
+    return int(count * (dim * 4 + m * 2 * 4 + 64))
+
+
+class ResidencyManager(object):
+    """
+    记录哪些collection的索引已加载进内存（常驻），按估算大小限制在预算内，超出时按LRU淘汰冷collection。
+    访问次数持久化到RESIDENCY_STATS_FILE，启动时按显式列表或访问频率预加载热collection，让热租户的检索延迟稳定。
+    chromadb 1.x的rust实现不能单独卸载某个collection的索引，淘汰时重新打开client（丢弃全部已加载索引），
+    再在后台重新加载仍在预算内的热collection。
+    只有reader进程会淘汰：写进程重新打开client可能和正在进行的写入冲突，writer/all角色超出预算时只记录统计
+    """
+    def __init__(self, db_dir: str, budget_bytes: int, stats_file: str):
+        self.db_dir = db_dir
+        self.budget_bytes = budget_bytes
+        self.stats_file = stats_file
+        self._lock = threading.RLock()
+        self._resident: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()  # collection -> {"bytes", "load_ms", "loaded_at"}
+        self._stats: Dict[str, Dict[str, Any]] = {}  # collection -> {"hits", "last_access", "load_ms", "loads", "bytes", "dim"}
+        self._pending_hits: Dict[str, int] = {}  # 上次保存后新增的访问次数，多进程保存时累加
+        self._last_evict = 0.0
+        self._last_save = time.time()
+        self.evictions = 0
+        self.reloads = 0
+        self.over_budget = 0  # 非reader进程超出预算但没有淘汰的次数
+        self._load_stats()
+
+    @property
+    def enabled(self) -> bool:
+        return self.budget_bytes > 0
+
+    def resident_bytes(self) -> int:
+        with self._lock:
+            return sum(item["bytes"] for item in self._resident.values())
+
+    def _load_stats(self):
+        try:
+            with open(self.stats_file, "r", encoding="utf-8") as f:
+                self._stats = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self._stats = {}
+
+    def save(self):
+        """
+        把访问次数合并进持久化文件（其它进程的计数也保留），先写临时文件再原子替换
+        """
+        with self._lock:
+            pending = self._pending_hits
+            self._pending_hits = {}
+            local = copy.deepcopy(self._stats)
+            self._last_save = time.time()
+        try:
+            with open(self.stats_file, "r", encoding="utf-8") as f:
+                merged = json.load(f)
+        except (FileNotFoundError, ValueError):
+            merged = {}
+        for collection, stat in local.items():
+            old_hits = merged.get(collection, {}).get("hits", 0)
+            merged[collection] = dict(stat, hits=old_hits + pending.get(collection, 0))
+        os.makedirs(os.path.dirname(self.stats_file) or ".", exist_ok=True)
+        tmp_file = f"{self.stats_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(merged, f, ensure_ascii=False)
+        os.replace(tmp_file, self.stats_file)
+        with self._lock:
+            for collection, stat in merged.items():
+                self._stats.setdefault(collection, {})["hits"] = stat.get("hits", 0) + self._pending_hits.get(collection, 0)
+
+    def record_access(self, collection: str, col, dim: int, elapsed_ms: float, count_hit: bool = True):
+        """
+        每次检索后调用。collection不在常驻集合里时，这次检索包含了加载索引的时间，记为加载耗时
+        """
+        now = time.time()
+        with self._lock:
+            stat = self._stats.setdefault(collection, {"hits": 0, "loads": 0})
+            if count_hit:
+                stat["hits"] = stat.get("hits", 0) + 1
+                self._pending_hits[collection] = self._pending_hits.get(collection, 0) + 1
+            stat["last_access"] = now
+            stat["dim"] = dim
+            if collection in self._resident:
+                self._resident.move_to_end(collection)
+                cold = False
+            else:
+                cold = True
+        if cold:
+            size = estimate_index_bytes(col.count(), dim, (col.metadata or {}).get("hnsw:M", 16))
+            with self._lock:
+                stat["load_ms"] = round(elapsed_ms, 1)
+                stat["loads"] = stat.get("loads", 0) + 1
+                stat["bytes"] = size
+                self._resident[collection] = {"bytes": size, "load_ms": round(elapsed_ms, 1), "loaded_at": now}
+                if not count_hit:
+                    # 预加载/淘汰后重新加载的不是真实访问，放在LRU最旧的一端，不挤掉刚被访问过的collection
+                    self._resident.move_to_end(collection, last=False)
+            logger.info(f"collection {collection} 加载进内存，耗时 {elapsed_ms:.1f}ms，估算 {size / 1024 / 1024:.1f}MB")
+            if self.enabled and self.resident_bytes() > self.budget_bytes:
+                self._evict()
+        if now - self._last_save > RESIDENCY_SAVE_INTERVAL_SECONDS:
+            try:
+                self.save()
+            except OSError as e:
+                logger.warning(f"保存常驻统计失败: {e}")
+
+    def _evict(self):
+        """
+        超出预算时保留最近使用、总大小在预算内的collection，其余淘汰
+        """
+        with self._lock:
+            if time.time() - self._last_evict < RESIDENCY_EVICT_INTERVAL_SECONDS:
+                return
+            keep, used = [], 0
+            for collection in reversed(self._resident):
+                size = self._resident[collection]["bytes"]
+                if used + size > self.budget_bytes:
+                    continue
+                keep.append(collection)
+                used += size
+            evicted = [c for c in self._resident if c not in keep]
+            if not evicted:
+                return
+            self._last_evict = time.time()
+            if KNOWLEDGE_ROLE != "reader":
+                self.over_budget += 1
+                logger.warning(f"常驻内存超出预算，{KNOWLEDGE_ROLE}进程不重新打开chromadb client，只记录统计: {evicted}")
+                return
+            self.evictions += len(evicted)
+            self.reloads += 1
+            self._resident.clear()
+        logger.info(f"常驻内存超出预算，淘汰 {evicted}，重新加载 {keep}")
+        reload_chroma_client(self.db_dir)
+        threading.Thread(target=self.preload, args=(list(reversed(keep)), False), name="residency-rewarm",
+                         daemon=True).start()
+
+    def warm(self, collection: str) -> Dict[str, Any]:
+        """
+        用collection里的一条向量检索一次，把索引加载进内存，返回加载耗时和估算大小
+        """
+        with self._lock:
+            if collection in self._resident:
+                return {"collection": collection, "status": "resident", **self._resident[collection]}
+        try:
+            col = get_chroma_client(self.db_dir).get_collection(collection)
+        except Exception:
+            return {"collection": collection, "status": "missing"}
+        sample = col.get(limit=1, include=["embeddings"])
+        if not sample["ids"]:
+            return {"collection": collection, "status": "empty"}
+        import numpy as np
+        query = np.asarray(sample["embeddings"][:1], dtype=np.float32)
+        size = estimate_index_bytes(col.count(), query.shape[1], (col.metadata or {}).get("hnsw:M", 16))
+        if self.enabled and self.resident_bytes() + size > self.budget_bytes:
+            return {"collection": collection, "status": "over_budget", "bytes": size}
+        start = time.perf_counter()
+        col.query(query_embeddings=query, n_results=1, include=[])
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self.record_access(collection, col, query.shape[1], elapsed_ms, count_hit=False)
+        return {"collection": collection, "status": "loaded", "load_ms": round(elapsed_ms, 1), "bytes": size}
+
+    def preload_candidates(self, top_n: Optional[int] = None) -> List[str]:
+        """
+        显式列表在前，启用预算时再按访问次数补上前top_n个
+        """
+        candidates = list(RESIDENCY_PRELOAD)
+        if self.enabled:
+            top_n = RESIDENCY_PRELOAD_TOP_N if top_n is None else top_n
+            with self._lock:
+                ranked = sorted(self._stats.items(), key=lambda item: item[1].get("hits", 0), reverse=True)
+            candidates += [c for c, stat in ranked[:top_n] if stat.get("hits", 0) > 0]
+        return list(OrderedDict.fromkeys(candidates))
+
+    def preload(self, collections: Optional[List[str]] = None, log: bool = True) -> List[Dict[str, Any]]:
+        """
+        依次加载collections（默认按preload_candidates），超出预算的跳过
+        """
+        results = []
+        for collection in (collections if collections is not None else self.preload_candidates()):
+            try:
+                results.append(self.warm(collection))
+            except Exception as e:
+                logger.error(f"预加载collection {collection} 失败: {e}", exc_info=True)
+                results.append({"collection": collection, "status": "error", "error": str(e)})
+        if log:
+            logger.info(f"预加载collection完成: {results}")
+        return results
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            collections = []
+            for collection, stat in sorted(self._stats.items(), key=lambda item: item[1].get("hits", 0), reverse=True):
+                collections.append({
+                    "collection": collection,
+                    "resident": collection in self._resident,
+                    "est_mb": round(stat.get("bytes", 0) / 1024 / 1024, 2),
+                    "load_ms": stat.get("load_ms"),
+                    "loads": stat.get("loads", 0),
+                    "hits": stat.get("hits", 0),
+                    "last_access": stat.get("last_access"),
+                })
+            return {
+                "enabled": self.enabled,
+                "budget_mb": round(self.budget_bytes / 1024 / 1024, 1),
+                "resident_mb": round(sum(item["bytes"] for item in self._resident.values()) / 1024 / 1024, 2),
+                "resident": list(self._resident),
+                "evict_enabled": self.enabled and KNOWLEDGE_ROLE == "reader",
+                "evictions": self.evictions,
+                "reloads": self.reloads,
+                "over_budget": self.over_budget,
+                "collections": collections,
+            }
+
+
+residency = ResidencyManager("cache/chromadb", RESIDENCY_MEMORY_BUDGET_MB * 1024 * 1024, RESIDENCY_STATS_FILE)
+
+
 def cal_md5(content):
     """
     计算content字符串的md5
@@ -48,12 +540,11 @@ def cache_decorator(func):
         func ():
     Returns:
     """
-    cache_path = "cache" #cache目录
-    if not os.path.exists(cache_path):
-        os.mkdir(cache_path)
+    cache_path = "cache" #cache目录，第一次调用时才创建
 
     @wraps(func)
     def wrapper(*args, **kwargs):
+        os.makedirs(cache_path, exist_ok=True)
         # 将args和kwargs转换为哈希键， 当装饰类中的函数的时候，args的第一个参数是实例化的类，这会通常导致改变，我们不想检测它是否改变，那么就忽略它
         usecache = kwargs.get("usecache", True)
         if "usecache" in kwargs:
@@ -62,8 +553,8 @@ def cache_decorator(func):
             if isinstance(args[0],(int, float, str, list, tuple, dict)):
                 key = str(args) + str(kwargs)
             else:
-                # 第1个参数以后的内容
-                key = str(args[1:]) + str(kwargs)
+                # 第1个参数以后的内容；实例可以通过cache_key_prefix区分（如不同的embedding模型）
+                key = getattr(args[0], "cache_key_prefix", "") + str(args[1:]) + str(kwargs)
         else:
             key = str(args) + str(kwargs)
         # 变成md5字符串
@@ -92,7 +583,130 @@ def cache_decorator(func):
     return wrapper
 
 
+def build_metadata_filter(file_id=None, folder_id=None, file_type=None) -> Optional[Dict[str, Any]]:
+    """
+    根据file_id/folder_id/file_type构造chromadb的where过滤条件，每个参数可以是单值或列表
+    Returns:
+        None表示不过滤
+    """
+    conditions = []
+    for field, value in (("file_id", file_id), ("folder_id", folder_id), ("file_type", file_type)):
+        if value is None or value == "" or value == []:
+            continue
+        if isinstance(value, (list, tuple, set)):
+            values = list(value)
+            conditions.append({field: values[0]} if len(values) == 1 else {field: {"$in": values}})
+        else:
+            conditions.append({field: value})
+    if not conditions:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"$and": conditions}
+
+
+# HNSW索引参数档位，创建collection或重建索引时使用，写入collection metadata的 hnsw:* 字段
+# M/construction_ef/batch_size/sync_threshold 只在建索引时生效，修改需要重建；search_ef 可以原地修改
+HNSW_SPACE = "cosine"
+HNSW_PARAM_KEYS = ("M", "construction_ef", "search_ef", "batch_size", "sync_threshold")
+HNSW_PROFILES: Dict[str, Dict[str, int]] = {
+    # chromadb默认值: M=16, construction_ef=100, search_ef=100, batch_size=100, sync_threshold=1000
+    "default": {},
+    # 几百~几千个分块的小租户，召回基本是满的，降低search_ef换延迟
+    "small": {"M": 16, "construction_ef": 100, "search_ef": 64},
+    # 十万级分块
+    "large": {"M": 32, "construction_ef": 200, "search_ef": 128, "batch_size": 1000, "sync_threshold": 5000},
+    # 百万级分块，建索引更慢、更占内存，换取召回
+    "xlarge": {"M": 48, "construction_ef": 400, "search_ef": 256, "batch_size": 2000, "sync_threshold": 20000},
+}
+# 新建collection默认使用的档位
+HNSW_DEFAULT_PROFILE = os.getenv("HNSW_DEFAULT_PROFILE", "default")
+
+
+def resolve_hnsw_params(profile: Optional[str] = None, params: Optional[Dict[str, int]] = None) -> Dict[str, int]:
+    """
+    档位参数 + 单独覆盖的参数，校验参数名和取值
+    """
+    profile = profile or HNSW_DEFAULT_PROFILE
+    if profile not in HNSW_PROFILES:
+        raise ValueError(f"未知的HNSW档位: {profile}，可选: {list(HNSW_PROFILES)}")
+    resolved = dict(HNSW_PROFILES[profile])
+    for key, value in (params or {}).items():
+        if key not in HNSW_PARAM_KEYS:
+            raise ValueError(f"不支持的HNSW参数: {key}，可选: {list(HNSW_PARAM_KEYS)}")
+        if not isinstance(value, int) or value <= 0:
+            raise ValueError(f"HNSW参数 {key} 需要是正整数: {value}")
+        resolved[key] = value
+    return resolved
+
+
+def hnsw_metadata(profile: Optional[str] = None, params: Optional[Dict[str, int]] = None,
+                  base: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    生成创建collection用的metadata: base中的非hnsw字段 + hnsw:space + 档位参数
+    """
+    metadata = {k: v for k, v in (base or {}).items() if not k.startswith("hnsw:") and k != "hnsw_profile"}
+    metadata["hnsw:space"] = (base or {}).get("hnsw:space", HNSW_SPACE)
+    for key, value in resolve_hnsw_params(profile, params).items():
+        metadata[f"hnsw:{key}"] = value
+    metadata["hnsw_profile"] = profile or HNSW_DEFAULT_PROFILE
+    return metadata
+
+
+# 联邦检索：并行查询多个collection的线程数上限，以及每个请求的超时
+FEDERATED_MAX_WORKERS = int(os.getenv("FEDERATED_MAX_WORKERS", "8"))
+FEDERATED_TIMEOUT_SECONDS = float(os.getenv("FEDERATED_TIMEOUT_SECONDS", "5"))
+# 线程池中排队+执行中的查询数上限（所有请求合计），超出的collection不再提交，直接标记为shed
+FEDERATED_MAX_PENDING = int(os.getenv("FEDERATED_MAX_PENDING", str(FEDERATED_MAX_WORKERS * 4)))
+_FEDERATED_POOL: Optional[ThreadPoolExecutor] = None
+_FEDERATED_LOCK = threading.Lock()
+_FEDERATED_INFLIGHT = 0
+
+
+def _federated_pool() -> ThreadPoolExecutor:
+    global _FEDERATED_POOL
+    with _CLIENTS_LOCK:
+        if _FEDERATED_POOL is None:
+            _FEDERATED_POOL = ThreadPoolExecutor(max_workers=FEDERATED_MAX_WORKERS, thread_name_prefix="federated-search")
+        return _FEDERATED_POOL
+
+
+def _federated_release(_future):
+    global _FEDERATED_INFLIGHT
+    with _FEDERATED_LOCK:
+        _FEDERATED_INFLIGHT -= 1
+
+
+def _federated_submit(fn, *args):
+    """
+    提交到联邦检索线程池；排队+执行中的查询已达FEDERATED_MAX_PENDING时不提交，返回None。
+    超时后仍在执行的查询线程无法中断，结束前一直计入上限，线程池饱和时新请求直接降级而不是无限排队
+    """
+    global _FEDERATED_INFLIGHT
+    with _FEDERATED_LOCK:
+        if _FEDERATED_INFLIGHT >= FEDERATED_MAX_PENDING:
+            return None
+        _FEDERATED_INFLIGHT += 1
+    future = _federated_pool().submit(fn, *args)
+    future.add_done_callback(_federated_release)
+    return future
+
+
+def distance_to_score(distance: float, space: str) -> float:
+    """
+    不同距离度量的distance归一化为[0, 1]的相似度，越大越相似，用于合并多个collection的结果
+    cosine/ip: distance = 1 - 相似度，范围[0, 2]；l2: 平方欧氏距离，范围[0, +inf)
+    """
+    if space in ("cosine", "ip"):
+        return max(0.0, min(1.0, 1.0 - distance / 2.0))
+    return 1.0 / (1.0 + max(distance, 0.0))
+
+
 class ChromaDB(object):
+    """
+    collection名都是逻辑名，读写前通过别名表解析为实际的collection（重新embedding迁移期间仍指向旧collection）；
+    collection metadata记录建库时的embedding模型和维度，检索和写入都用与之匹配的embedding模型
+    """
     def __init__(self, embedder, db_dir="cache/chromadb"):
         """
         Args:
@@ -101,19 +715,69 @@ class ChromaDB(object):
         """
         # 目前支持的模型,
         self.embedder = embedder
+        self.db_dir = db_dir
         if not os.path.exists(db_dir):
             os.makedirs(db_dir)
-        self.client = chromadb.PersistentClient(path=db_dir, settings=Settings(anonymized_telemetry=False))
+        self.client = get_chroma_client(db_dir)
+
+    def _after_write(self, collection):
+        """
+        索引被修改后调用，使该collection的检索缓存失效，并通知reader进程重新加载
+        """
+        bump_collection_version(self.db_dir, collection)
+        bump_write_version(self.db_dir)
+
+    def _physical(self, collection):
+        return resolve_collection(self.db_dir, collection)
+
+    def _embedding_metadata(self):
+        """
+        新建collection时记录的embedding模型和维度
+        """
+        model, dimensions = self.embedder.identity if self.embedder is not None else (EMBEDDING_MODEL, EMBEDDING_DIMENSIONS)
+        return {"embedding_model": model, "embedding_dimensions": dimensions}
+
+    def _get_or_create(self, collection):
+        return self.client.get_or_create_collection(self._physical(collection),
+                                                    metadata=hnsw_metadata(base=self._embedding_metadata()))
+
+    def _embedder_for(self, col):
+        """
+        与collection建库时一致的embedding模型；老collection没有记录时按默认模型
+        """
+        identity = collection_embedding_identity(col.metadata)
+        if self.embedder is not None and self.embedder.identity == identity:
+            return self.embedder
+        return get_embedder(*identity)
+
+    def _get_collection_for_read(self, collection):
+        """
+        只读场景获取collection，不存在时返回None，避免检索请求顺带创建空collection（reader进程不能写库）
+        """
+        try:
+            return self.client.get_collection(self._physical(collection))
+        except Exception:
+            return None
 
     def delete_one_collection(self, collection):
         """
-        删除1个collection
+        删除1个collection：别名指向的实际collection，以及迁移后仍保留在逻辑名下的源collection，删除期间持有写锁
         Args:
             collection ():
         Returns:
         """
         try:
-            self.client.delete_collection(name=collection)
+            with collection_write(self.db_dir, collection):
+                physical = self._physical(collection)
+                self.client.delete_collection(name=physical)
+                if physical != collection:
+                    try:
+                        # 迁移时没有drop_source，源collection还在逻辑名下
+                        self.client.delete_collection(name=collection)
+                    except Exception:
+                        pass
+                    set_alias(self.db_dir, collection, None)
+                self._after_write(collection)
         except Exception as e:
             print(f"删除collection:{collection}失败，错误信息:{e}")
             return "fail"
@@ -129,9 +793,10 @@ class ChromaDB(object):
             str: "success" 表示删除成功，"fail" 表示失败。
         """
         try:
-            col = self.client.get_or_create_collection(collection)
+            col = self.client.get_or_create_collection(self._physical(collection))
             # 删除指定 ID 的文档
             col.delete(ids=[doc_id])
+            self._after_write(collection)
             print(f"尝试删除集合 '{collection}' 中的文档 ID '{doc_id}'。")
 
             # 验证是否删除成功：查询该 ID，如果结果为空，则成功
@@ -156,47 +821,173 @@ class ChromaDB(object):
             meta: 插入collection的meta信息, list[]
         Returns:
         """
-        col = self.client.get_or_create_collection(collection, metadata={"hnsw:space": "cosine"})
-        vectors_result = self.embedder.do_embedding(documents)
-        vectors = vectors_result["data"]
-        embeddings = [one["embedding"] for one in vectors]
-        col.add(
-            embeddings=embeddings,
-            documents=documents,
-            metadatas=meta,
-            ids=[str(i) for i in range(len(documents))]
-        )
+        with collection_write(self.db_dir, collection):
+            col = self._get_or_create(collection)
+            vectors_result = self._embedder_for(col).do_embedding(documents)
+            embeddings = embeddings_array(vectors_result)
+            col.add(
+                embeddings=embeddings,
+                documents=documents,
+                metadatas=meta,
+                ids=[str(i) for i in range(len(documents))]
+            )
+            self._after_write(collection)
         return "success"
 
-    def query2collection(self, collection, query_documents, keyword="", topk=3):
+    def query2collection(self, collection, query_documents, keyword="", topk=3, file_id=None, folder_id=None, file_type=None):
         """
         查询向量，混合搜索
         Args:
             collection ():
             query_documents (): list[str]
             keyword: 是否同时对documents执行关键字搜索
+            file_id/folder_id/file_type: 按元数据过滤，可以是单值或列表，一个租户collection可以服务多个文件
         Returns:
         """
-        col = self.client.get_or_create_collection(collection)
-        vectors_result = self.embedder.do_embedding(texts=query_documents)
-        vectors = vectors_result["data"]
-        embeddings = [one["embedding"] for one in vectors]
+        where = build_metadata_filter(file_id=file_id, folder_id=folder_id, file_type=file_type)
+        # reader进程重新加载client后，进程内的collection版本不再可信，所以把client的写版本也放进key
+        client_version = _CLIENTS.get(self.db_dir, {}).get("version", 0)
+        cache_key = (self.db_dir, collection, tuple(query_documents), keyword or "", topk,
+                     json.dumps(where, sort_keys=True, default=str), get_collection_version(self.db_dir, collection), client_version)
+        cached = search_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"检索缓存命中: {collection}, {query_documents}")
+            return cached
+        col = self._get_collection_for_read(collection)
+        if col is None:
+            logger.info(f"collection {collection} 不存在，返回空结果")
+            return {
+                "ids": [[] for _ in query_documents],
+                "documents": [[] for _ in query_documents],
+                "metadatas": [[] for _ in query_documents],
+                "distances": [[] for _ in query_documents],
+            }
+        vectors_result = self._embedder_for(col).do_embedding(texts=query_documents)
+        embeddings = embeddings_array(vectors_result)
+        query_kwargs = {}
         if keyword:
-            query_result = col.query(
-                query_embeddings=embeddings,
-                n_results=topk,
-                where_document={"$contains": keyword},
-                include=["metadatas", "documents", "distances"]
-            )
-        else:
-            query_result = col.query(
-                query_embeddings=embeddings,
-                n_results=topk,
-                include=["metadatas", "documents", "distances"]
-            )
+            query_kwargs["where_document"] = {"$contains": keyword}
+        if where:
+            query_kwargs["where"] = where
+        start = time.perf_counter()
+        query_result = col.query(
+            query_embeddings=embeddings,
+            n_results=topk,
+            include=["metadatas", "documents", "distances"],
+            **query_kwargs
+        )
+        if self.db_dir == residency.db_dir:
+            residency.record_access(collection, col, embeddings.shape[1], (time.perf_counter() - start) * 1000)
+        search_cache.put(cache_key, query_result)
         return query_result
 
 
+    def federated_query(self, targets: List[Dict[str, Any]], query_document: str, keyword="", topk=3,
+                        timeout: Optional[float] = None):
+        """
+        跨多个collection检索：query只embedding一次，在有界线程池中并行查询各collection，
+        按各自的距离度量把distance归一化为score后合并取topk；整个请求从开始起超过timeout秒仍未返回的collection放弃其结果，
+        线程池饱和时超出FEDERATED_MAX_PENDING的collection不提交（shed）
+        Args:
+            targets: [{"collection", "file_id", "folder_id", "file_type"}]，过滤条件可选
+        Returns:
+            dict: {"results": [{"collection", "id", "document", "metadata", "distance", "score"}],
+                   "collections": [{"collection", "status", "elapsed_ms", "hits"}], "timings_ms"}
+        """
+        timeout = FEDERATED_TIMEOUT_SECONDS if timeout is None else timeout
+        total_start = time.perf_counter()
+        started: Dict[int, float] = {}
+        # 同一个embedding模型只embedding一次；collection来自不同模型（迁移中）时各自embedding
+        query_embeddings: Dict[tuple, Any] = {}
+        embedding_lock = threading.Lock()
+        embedding_ms = 0.0
+
+        def _embed(col):
+            nonlocal embedding_ms
+            embedder = self._embedder_for(col)
+            with embedding_lock:
+                if embedder.identity not in query_embeddings:
+                    start = time.perf_counter()
+                    query_embeddings[embedder.identity] = embeddings_array(embedder.do_embedding(texts=[query_document]))
+                    embedding_ms += (time.perf_counter() - start) * 1000
+                return query_embeddings[embedder.identity]
+
+        def _query_one(index, target):
+            started[index] = time.perf_counter()
+            collection = target["collection"]
+            col = self._get_collection_for_read(collection)
+            if col is None:
+                return None, "missing"
+            embeddings = _embed(col)
+            where = build_metadata_filter(file_id=target.get("file_id"), folder_id=target.get("folder_id"),
+                                          file_type=target.get("file_type"))
+            query_kwargs = {}
+            if keyword:
+                query_kwargs["where_document"] = {"$contains": keyword}
+            if where:
+                query_kwargs["where"] = where
+            query_start = time.perf_counter()
+            result = col.query(query_embeddings=embeddings, n_results=topk,
+                               include=["metadatas", "documents", "distances"], **query_kwargs)
+            if self.db_dir == residency.db_dir:
+                residency.record_access(collection, col, embeddings.shape[1], (time.perf_counter() - query_start) * 1000)
+            space = (col.metadata or {}).get("hnsw:space", "l2")
+            return (result, space), "ok"
+
+        deadline = total_start + timeout
+        statuses: List[Dict[str, Any]] = [{"collection": t["collection"], "status": "pending", "elapsed_ms": None, "hits": 0}
+                                          for t in targets]
+        pending = {}
+        for i, target in enumerate(targets):
+            future = _federated_submit(_query_one, i, target)
+            if future is None:
+                statuses[i]["status"] = "shed"
+                logger.warning(f"联邦检索线程池已满（{FEDERATED_MAX_PENDING}），跳过 {target['collection']}")
+                continue
+            pending[future] = i
+        merged: Dict[tuple, Dict[str, Any]] = {}
+        while pending:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            done, _ = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            now = time.perf_counter()
+            for future in done:
+                i = pending.pop(future)
+                statuses[i]["elapsed_ms"] = round((now - started.get(i, now)) * 1000, 1)
+                try:
+                    payload, status = future.result()
+                except Exception as e:
+                    logger.error(f"联邦检索 {targets[i]['collection']} 失败: {e}", exc_info=True)
+                    statuses[i]["status"] = "error"
+                    statuses[i]["error"] = str(e)
+                    continue
+                statuses[i]["status"] = status
+                if payload is None:
+                    continue
+                result, space = payload
+                for doc_id, document, metadata, distance in zip(result["ids"][0], result["documents"][0],
+                                                                result["metadatas"][0], result["distances"][0]):
+                    hit = {"collection": targets[i]["collection"], "id": doc_id, "document": document,
+                           "metadata": metadata, "distance": distance, "score": round(distance_to_score(distance, space), 6)}
+                    key = (hit["collection"], doc_id)
+                    if key not in merged or merged[key]["score"] < hit["score"]:
+                        merged[key] = hit
+                    statuses[i]["hits"] += 1
+        # 到截止时间仍未返回：还在排队的直接取消，已在执行的线程无法中断，结果丢弃
+        now = time.perf_counter()
+        for future, i in pending.items():
+            future.cancel()
+            statuses[i]["status"] = "timeout"
+            statuses[i]["elapsed_ms"] = round((now - started[i]) * 1000, 1) if i in started else None
+            logger.warning(f"联邦检索 {targets[i]['collection']} 超时（{timeout}s），丢弃其结果")
+        results = sorted(merged.values(), key=lambda hit: hit["score"], reverse=True)[:topk]
+        return {
+            "results": results,
+            "collections": statuses,
+            "timings_ms": {"embedding": round(embedding_ms, 1), "total": round((time.perf_counter() - total_start) * 1000, 1)},
+        }
+
     def delete_file_vectors(self, user_id: int, file_id: int):
         """
         根据用户ID和文件ID删除对应的向量
@@ -208,15 +999,18 @@ class ChromaDB(object):
         """
         try:
             collection_name = f"user_{user_id}"
-            col = self.client.get_or_create_collection(collection_name)
-            col.delete(where={"file_id": file_id})
+            with collection_write(self.db_dir, collection_name):
+                col = self._get_or_create(collection_name)
+                col.delete(where={"file_id": file_id})
+                self._after_write(collection_name)
             logger.info(f"成功删除用户 {user_id} 的文件 {file_id} 对应的向量")
             return "success"
         except Exception as e:
             logger.error(f"删除用户 {user_id} 的文件 {file_id} 向量失败: {str(e)}", exc_info=True)
             return "fail"
 
-    def insert_file_vectors(self, file_name:str, user_id: int, file_id: int, file_type: str, url: str, folder_id: int, documents: List[str]):
+    def insert_file_vectors(self, file_name:str, user_id: int, file_id: int, file_type: str, url: str, folder_id: int, documents: List[str],
+                            provenance: Optional[List[Dict[str, Any]]] = None):
         """
         将文件内容插入到ChromaDB中，生成并存储embedding向量
         Args:
@@ -227,37 +1021,184 @@ class ChromaDB(object):
             url (str): 文件URL
             folder_id (int): 文件夹ID
             documents (List[str]): 文件内容列表
+            provenance: 每个分块的出处（char_start/char_end/page），与documents一一对应，写入元数据；ordinal总是写入
         Returns:
-            dict: 包含embedding结果
+            dict: 入库摘要 {"collection", "chunks", "total_tokens", "timings_ms", "ids"}
         """
         try:
             collection_name = f"user_{user_id}"
-            vectors_result = self.embedder.do_embedding(texts=documents)
-            vectors = vectors_result["data"]
-            embeddings = [one["embedding"] for one in vectors]
-            meta = [{"file_name": file_name,"file_id": file_id, "user_id": user_id, "folder_id": folder_id, "url": url, "file_type": file_type} for _ in documents]
-            ids = [f"{file_id}_{i}" for i in range(len(documents))]
-            col = self.client.get_or_create_collection(collection_name, metadata={"hnsw:space": "cosine"})
-            col.add(
-                embeddings=embeddings,
-                documents=documents,
-                metadatas=meta,
-                ids=ids
-            )
+            with collection_write(self.db_dir, collection_name):
+                col = self._get_or_create(collection_name)
+                start = time.perf_counter()
+                vectors_result = self._embedder_for(col).do_embedding(texts=documents)
+                embedding_ms = (time.perf_counter() - start) * 1000
+                embeddings = embeddings_array(vectors_result)
+                meta = [{"file_name": file_name,"file_id": file_id, "user_id": user_id, "folder_id": folder_id, "url": url, "file_type": file_type,
+                         "ordinal": i, **(provenance[i] if provenance else {})} for i in range(len(documents))]
+                ids = [f"{file_id}_{i}" for i in range(len(documents))]
+                start = time.perf_counter()
+                col.add(
+                    embeddings=embeddings,
+                    documents=documents,
+                    metadatas=meta,
+                    ids=ids
+                )
+                write_ms = (time.perf_counter() - start) * 1000
+                self._after_write(collection_name)
             logger.info(f"成功插入文件 {file_id} 的向量到集合 {collection_name}")
-            return vectors_result
+            # 只返回摘要，不回传向量；需要向量时通过 /vectors/{user_id}/{file_id} 以二进制获取
+            return {
+                "collection": collection_name,
+                "chunks": len(ids),
+                "total_tokens": vectors_result.get("usage", {}).get("total_tokens", 0),
+                "timings_ms": {"embedding": round(embedding_ms, 1), "write": round(write_ms, 1)},
+                "ids": ids,
+            }
         except Exception as e:
             logger.error(f"插入用户 {user_id} 的文件 {file_id} 向量失败: {str(e)}", exc_info=True)
             raise ValueError(f"插入向量失败: {str(e)}")
 
 
+    def insert_file_vectors_stream(self, file_name: str, user_id: int, file_id: int, file_type: str, url: str, folder_id: int,
+                                   documents, window_size: int = 64, on_window=None):
+        """
+        流式插入文件内容：documents是可迭代对象（如生成器），每攒够window_size个分块就embedding并写入chromadb一次，
+        内存中只保留一个窗口的文本和向量，峰值内存与文档大小无关
+        Args:
+            documents: 可迭代的分块文本，元素也可以是 (文本, 出处dict) 二元组，出处写入元数据
+            window_size: 每个窗口的分块数
+            on_window: 每写完一个窗口的回调 on_window(chunks_done, windows_done)
+        Returns:
+            dict: 入库摘要 {"collection", "chunks", "windows", "total_tokens", "timings_ms", "ids"}
+        """
+        collection_name = f"user_{user_id}"
+        chunks = 0
+        windows = 0
+        total_tokens = 0
+        embedding_ms = 0.0
+        write_ms = 0.0
+        window: List[str] = []
+        window_provenance: List[Dict[str, Any]] = []
+
+        def _flush():
+            nonlocal chunks, windows, total_tokens, embedding_ms, write_ms
+            start = time.perf_counter()
+            vectors_result = embedder.do_embedding(texts=window)
+            embedding_ms += (time.perf_counter() - start) * 1000
+            total_tokens += vectors_result.get("usage", {}).get("total_tokens", 0)
+            embeddings = embeddings_array(vectors_result)
+            if len(embeddings) != len(window):
+                raise ValueError(f"第 {windows + 1} 个窗口embedding数量不一致: {len(embeddings)} != {len(window)}")
+            start = time.perf_counter()
+            col.add(
+                embeddings=embeddings,
+                documents=window,
+                metadatas=[{"file_name": file_name, "file_id": file_id, "user_id": user_id, "folder_id": folder_id,
+                            "url": url, "file_type": file_type, "ordinal": chunks + i, **window_provenance[i]}
+                           for i in range(len(window))],
+                ids=[f"{file_id}_{chunks + i}" for i in range(len(window))]
+            )
+            write_ms += (time.perf_counter() - start) * 1000
+            chunks += len(window)
+            windows += 1
+            self._after_write(collection_name)
+            if on_window:
+                on_window(chunks, windows)
+
+        try:
+            with collection_write(self.db_dir, collection_name):
+                col = self._get_or_create(collection_name)
+                embedder = self._embedder_for(col)
+                for doc in documents:
+                    doc, doc_provenance = doc if isinstance(doc, tuple) else (doc, {})
+                    window.append(doc)
+                    window_provenance.append(doc_provenance)
+                    if len(window) >= window_size:
+                        _flush()
+                        window = []
+                        window_provenance = []
+                if window:
+                    _flush()
+                    window = []
+                    window_provenance = []
+        except Exception as e:
+            logger.error(f"流式插入用户 {user_id} 的文件 {file_id} 向量失败，已写入 {chunks} 个分块: {str(e)}", exc_info=True)
+            raise ValueError(f"流式插入向量失败，已写入 {chunks} 个分块: {str(e)}")
+        logger.info(f"流式插入文件 {file_id} 到集合 {collection_name} 完成，共 {chunks} 个分块，{windows} 个窗口")
+        return {
+            "collection": collection_name,
+            "chunks": chunks,
+            "windows": windows,
+            "total_tokens": total_tokens,
+            "timings_ms": {"embedding": round(embedding_ms, 1), "write": round(write_ms, 1)},
+            "ids": [f"{file_id}_{i}" for i in range(chunks)],
+        }
+
+    def get_file_vectors(self, user_id: int, file_id: int):
+        """
+        读取某个文件已入库的全部向量
+        Returns:
+            (ids, embeddings): embeddings为float32的numpy数组，形状(n, dim)
+        """
+        import numpy as np
+        col = self._get_collection_for_read(f"user_{user_id}")
+        if col is None:
+            return [], np.zeros((0, 0), dtype=np.float32)
+        data = col.get(where={"file_id": file_id}, include=["embeddings"])
+        if not data["ids"]:
+            return [], np.zeros((0, 0), dtype=np.float32)
+        return data["ids"], np.asarray(data["embeddings"], dtype=np.float32)
+
+    def count_file_chunks(self, user_id: int, file_id: int) -> int:
+        """
+        某个文件已入库的分块数，只取id不取向量；collection不存在时返回0
+        """
+        col = self._get_collection_for_read(f"user_{user_id}")
+        if col is None:
+            return 0
+        return len(col.get(where={"file_id": file_id}, include=[])["ids"])
+
+    def get_neighbors(self, collection, ids, window=1):
+        """
+        按id直接取命中分块前后各window个相邻分块，不做embedding和ANN检索
+        分块id为 f"{file_id}_{ordinal}"，相邻分块即同一文件ordinal相差不超过window的分块
+        Args:
+            collection: 集合名称
+            ids: 命中分块的id列表
+            window: 前后各取几个分块
+        Returns:
+            list: 与ids顺序一致，[{"id", "neighbors": [{"id", "offset", "document", "metadata"}, ...]}]，neighbors按ordinal升序，包含命中分块自身(offset=0)
+        """
+        col = self._get_collection_for_read(collection)
+        wanted = []
+        for hit in ids:
+            prefix, sep, ordinal = str(hit).rpartition("_")
+            if not sep or not ordinal.isdigit():
+                wanted.append((hit, []))
+                continue
+            ordinal = int(ordinal)
+            wanted.append((hit, [(f"{prefix}_{n}", n - ordinal) for n in range(max(0, ordinal - window), ordinal + window + 1)]))
+        lookup_ids = list({nid for _, neighbors in wanted for nid, _ in neighbors})
+        found = {}
+        if col is not None and lookup_ids:
+            data = col.get(ids=lookup_ids, include=["documents", "metadatas"])
+            for nid, doc, meta in zip(data["ids"], data["documents"], data["metadatas"]):
+                found[nid] = (doc, meta)
+        result = []
+        for hit, neighbors in wanted:
+            result.append({
+                "id": hit,
+                "neighbors": [{"id": nid, "offset": offset, "document": found[nid][0], "metadata": found[nid][1]}
+                              for nid, offset in neighbors if nid in found],
+            })
+        return result
 
     def list_collection(self, collection, number=100):
         """
         列出某个集后的内容
         Returns:
         """
-        col = self.client.get_or_create_collection(collection)
+        col = self.client.get_or_create_collection(self._physical(collection))
         data = col.peek(number)
         total = col.count()
         result = {
@@ -267,6 +1208,168 @@ class ChromaDB(object):
         }
         return result
 
+    def export_collection(self, collection, page_size=1000, offset=0, limit=None):
+        """
+        分页导出collection，生成器，每次产出一行记录（dict），用于迁移租户或给新节点预热，导入时不需要重新embedding
+        第一行是header: {"type": "header", "collection", "metadata", "total", "dim", "dtype"}
+        之后每行: {"type": "record", "id", "embedding"(float32小端序的base64), "document", "metadata"}
+        Args:
+            page_size: 每页从chromadb读取的条数，决定内存占用
+            offset/limit: 只导出部分记录，用于断点续传
+        """
+        col = self._get_collection_for_read(collection)
+        if col is None:
+            raise ValueError(f"collection {collection} 不存在")
+        total = col.count()
+        end = total if limit is None else min(total, offset + limit)
+        header_written = False
+        while offset < end:
+            page = col.get(limit=min(page_size, end - offset), offset=offset,
+                           include=["embeddings", "documents", "metadatas"])
+            ids = page["ids"]
+            if not ids:
+                break
+            import numpy as np
+            embeddings = np.asarray(page["embeddings"], dtype="<f4")
+            if not header_written:
+                yield {"type": "header", "collection": collection, "metadata": col.metadata, "total": total,
+                       "dim": int(embeddings.shape[1]), "dtype": "float32"}
+                header_written = True
+            for i, doc_id in enumerate(ids):
+                yield {
+                    "type": "record",
+                    "id": doc_id,
+                    "embedding": base64.b64encode(embeddings[i].tobytes()).decode("ascii"),
+                    "document": page["documents"][i],
+                    "metadata": page["metadatas"][i],
+                }
+            offset += len(ids)
+        if not header_written:
+            yield {"type": "header", "collection": collection, "metadata": col.metadata, "total": total,
+                   "dim": 0, "dtype": "float32"}
+
+    def import_records(self, collection, records, collection_metadata=None):
+        """
+        把export_collection导出的记录批量写入collection（upsert，可重复导入），直接使用导出的向量，不调用embedding接口
+        Args:
+            records: list[dict]，export_collection产出的record行
+            collection_metadata: collection不存在时创建用的metadata，一般取自导出的header
+        Returns:
+            int: 写入条数
+        """
+        if not records:
+            return 0
+        import numpy as np
+        embeddings = np.stack([np.frombuffer(base64.b64decode(r["embedding"]), dtype="<f4") for r in records])
+        documents = [r.get("document") for r in records]
+        # 逐条保留metadata，没有metadata的记录传None（chromadb不接受空dict）
+        metadatas = [r.get("metadata") or None for r in records]
+        with collection_write(self.db_dir, collection):
+            col = self.client.get_or_create_collection(self._physical(collection),
+                                                      metadata=collection_metadata or hnsw_metadata(base=self._embedding_metadata()))
+            col.upsert(
+                ids=[r["id"] for r in records],
+                embeddings=embeddings,
+                # chromadb要求整批都有或都没有document
+                documents=documents if all(d is not None for d in documents) else None,
+                metadatas=metadatas if any(metadatas) else None,
+            )
+            self._after_write(collection)
+        return len(records)
+
+    def get_index_config(self, collection):
+        """
+        collection当前的索引配置：档位、metadata中的hnsw参数、chromadb实际生效的hnsw配置
+        """
+        col = self._get_collection_for_read(collection)
+        if col is None:
+            raise ValueError(f"collection {collection} 不存在")
+        metadata = col.metadata or {}
+        effective = dict((col.configuration or {}).get("hnsw") or {})
+        return {
+            "collection": collection,
+            "physical": col.name,
+            "embedding": dict(zip(("model", "dimensions"), collection_embedding_identity(metadata))),
+            "count": col.count(),
+            "profile": metadata.get("hnsw_profile", "default"),
+            "metadata": {k: v for k, v in metadata.items() if k.startswith("hnsw:")},
+            "effective": effective,
+        }
+
+    def set_index_profile(self, collection, profile=None, params=None, rebuild=False, page_size=1000):
+        """
+        设置collection的HNSW档位
+        - collection不存在: 按档位创建空collection，之后的入库沿用该档位
+        - 只有search_ef变化且不要求重建: 原地修改，立即生效
+        - 其它参数变化: 新建临时collection按新参数建索引，分页拷贝向量（不重新embedding），删除旧collection后改名
+          重建期间不要向该collection写入
+        Returns:
+            dict: {"collection", "action": created/updated/rebuilt/unchanged, "count", "build_ms", "index"}
+        """
+        profile = profile or HNSW_DEFAULT_PROFILE
+        col = self._get_collection_for_read(collection)
+        if col is None:
+            self.client.create_collection(self._physical(collection),
+                                          metadata=hnsw_metadata(profile, params, base=self._embedding_metadata()))
+            self._after_write(collection)
+            return {"collection": collection, "action": "created", "count": 0, "build_ms": 0.0,
+                    "index": self.get_index_config(collection)}
+        old_metadata = col.metadata or {}
+        new_metadata = hnsw_metadata(profile, params, base=old_metadata)
+        old_params = {k: v for k, v in old_metadata.items() if k.startswith("hnsw:") and k not in ("hnsw:space", "hnsw:search_ef")}
+        new_params = {k: v for k, v in new_metadata.items() if k.startswith("hnsw:") and k not in ("hnsw:space", "hnsw:search_ef")}
+        changed = {k for k in set(old_params) | set(new_params) if old_params.get(k) != new_params.get(k)}
+        # search_ef可能被原地修改过，和实际生效值比较
+        search_ef = new_metadata.get("hnsw:search_ef", 100)
+        if ((col.configuration or {}).get("hnsw") or {}).get("ef_search", 100) != search_ef:
+            changed.add("hnsw:search_ef")
+        if not changed and not rebuild:
+            return {"collection": collection, "action": "unchanged", "count": col.count(), "build_ms": 0.0,
+                    "index": self.get_index_config(collection)}
+        if changed <= {"hnsw:search_ef"} and not rebuild:
+            # metadata带hnsw:space时chromadb会拒绝修改，只改生效配置，metadata保留建索引时的参数
+            col.modify(configuration={"hnsw": {"ef_search": search_ef}})
+            self._after_write(collection)
+            logger.info(f"collection {collection} search_ef 原地修改为 {search_ef}")
+            return {"collection": collection, "action": "updated", "count": col.count(), "build_ms": 0.0,
+                    "index": self.get_index_config(collection)}
+
+        start = time.perf_counter()
+        physical = col.name
+        tmp_name = f"{physical}__rebuild"
+        # 重建期间挡住对该collection的写入，避免写到即将删除的旧collection
+        with collection_swap(self.db_dir, collection):
+            try:
+                self.client.delete_collection(tmp_name)
+            except Exception:
+                pass
+            tmp = self.client.create_collection(tmp_name, metadata=new_metadata)
+            total = col.count()
+            offset = 0
+            while offset < total:
+                page = col.get(limit=page_size, offset=offset, include=["embeddings", "documents", "metadatas"])
+                if not page["ids"]:
+                    break
+                documents = page["documents"]
+                metadatas = page["metadatas"]
+                tmp.add(
+                    ids=page["ids"],
+                    embeddings=page["embeddings"],
+                    documents=documents if all(d is not None for d in documents) else None,
+                    metadatas=metadatas if all(metadatas) else None,
+                )
+                offset += len(page["ids"])
+            if tmp.count() != total:
+                self.client.delete_collection(tmp_name)
+                raise ValueError(f"重建collection {collection} 拷贝条数不一致: {tmp.count()} != {total}")
+            self.client.delete_collection(physical)
+            tmp.modify(name=physical)
+            self._after_write(collection)
+        build_ms = (time.perf_counter() - start) * 1000
+        logger.info(f"collection {collection} 按档位 {profile} 重建索引完成，{total} 条，耗时 {build_ms:.0f}ms")
+        return {"collection": collection, "action": "rebuilt", "count": total, "build_ms": round(build_ms, 1),
+                "index": self.get_index_config(collection)}
+
     def list_exist_collections(self):
         """
         列出所有已有的collections
@@ -276,16 +1379,76 @@ class ChromaDB(object):
         collections = [i.name for i in collections_info]
         return collections
 
+# 向量传输格式：base64（默认，服务端返回float32字节的base64）或float（JSON浮点数组）
+EMBEDDING_ENCODING = os.getenv("EMBEDDING_ENCODING", "base64")
+
+
+def decode_embedding(value):
+    """
+    把接口返回的单条向量解码为float32 numpy数组，兼容base64字符串和浮点列表
+    """
+    import numpy as np
+    if isinstance(value, str):
+        return np.frombuffer(base64.b64decode(value), dtype="<f4")
+    return np.asarray(value, dtype=np.float32)
+
+
+def embeddings_array(vectors_result):
+    """
+    从do_embedding的结果中取出float32向量矩阵 (n, dim)；
+    兼容旧版本磁盘缓存中 {"data": [{"embedding": [...]}, ...]} 的格式
+    """
+    import numpy as np
+    if "embeddings" in vectors_result:
+        return vectors_result["embeddings"]
+    data = vectors_result.get("data") or []
+    if not data:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.asarray([one["embedding"] for one in data], dtype=np.float32)
+
+
+# 默认embedding模型和维度，更换后已有collection需要通过迁移任务重新embedding（见migrate_embeddings.py）
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-v4")
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "1024"))
+# 没有在metadata中记录embedding信息的老collection，都是用这个模型建的
+LEGACY_EMBEDDING = ("text-embedding-v4", 1024)
+_EMBEDDERS: Dict[tuple, "EmbeddingModel"] = {}
+
+
+def collection_embedding_identity(metadata: Optional[Dict[str, Any]]) -> tuple:
+    """
+    collection建库时使用的 (embedding模型, 维度)
+    """
+    metadata = metadata or {}
+    return (metadata.get("embedding_model", LEGACY_EMBEDDING[0]),
+            int(metadata.get("embedding_dimensions", LEGACY_EMBEDDING[1])))
+
+
+def get_embedder(model: str, dimensions: int) -> "EmbeddingModel":
+    """
+    按 (模型, 维度) 复用EmbeddingModel实例
+    """
+    key = (model, int(dimensions))
+    with _CLIENTS_LOCK:
+        if key not in _EMBEDDERS:
+            _EMBEDDERS[key] = EmbeddingModel(model=model, dimensions=int(dimensions))
+        return _EMBEDDERS[key]
+
+
 class EmbeddingModel(object):
-    def __init__(self, model="text-embedding-v4", provider="aliyun"):
+    def __init__(self, model=None, provider="aliyun", dimensions=None):
         """
         Args:
+            model: embedding模型，默认EMBEDDING_MODEL
+            dimensions: 向量维度，默认EMBEDDING_DIMENSIONS
         """
-        self.model = model
+        self.model = model or EMBEDDING_MODEL
+        self.dimensions = int(dimensions or EMBEDDING_DIMENSIONS)
         self.provider = provider
         if provider == "aliyun":
             api_key = os.getenv("ALI_API_KEY")
             assert api_key, "ALI_API_KEY没有设置，无法使用嵌入模型"
+            from openai import OpenAI
             self.client = OpenAI(
                 api_key=api_key,  # 如果您没有配置环境变量，请在此处用您的API Key进行替换
                 base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"  # 百炼服务的base_url
@@ -293,17 +1456,31 @@ class EmbeddingModel(object):
         else:
             raise Exception("目前只支持阿里云的模型")
 
+    @property
+    def identity(self):
+        return (self.model, self.dimensions)
+
+    @property
+    def cache_key_prefix(self):
+        """
+        embedding磁盘缓存key的前缀：默认模型保持为空，兼容已有缓存；其它模型/维度的结果分开缓存
+        """
+        return "" if self.identity == LEGACY_EMBEDDING else f"{self.model}/{self.dimensions}"
+
     @cache_decorator
     def do_embedding(self, texts: list[str]):
         """
         对数据进行embedding，处理批量大小限制，确保所有文本都被处理
+        默认以base64请求向量，直接解码为连续的float32 numpy数组，不经过Python float列表
         Args:
             texts: 数据，为一个list，每个元素为一个字符串
         Returns:
-            dict: 包含所有输入文本的embedding结果
+            dict: {"embeddings": np.ndarray float32 (n, dim), "usage": {"total_tokens": int}}
         """
+        import numpy as np
         max_batch_size = 10  # 最大批量大小限制 避免报错
-        result = {"data": []}  # 用于收集所有批次的嵌入结果
+        parts = []  # 每个批次解码后的float32数组
+        result = {"usage": {"total_tokens": 0}}  # token用量
 
         # 循环处理所有文本，分割成批次
         for i in range(0, len(texts), max_batch_size):
@@ -312,17 +1489,20 @@ class EmbeddingModel(object):
                 completion = self.client.embeddings.create(
                     model=self.model,
                     input=batch_texts,
-                    dimensions=1024,
-                    encoding_format="float"
+                    dimensions=self.dimensions,
+                    encoding_format=EMBEDDING_ENCODING
                 )
-                batch_result = completion.dict()
-                result["data"].extend(batch_result["data"])  # 合并当前批次的嵌入结果
+                items = sorted(completion.data, key=lambda one: one.index)
+                parts.append(np.vstack([decode_embedding(one.embedding) for one in items]))
+                if completion.usage is not None:
+                    result["usage"]["total_tokens"] += completion.usage.total_tokens or 0
                 logger.info(f"成功嵌入批次 {i // max_batch_size + 1}，包含 {len(batch_texts)} 个文本")
             except Exception as e:
                 logger.error(f"嵌入批次 {i // max_batch_size + 1} 失败: {e}")
                 # 如果需要，可以在这里返回错误，但为了继续处理，我们只记录日志
                 # 如果想在出错时停止，可以 raise e 或返回 {"error": str(e), "data": []}
 
+        result["embeddings"] = np.concatenate(parts) if parts else np.zeros((0, 0), dtype=np.float32)
         logger.info(f"所有 {len(texts)} 个文本嵌入完成")
         return result
 
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Date  : 2025/9/26
+# @File  : hnsw_sweep.py
+# @Desc  : HNSW参数扫描：对一个collection的真实向量（或随机向量），按不同档位/参数重新建索引，
+#          统计建索引耗时、内存增量、磁盘占用、检索延迟和recall@k（以numpy暴力检索为准），用于给大租户选档位
+#          只读原collection，索引建在临时目录，不会修改线上数据，也不会调用embedding接口
+# 用法: python hnsw_sweep.py --db_dir cache/chromadb --collection user_2 --profiles default,large,xlarge
+#      python hnsw_sweep.py --synthetic 100000 --dim 1024 --grid "M=16,32 construction_ef=100,200 search_ef=64,128,256"
+
+import argparse
+import itertools
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+import chromadb
+from chromadb.config import Settings
+from embedding_utils import HNSW_PROFILES, resolve_hnsw_params
+
+# chromadb单次add的最大条数在5000多，分批写入
+ADD_BATCH_SIZE = 5000
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def _rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError):
+        return 0.0
+
+
+def _dir_size_mb(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total / 1024 / 1024
+
+
+def load_vectors(db_dir, collection, page_size=5000):
+    """
+    分页读出collection的全部向量
+    """
+    client = chromadb.PersistentClient(path=db_dir, settings=Settings(anonymized_telemetry=False))
+    col = client.get_collection(collection)
+    total = col.count()
+    parts = []
+    for offset in range(0, total, page_size):
+        page = col.get(limit=page_size, offset=offset, include=["embeddings"])
+        parts.append(np.asarray(page["embeddings"], dtype=np.float32))
+    space = (col.metadata or {}).get("hnsw:space", "l2")
+    return np.concatenate(parts), space
+
+
+def make_queries(vectors, n, seed=7):
+    """
+    从库中抽样向量加少量噪声作为查询，近似真实查询（查询和文档分布接近，但不完全命中某个文档）
+    """
+    rng = np.random.default_rng(seed)
+    picked = vectors[rng.choice(len(vectors), size=min(n, len(vectors)), replace=False)]
+    noise = rng.standard_normal(picked.shape).astype(np.float32) * picked.std() * 0.3
+    return picked + noise
+
+
+def brute_force_topk(vectors, queries, k, space, block=1024):
+    """
+    numpy暴力检索，作为recall的标准答案
+    """
+    if space == "cosine":
+        base = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        q = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+    else:
+        base, q = vectors, queries
+    base_sq = (base ** 2).sum(axis=1)
+    result = []
+    for begin in range(0, len(q), block):
+        qb = q[begin:begin + block]
+        if space in ("cosine", "ip"):
+            scores = -(qb @ base.T)
+        else:
+            scores = base_sq[None, :] - 2 * (qb @ base.T)
+        top = np.argpartition(scores, kth=min(k, scores.shape[1] - 1), axis=1)[:, :k]
+        order = np.take_along_axis(scores, top, axis=1).argsort(axis=1)
+        result.append(np.take_along_axis(top, order, axis=1))
+    return np.concatenate(result)
+
+
+def run_config(name, params, vectors, queries, truth, space, k):
+    """
+    按一组参数在临时目录建索引并测量
+    """
+    db_dir = tempfile.mkdtemp(prefix="hnsw_sweep_")
+    try:
+        client = chromadb.PersistentClient(path=db_dir, settings=Settings(anonymized_telemetry=False))
+        metadata = {"hnsw:space": space, **{f"hnsw:{key}": value for key, value in params.items()}}
+        rss_before = _rss_mb()
+        start = time.perf_counter()
+        col = client.create_collection("sweep", metadata=metadata)
+        for begin in range(0, len(vectors), ADD_BATCH_SIZE):
+            end = min(begin + ADD_BATCH_SIZE, len(vectors))
+            col.add(ids=[str(i) for i in range(begin, end)], embeddings=vectors[begin:end])
+        build_s = time.perf_counter() - start
+        rss_delta = _rss_mb() - rss_before
+
+        latencies = []
+        hits = 0
+        for i, q in enumerate(queries):
+            start = time.perf_counter()
+            found = col.query(query_embeddings=q[None, :], n_results=k, include=[])["ids"][0]
+            latencies.append((time.perf_counter() - start) * 1000)
+            hits += len(set(int(x) for x in found) & set(truth[i].tolist()))
+        recall = hits / (len(queries) * k)
+        print(f"{name:<40} build={build_s:8.1f}s  rss+={rss_delta:8.1f}MB  disk={_dir_size_mb(db_dir):8.1f}MB  "
+              f"p50={_percentile(latencies, 0.5):7.2f}ms  p95={_percentile(latencies, 0.95):7.2f}ms  recall@{k}={recall:.4f}")
+        client.delete_collection("sweep")
+    finally:
+        shutil.rmtree(db_dir, ignore_errors=True)
+
+
+def parse_grid(grid):
+    """
+    "M=16,32 search_ef=64,128" -> [{"M": 16, "search_ef": 64}, ...]
+    """
+    axes = []
+    for part in grid.split():
+        key, values = part.split("=")
+        axes.append([(key, int(v)) for v in values.split(",")])
+    return [dict(combo) for combo in itertools.product(*axes)]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="HNSW参数扫描: 建索引耗时/内存/延迟/recall@k")
+    arg_parser.add_argument("--db_dir", default="cache/chromadb")
+    arg_parser.add_argument("--collection", help="要扫描的collection，不填则使用--synthetic随机向量")
+    arg_parser.add_argument("--synthetic", type=int, default=20000, help="随机向量条数")
+    arg_parser.add_argument("--dim", type=int, default=1024)
+    arg_parser.add_argument("--profiles", default=",".join(HNSW_PROFILES), help="逗号分隔的档位名")
+    arg_parser.add_argument("--grid", default="", help='参数网格，如 "M=16,32 search_ef=64,128"，填了则忽略--profiles')
+    arg_parser.add_argument("--queries", type=int, default=200)
+    arg_parser.add_argument("--topk", type=int, default=10)
+    args = arg_parser.parse_args()
+
+    if args.collection:
+        vectors, space = load_vectors(args.db_dir, args.collection)
+        print(f"collection {args.collection}: {vectors.shape[0]} 条, 维度 {vectors.shape[1]}, space={space}")
+    else:
+        vectors = np.random.default_rng(42).standard_normal((args.synthetic, args.dim)).astype(np.float32)
+        space = "cosine"
+        print(f"随机向量: {vectors.shape[0]} 条, 维度 {vectors.shape[1]}")
+    queries = make_queries(vectors, args.queries)
+    start = time.perf_counter()
+    truth = brute_force_topk(vectors, queries, args.topk, space)
+    print(f"暴力检索 {len(queries)} 个查询耗时 {time.perf_counter() - start:.1f}s")
+
+    if args.grid:
+        configs = [(" ".join(f"{k}={v}" for k, v in params.items()), resolve_hnsw_params("default", params))
+                   for params in parse_grid(args.grid)]
+    else:
+        configs = [(name, resolve_hnsw_params(name)) for name in args.profiles.split(",")]
+    for name, params in configs:
+        run_config(name, params, vectors, queries, truth, space, args.topk)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,16 +4,29 @@
 # @Desc  : 使用FastAPI实现API，接收JSON或RabbitMQ消息，下载七牛云文件，读取内容并生成embedding向量
 
 import os
+import time
+_MODULE_IMPORT_START = time.perf_counter()
+import io
 import json
+import zlib
+import queue
+import threading
+import contextlib
+import resource
 import requests
 import uvicorn
 import logging
 import asyncio
 import uuid
-from fastapi import FastAPI, HTTPException, File, UploadFile, Form
+import shutil
+import argparse
+import httpx
+from fastapi import FastAPI, HTTPException, File, UploadFile, Form, Request
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel, ValidationError
-from typing import List, Optional
+from typing import Dict, List, Optional, Union
 import embedding_utils
+import migrate_embeddings
 import read_all_files
 from urllib.parse import urlparse
 
@@ -21,7 +34,193 @@ from urllib.parse import urlparse
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+# 后台预热：chromadb/openai/numpy/tika都是懒加载，服务先启动，再在后台线程中依次加载并记录耗时
+KNOWLEDGE_WARMUP = os.getenv("KNOWLEDGE_WARMUP", "1") == "1"
+_WARMUP_STATE = {
+    "search_ready": False,   # 检索所需依赖已加载，可以低延迟服务/search
+    "fully_warmed": False,   # 解析文件所需的tika/JVM也已就绪
+    "import_times_ms": {},
+    "errors": {},
+}
+
+
+def _timed_stage(name, func):
+    start = time.perf_counter()
+    try:
+        func()
+        return True
+    except Exception as e:
+        logger.error(f"预热阶段 {name} 失败: {str(e)}", exc_info=True)
+        _WARMUP_STATE["errors"][name] = str(e)
+        return False
+    finally:
+        _WARMUP_STATE["import_times_ms"][name] = round((time.perf_counter() - start) * 1000, 1)
+
+
+def _warmup():
+    """
+    依次加载检索依赖和解析依赖，记录每一步的耗时
+    """
+    search_ok = all([
+        _timed_stage("import_numpy", lambda: __import__("numpy")),
+        _timed_stage("import_chromadb", lambda: __import__("chromadb")),
+        _timed_stage("open_chromadb", lambda: embedding_utils.get_chroma_client("cache/chromadb")),
+        _timed_stage("import_openai", lambda: __import__("openai")),
+    ])
+    if search_ok and embedding_utils.residency.preload_candidates():
+        # 热collection预加载完再标记就绪，避免热租户的第一次检索承担加载索引的耗时
+        _timed_stage("preload_collections", embedding_utils.residency.preload)
+    _WARMUP_STATE["search_ready"] = search_ok
+    tika_ok = _timed_stage("init_tika", read_all_files.init_tika)
+    _WARMUP_STATE["fully_warmed"] = search_ok and tika_ok
+    logger.info(f"预热完成: {_WARMUP_STATE}")
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    if KNOWLEDGE_WARMUP:
+        threading.Thread(target=_warmup, name="knowledge-warmup", daemon=True).start()
+    if embedding_utils.KNOWLEDGE_ROLE != "reader":
+        # 继续上次进程中断的重新embedding迁移
+        threading.Thread(target=migrate_embeddings.resume_migrations, name="resume-migrations", daemon=True).start()
+    yield
+    try:
+        embedding_utils.residency.save()
+    except OSError as e:
+        logger.warning(f"保存常驻统计失败: {e}")
+
+
+app = FastAPI(lifespan=lifespan)
+
+# 多进程部署：reader进程只处理检索，写请求转发给唯一的writer进程
+KNOWLEDGE_WRITER_URL = os.getenv("KNOWLEDGE_WRITER_URL", "")
+KNOWLEDGE_WRITER_TIMEOUT = float(os.getenv("KNOWLEDGE_WRITER_TIMEOUT", "600"))
+# 转发时不透传的逐跳头
+_HOP_HEADERS = {"host", "content-length", "transfer-encoding", "connection", "keep-alive"}
+_writer_client: Optional[httpx.AsyncClient] = None
+
+
+def _is_read_request(request: Request) -> bool:
+    """
+    GET请求和/search开头的检索请求都是只读的，reader可以直接处理
+    """
+    if request.url.path.startswith("/vectorize/"):
+        # 入库进度只在writer进程中
+        return False
+    if request.url.path.startswith("/residency"):
+        # 常驻内存是每个进程自己的，预加载在当前进程执行
+        return True
+    return request.method in ("GET", "HEAD", "OPTIONS") or request.url.path.startswith("/search")
+
+
+@app.middleware("http")
+async def forward_writes_to_writer(request: Request, call_next):
+    """
+    reader角色下，把会修改索引的请求原样转发给writer进程，保证只有一个进程写chromadb
+    """
+    global _writer_client
+    if embedding_utils.KNOWLEDGE_ROLE != "reader" or _is_read_request(request):
+        return await call_next(request)
+    if not KNOWLEDGE_WRITER_URL:
+        logger.error("reader角色下未设置KNOWLEDGE_WRITER_URL，无法处理写请求")
+        return Response(content=json.dumps({"detail": "只读检索节点，未配置KNOWLEDGE_WRITER_URL"}, ensure_ascii=False),
+                        status_code=503, media_type="application/json")
+    if _writer_client is None:
+        _writer_client = httpx.AsyncClient(base_url=KNOWLEDGE_WRITER_URL.rstrip("/"),
+                                           timeout=KNOWLEDGE_WRITER_TIMEOUT, trust_env=False)
+    headers = {k: v for k, v in request.headers.items() if k.lower() not in _HOP_HEADERS}
+    url = request.url.path + (f"?{request.url.query}" if request.url.query else "")
+    logger.info(f"reader转发写请求到writer: {request.method} {url}")
+    try:
+        writer_resp = await _writer_client.request(request.method, url, headers=headers, content=request.stream())
+    except httpx.HTTPError as e:
+        logger.error(f"转发写请求失败: {str(e)}", exc_info=True)
+        return Response(content=json.dumps({"detail": f"转发写请求失败: {str(e)}"}, ensure_ascii=False),
+                        status_code=502, media_type="application/json")
+    resp_headers = {k: v for k, v in writer_resp.headers.items()
+                    if k.lower() not in _HOP_HEADERS and k.lower() != "content-encoding"}
+    return Response(content=writer_resp.content, status_code=writer_resp.status_code, headers=resp_headers)
+
+
+# 请求体gzip解压后的大小上限，防止压缩炸弹
+REQUEST_MAX_DECOMPRESSED_MB = int(os.getenv("REQUEST_MAX_DECOMPRESSED_MB", "2048"))
+
+
+class RequestBodyError(HTTPException):
+    """
+    gzip请求体解压失败（400）或解压后超过上限（413），在读取请求体时抛出。
+    继承HTTPException：FastAPI解析请求体时、接口中 except HTTPException: raise 的地方都会原样抛出；
+    经过 @app.middleware("http") 时会被包进ExceptionGroup，所以GzipRequestMiddleware记下错误后，
+    丢弃内层返回的响应（500/400等），改为返回这里的状态码
+    """
+
+
+class GzipRequestMiddleware:
+    """
+    Content-Encoding: gzip 的请求体在这里边接收边解压，后面的中间件和接口拿到的就是原始JSON/NDJSON；
+    压缩数据损坏返回400，解压后超过REQUEST_MAX_DECOMPRESSED_MB返回413（读取请求体时抛出RequestBodyError）
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        if headers.get(b"content-encoding", b"").lower() != b"gzip":
+            return await self.app(scope, receive, send)
+        scope = dict(scope)
+        scope["headers"] = [(k, v) for k, v in scope["headers"] if k not in (b"content-encoding", b"content-length")]
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        limit = REQUEST_MAX_DECOMPRESSED_MB * 1024 * 1024
+        total = 0
+        response_started = False
+        # 解压错误可能被内层中间件包装成别的异常，这里单独记下来，响应还没开始时兜底返回
+        decode_error: Optional[RequestBodyError] = None
+
+        async def _receive():
+            nonlocal total, decode_error
+            message = await receive()
+            if message["type"] != "http.request":
+                return message
+            more_body = message.get("more_body", False)
+            try:
+                body = decompressor.decompress(message.get("body", b""))
+                if not more_body:
+                    body += decompressor.flush()
+            except zlib.error as e:
+                decode_error = RequestBodyError(status_code=400, detail=f"gzip请求体无法解压: {str(e)}")
+                raise decode_error from e
+            total += len(body)
+            if total > limit:
+                decode_error = RequestBodyError(status_code=413, detail=f"请求体解压后超过 {REQUEST_MAX_DECOMPRESSED_MB}MB")
+                raise decode_error
+            return {"type": "http.request", "body": body, "more_body": more_body}
+
+        async def _send(message):
+            nonlocal response_started
+            if decode_error is not None and not response_started:
+                # 请求体出错后内层把异常转成了别的响应，丢弃，由下面统一返回400/413
+                return
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, _receive, _send)
+        except Exception:
+            if decode_error is None or response_started:
+                raise
+        if decode_error is not None and not response_started:
+            logger.warning(decode_error.detail)
+            response = Response(content=json.dumps({"detail": decode_error.detail}, ensure_ascii=False),
+                                status_code=decode_error.status_code, media_type="application/json")
+            await response(scope, receive, send)
+
+
+# 最后添加的中间件在最外层：先解压，reader转发给writer的也是解压后的请求体
+app.add_middleware(GzipRequestMiddleware)
 
 # 请求体
 class RequestBody(BaseModel):
@@ -40,14 +239,79 @@ class RabbitMessage(BaseModel):
 TEMP_DIR = "temp_download"
 if not os.path.exists(TEMP_DIR):
     os.makedirs(TEMP_DIR)
+# 不超过该大小的文件直接在内存中解析，不写临时文件
+PARSE_IN_MEMORY_MAX_BYTES = int(os.getenv("PARSE_IN_MEMORY_MAX_BYTES", str(20 * 1024 * 1024)))
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# 超过该大小的文件自动使用流式入库（边解析边embedding边写入），也可以在/upload/中传streaming=true强制开启；
+# 默认与内存解析阈值相同，即不超过20MB的文件在内存中整体解析，更大的文件落临时文件流式入库
+STREAM_INGEST_MIN_BYTES = int(os.getenv("STREAM_INGEST_MIN_BYTES", str(PARSE_IN_MEMORY_MAX_BYTES)))
+# 流式入库每个窗口的分块数
+INGEST_WINDOW_SIZE = int(os.getenv("INGEST_WINDOW_SIZE", "64"))
+# NDJSON上传时队列满（embedding跟不上）阻塞等待的单次超时，超时后检查消费线程是否已经结束
+NDJSON_PUT_TIMEOUT_SECONDS = float(os.getenv("NDJSON_PUT_TIMEOUT_SECONDS", "1"))
+# 流式入库进度，key为 f"{userId}_{fileId}"
+_INGEST_PROGRESS: dict = {}
+
+
+def _use_stream_ingest(size: int, streaming: bool = False) -> bool:
+    """
+    是否使用流式入库：显式要求，或文件超过STREAM_INGEST_MIN_BYTES（内存中解析的文件同样适用）
+    """
+    return streaming or size > STREAM_INGEST_MIN_BYTES
 
 # RabbitMQ消息处理类
 
+@app.get("/healthz")
+def healthz():
+    """
+    存活探针，不依赖任何重型依赖
+    """
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+def readyz(full: bool = False):
+    """
+    就绪探针：
+    - 默认：检索依赖加载完成（可以服务/search）返回200，否则503
+    - full=true：解析文件所需的tika也就绪才返回200
+    返回体中带各阶段的加载耗时
+    """
+    ready = _WARMUP_STATE["fully_warmed"] if full else _WARMUP_STATE["search_ready"]
+    body = {
+        "status": "ready" if ready else "warming",
+        "serving_search": _WARMUP_STATE["search_ready"],
+        "fully_warmed": _WARMUP_STATE["fully_warmed"],
+        "import_times_ms": _WARMUP_STATE["import_times_ms"],
+        "errors": _WARMUP_STATE["errors"],
+    }
+    return Response(content=json.dumps(body, ensure_ascii=False), status_code=200 if ready else 503,
+                    media_type="application/json")
+
+
+@app.get("/deploy_info")
+def deploy_info():
+    """
+    当前进程的部署信息，多worker部署时用来确认角色和reader看到的数据版本
+    """
+    db_dir = "cache/chromadb"
+    return {
+        "role": embedding_utils.KNOWLEDGE_ROLE,
+        "pid": os.getpid(),
+        "writer_url": KNOWLEDGE_WRITER_URL,
+        "write_version": embedding_utils.read_write_version(db_dir),
+        "refresh_seconds": embedding_utils.READER_REFRESH_SECONDS,
+    }
+
 class SearchQuery(BaseModel):
     userId: int | str
     query: str
     keyword: Optional[str] = ""
     topk: Optional[int] = 3
+    # 元数据过滤，可以是单值或列表
+    fileId: Optional[Union[int, List[int]]] = None
+    folderId: Optional[Union[int, List[int]]] = None
+    fileType: Optional[Union[str, List[str]]] = None
 
 @app.post("/search")
 def search_personal_knowledge_base(query: SearchQuery):
@@ -64,7 +328,10 @@ def search_personal_knowledge_base(query: SearchQuery):
             collection=collection_name,
             query_documents=[query.query],
             keyword=query.keyword,
-            topk=query.topk
+            topk=query.topk,
+            file_id=query.fileId,
+            folder_id=query.folderId,
+            file_type=query.fileType
         )
         logger.info(f"搜索成功: {result}")
         return result
@@ -72,17 +339,256 @@ def search_personal_knowledge_base(query: SearchQuery):
         logger.error(f"搜索失败: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"搜索失败: {str(e)}")
 
+NEIGHBOR_MAX_WINDOW = int(os.getenv("NEIGHBOR_MAX_WINDOW", "10"))
+
+class NeighborQuery(BaseModel):
+    userId: int | str
+    ids: List[str]
+    window: Optional[int] = 1
+
+@app.post("/search/neighbors")
+def search_neighbors(query: NeighborQuery):
+    """
+    命中分块的上下文扩展：按id取每个命中分块前后各window个相邻分块，是一次按id的读取，不调用embedding
+    """
+    if query.window is None or query.window < 0 or query.window > NEIGHBOR_MAX_WINDOW:
+        raise HTTPException(status_code=400, detail=f"window 需要在 0~{NEIGHBOR_MAX_WINDOW} 之间")
+    try:
+        logger.info(f"收到相邻分块请求: userId={query.userId} ids={query.ids} window={query.window}")
+        embedder = embedding_utils.EmbeddingModel()
+        chroma = embedding_utils.ChromaDB(embedder)
+        return {"results": chroma.get_neighbors(f"user_{query.userId}", query.ids, window=query.window)}
+    except Exception as e:
+        logger.error(f"获取相邻分块失败: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"获取相邻分块失败: {str(e)}")
+
+@app.get("/residency")
+def residency_stats():
+    """
+    当前进程的collection常驻情况：内存预算、已加载的collection、每个collection的估算内存、加载耗时和访问次数
+    """
+    return embedding_utils.residency.stats()
+
+class PreloadBody(BaseModel):
+    # 不填时按 RESIDENCY_PRELOAD 和访问频率选择
+    collections: Optional[List[str]] = None
+
+@app.post("/residency/preload")
+def residency_preload(body: PreloadBody):
+    """
+    在当前进程中预加载collection，超出内存预算的跳过
+    """
+    logger.info(f"收到预加载请求: {body.collections}")
+    return {"results": embedding_utils.residency.preload(body.collections)}
+
+class FederatedTarget(BaseModel):
+    # 按用户定位collection user_{userId}，也可以直接给collection名
+    userId: Optional[Union[int, str]] = None
+    collection: Optional[str] = None
+    fileId: Optional[Union[int, List[int]]] = None
+    folderId: Optional[Union[int, List[int]]] = None
+    fileType: Optional[Union[str, List[str]]] = None
+
+class FederatedSearchQuery(BaseModel):
+    query: str
+    keyword: Optional[str] = ""
+    topk: Optional[int] = 3
+    targets: List[FederatedTarget]
+    # 整个请求的超时（秒），默认FEDERATED_TIMEOUT_SECONDS，超时未返回的collection放弃其结果
+    timeout: Optional[float] = None
+
+@app.post("/search/federated")
+def federated_search(query: FederatedSearchQuery):
+    """
+    跨多个collection/租户检索：query只embedding一次，并行查询各collection，按归一化后的score合并取topk，
+    慢的collection超时后放弃，不拖慢整体
+    """
+    targets = []
+    for target in query.targets:
+        collection = target.collection or (f"user_{target.userId}" if target.userId is not None else None)
+        if not collection:
+            raise HTTPException(status_code=400, detail="targets 中每项需要 userId 或 collection")
+        targets.append({"collection": collection, "file_id": target.fileId, "folder_id": target.folderId,
+                        "file_type": target.fileType})
+    if not targets:
+        raise HTTPException(status_code=400, detail="targets 不能为空")
+    try:
+        logger.info(f"收到联邦检索请求: query={query.query!r} targets={[t['collection'] for t in targets]}")
+        embedder = embedding_utils.EmbeddingModel()
+        chroma = embedding_utils.ChromaDB(embedder)
+        return chroma.federated_query(targets, query.query, keyword=query.keyword, topk=query.topk, timeout=query.timeout)
+    except Exception as e:
+        logger.error(f"联邦检索失败: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"联邦检索失败: {str(e)}")
+
+@app.get("/search/cache_stats")
+def search_cache_stats():
+    """
+    检索结果缓存的统计信息（当前进程）
+    """
+    return embedding_utils.search_cache.stats()
+
 def process_and_vectorize_local_file(file_name: str, temp_file_path: str, id: int, user_id: int, file_type: str, url: str, folder_id: int):
     """
     从本地文件路径处理文件、进行向量化并存储
     """
     # 步骤2: 使用read_all_files读取文件内容
     logger.info(f"开始读取文件内容: {temp_file_path}")
+    start = time.perf_counter()
     content: List[str] = read_all_files.read_file_content(temp_file_path)
-    if not content or all(not line.strip() for line in content):
-        logger.error(f"文件内容为空或无效: {temp_file_path}")
+    parse_ms = (time.perf_counter() - start) * 1000
+    return process_and_vectorize_content(file_name, content, id, user_id, file_type, url, folder_id, parse_ms=parse_ms)
+
+
+def _memory_usage_mb():
+    """
+    当前进程的常驻内存和历史峰值（MB）
+    """
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    try:
+        with open("/proc/self/statm") as f:
+            rss_mb = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError):
+        rss_mb = peak_mb
+    return round(rss_mb, 1), round(peak_mb, 1)
+
+
+def process_and_vectorize_stream(file_name: str, temp_file_path: Optional[str], id: int, user_id: int, file_type: str, url: str, folder_id: int,
+                                 file_bytes: Optional[bytes] = None):
+    """
+    流式入库：逐行读取解析结果，按窗口embedding并写入chromadb，进度和内存占用可以通过 /vectorize/progress 查询
+    传file_bytes时直接解析内存中的文件内容，否则解析temp_file_path
+    """
+    progress_key = f"{user_id}_{id}"
+    rss_mb, peak_mb = _memory_usage_mb()
+    progress = {"status": "running", "file_name": file_name, "chunks": 0, "windows": 0, "window_size": INGEST_WINDOW_SIZE,
+                "rss_mb": rss_mb, "peak_rss_mb": peak_mb, "start_rss_mb": rss_mb, "started_at": time.time(), "error": ""}
+    _INGEST_PROGRESS[progress_key] = progress
+
+    def _on_window(chunks, windows):
+        rss, peak = _memory_usage_mb()
+        progress.update({"chunks": chunks, "windows": windows, "rss_mb": rss, "peak_rss_mb": peak})
+        logger.info(f"流式入库进度 {progress_key}: {chunks} 个分块, {windows} 个窗口, rss={rss}MB")
+
+    if not os.getenv("ALI_API_KEY"):
+        logger.error("ALI_API_KEY环境变量未设置")
+        progress.update({"status": "failed", "error": "ALI_API_KEY环境变量未设置"})
+        raise ValueError("ALI_API_KEY环境变量未设置")
+    try:
+        # 只解析一次，解析时顺带判断是否带换页符（决定是否记录页码），之后从解析缓存逐行读取
+        if file_bytes is not None:
+            logger.info(f"开始流式解析内存中的文件内容: {file_name}, 大小: {len(file_bytes)}")
+            lines, paged = read_all_files.stream_buffer_lines(file_bytes)
+        else:
+            logger.info(f"开始流式读取文件内容: {temp_file_path}")
+            lines, paged = read_all_files.stream_file_lines(temp_file_path)
+        # 分块规则与非流式相同（content_chunks），每个分块带上在全文中的字符偏移（和页码）
+        documents = read_all_files.content_chunks(lines, paged=paged)
+        embedder = embedding_utils.EmbeddingModel()
+        chroma = embedding_utils.ChromaDB(embedder)
+        summary = chroma.insert_file_vectors_stream(
+            file_name=file_name,
+            user_id=user_id,
+            file_id=id,
+            file_type=file_type or "unknown",
+            url=url or "",
+            folder_id=folder_id or 0,
+            documents=documents,
+            window_size=INGEST_WINDOW_SIZE,
+            on_window=_on_window
+        )
+        if not summary["chunks"]:
+            raise ValueError("文件内容为空或无效")
+    except Exception as e:
+        progress.update({"status": "failed", "error": str(e)})
+        raise
+    progress.update({"status": "done", "finished_at": time.time()})
+
+    return {
+        "id": id,
+        "file_name": file_name,
+        "userId": user_id,
+        "fileType": file_type,
+        "url": url,
+        "folderId": folder_id,
+        "embedding_result": summary
+    }
+
+
+@app.get("/vectorize/progress/{user_id}/{file_id}")
+def vectorize_progress(user_id: int, file_id: int):
+    """
+    查询流式入库的进度和内存占用
+    """
+    progress = _INGEST_PROGRESS.get(f"{user_id}_{file_id}")
+    if progress is None:
+        raise HTTPException(status_code=404, detail="没有该文件的入库进度")
+    return progress
+
+
+@app.get("/vectors/{user_id}/{file_id}")
+def get_file_vectors_endpoint(user_id: int, file_id: int):
+    """
+    显式获取某个文件的全部向量，以二进制npz返回（ids: 字符串数组, embeddings: float32 (n, dim)），
+    入库接口只返回摘要，不再在JSON中回传向量
+    """
+    import numpy as np
+    embedder = embedding_utils.EmbeddingModel()
+    chroma = embedding_utils.ChromaDB(embedder)
+    ids, embeddings = chroma.get_file_vectors(user_id, file_id)
+    if not ids:
+        raise HTTPException(status_code=404, detail=f"用户 {user_id} 没有文件 {file_id} 的向量")
+    buffer = io.BytesIO()
+    np.savez(buffer, ids=np.array(ids), embeddings=embeddings)
+    return Response(content=buffer.getvalue(), media_type="application/octet-stream",
+                    headers={"Content-Disposition": f'attachment; filename="vectors_{user_id}_{file_id}.npz"'})
+
+
+@app.get("/vectors/{user_id}/{file_id}/count")
+def count_file_vectors_endpoint(user_id: int, file_id: int):
+    """
+    某个文件已入库的分块数，chunks为0表示没有入库；调用方据此判断能否跳过重复向量化
+    """
+    embedder = embedding_utils.EmbeddingModel()
+    chroma = embedding_utils.ChromaDB(embedder)
+    return {"userId": user_id, "fileId": file_id, "chunks": chroma.count_file_chunks(user_id, file_id)}
+
+
+@app.delete("/vectors/{user_id}/{file_id}")
+def delete_file_vectors_endpoint(user_id: int, file_id: int):
+    """
+    删除某个文件的全部向量
+    """
+    embedder = embedding_utils.EmbeddingModel()
+    chroma = embedding_utils.ChromaDB(embedder)
+    if chroma.delete_file_vectors(user_id, file_id) != "success":
+        raise HTTPException(status_code=500, detail=f"删除用户 {user_id} 的文件 {file_id} 向量失败")
+    return {"userId": user_id, "fileId": file_id, "deleted": True}
+
+
+def process_and_vectorize_bytes(file_name: str, file_bytes: bytes, id: int, user_id: int, file_type: str, url: str, folder_id: int):
+    """
+    直接解析内存中的文件内容（不落临时文件）、进行向量化并存储
+    """
+    logger.info(f"开始从内存读取文件内容: {file_name}, 大小: {len(file_bytes)}")
+    start = time.perf_counter()
+    content: List[str] = read_all_files.read_buffer_content(file_bytes)
+    parse_ms = (time.perf_counter() - start) * 1000
+    return process_and_vectorize_content(file_name, content, id, user_id, file_type, url, folder_id, parse_ms=parse_ms)
+
+
+def process_and_vectorize_content(file_name: str, content: List[str], id: int, user_id: int, file_type: str, url: str, folder_id: int,
+                                  parse_ms: Optional[float] = None):
+    """
+    对已经解析出来的文件内容进行向量化并存储
+    返回的embedding_result只包含入库摘要（分块数、token用量、各阶段耗时、ids），不回传向量
+    """
+    # 分块规则与流式入库相同：一行作为一个分块，跳过空行
+    chunks = list(read_all_files.content_chunks(content, paged=read_all_files.has_page_breaks(content)))
+    if not chunks:
+        logger.error(f"文件内容为空或无效: {file_name}")
         raise ValueError("文件内容为空或无效")
-    logger.info(f"文件内容读取成功，长度: {len(content)}")
+    logger.info(f"文件内容读取成功，长度: {len(content)}，分块数: {len(chunks)}")
 
     # 步骤3: 检查环境变量
     if not os.getenv("ALI_API_KEY"):
@@ -101,8 +607,11 @@ def process_and_vectorize_local_file(file_name: str, temp_file_path: str, id: in
         file_type=file_type or "unknown",
         url=url or "",
         folder_id=folder_id or 0,
-        documents=content
+        documents=[line for line, _ in chunks],
+        provenance=[provenance for _, provenance in chunks]
     )
+    if parse_ms is not None:
+        embedding_result["timings_ms"]["parse"] = round(parse_ms, 1)
     logger.info("向量插入成功")
 
     result = {
@@ -118,9 +627,18 @@ def process_and_vectorize_local_file(file_name: str, temp_file_path: str, id: in
     return result
 
 
-def process_file_sync(file_name:str, id: int, user_id: int, file_type: str, url: str, folder_id: int):
+def _unique_temp_path(file_name: str) -> str:
+    """
+    临时文件名加uuid前缀，并发处理同名文件时不会互相覆盖
+    """
+    return os.path.join(TEMP_DIR, f"{uuid.uuid4().hex}_{os.path.basename(file_name)}")
+
+
+def process_file_sync(file_name:str, id: int, user_id: int, file_type: str, url: str, folder_id: int, streaming: bool = False):
     """
     处理文件下载、读取和生成embedding的同步版本
+    不超过PARSE_IN_MEMORY_MAX_BYTES的文件在内存中解析，更大的文件写入唯一命名的临时文件；
+    streaming=True或文件超过STREAM_INGEST_MIN_BYTES时使用流式入库（内存中的文件同样可以流式入库）
     """
     if not url:
         logger.error("url为空")
@@ -134,18 +652,36 @@ def process_file_sync(file_name:str, id: int, user_id: int, file_type: str, url:
     parsed_url = urlparse(url)
     logger.info(f"解析后的URL: {parsed_url.geturl()}")
     temp_file_path = None
+    temp_file = None
     try:
-        # 步骤1: 下载文件
+        # 步骤1: 下载文件，先放内存，超过阈值后转存临时文件
         local_file_name = os.path.basename(parsed_url.path) or f"downloaded_file_{user_id}"
-        temp_file_path = os.path.join(TEMP_DIR, local_file_name)
+        file_name = file_name or local_file_name
         logger.info(f"开始下载文件: {url}")
-        response = requests.get(url, timeout=60, proxies=None)
-        response.raise_for_status()
-        with open(temp_file_path, 'wb') as f:
-            f.write(response.content)
-        logger.info(f"文件下载成功: {temp_file_path}")
+        buffer = bytearray()
+        with requests.get(url, timeout=60, proxies=None, stream=True) as response:
+            response.raise_for_status()
+            for piece in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if temp_file is None:
+                    buffer.extend(piece)
+                    if len(buffer) > PARSE_IN_MEMORY_MAX_BYTES:
+                        temp_file_path = _unique_temp_path(local_file_name)
+                        temp_file = open(temp_file_path, 'wb')
+                        temp_file.write(buffer)
+                        buffer = bytearray()
+                else:
+                    temp_file.write(piece)
+        if temp_file is not None:
+            temp_file.close()
+            logger.info(f"文件下载成功，超过内存解析阈值，写入临时文件: {temp_file_path}")
+            if _use_stream_ingest(os.path.getsize(temp_file_path), streaming):
+                return process_and_vectorize_stream(file_name, temp_file_path, id, user_id, file_type, url, folder_id)
+            return process_and_vectorize_local_file(file_name, temp_file_path, id, user_id, file_type, url, folder_id)
 
-        return process_and_vectorize_local_file(file_name, temp_file_path, id, user_id, file_type, url, folder_id)
+        logger.info(f"文件下载成功，大小: {len(buffer)}，在内存中解析")
+        if _use_stream_ingest(len(buffer), streaming):
+            return process_and_vectorize_stream(file_name, None, id, user_id, file_type, url, folder_id, file_bytes=bytes(buffer))
+        return process_and_vectorize_bytes(file_name, bytes(buffer), id, user_id, file_type, url, folder_id)
 
     except requests.exceptions.Timeout as e:
         logger.error(f"下载文件超时: {str(e)}", exc_info=True)
@@ -160,6 +696,8 @@ def process_file_sync(file_name:str, id: int, user_id: int, file_type: str, url:
         logger.error(f"未知错误: {str(e)}", exc_info=True)
         raise ValueError(f"未知错误: {str(e)}")
     finally:
+        if temp_file is not None and not temp_file.closed:
+            temp_file.close()
         if temp_file_path and os.path.exists(temp_file_path):
             os.remove(temp_file_path)
             logger.info(f"临时文件已删除: {temp_file_path}")
@@ -173,9 +711,12 @@ async def upload_and_vectorize_endpoint(
     fileType: Optional[str] = Form(None),
     url: Optional[str] = Form(None),
     file: Optional[UploadFile] = File(None),
+    streaming: bool = Form(False),
 ):
     """
     上传文件或通过URL进行向量化
+    - streaming: 使用流式入库（边解析边embedding边写入），大于STREAM_INGEST_MIN_BYTES的文件自动开启
+    解析和向量化在线程池中执行，不阻塞事件循环，处理期间可以查询 /vectorize/progress
     """
     if not url and not file:
         raise HTTPException(status_code=400, detail="必须提供 'url' 或 'file'")
@@ -187,15 +728,41 @@ async def upload_and_vectorize_endpoint(
         if file:
             if not fileType:
                 fileType = file.filename.split('.')[-1] if '.' in file.filename else 'unknown'
-            
-            temp_file_name = f"{uuid.uuid4()}_{file.filename}"
-            temp_file_path = os.path.join(TEMP_DIR, temp_file_name)
-            
+
+            if file.size is not None and file.size <= PARSE_IN_MEMORY_MAX_BYTES:
+                file_bytes = await file.read()
+                logger.info(f"文件上传成功: {file.filename}, 大小: {len(file_bytes)}，在内存中解析")
+                if _use_stream_ingest(len(file_bytes), streaming):
+                    return await asyncio.to_thread(
+                        process_and_vectorize_stream,
+                        file_name=file.filename,
+                        temp_file_path=None,
+                        id=fileId,
+                        user_id=userId,
+                        file_type=fileType,
+                        url="",  # 直接上传的文件没有URL
+                        folder_id=folderId,
+                        file_bytes=file_bytes
+                    )
+                return await asyncio.to_thread(
+                    process_and_vectorize_bytes,
+                    file_name=file.filename,
+                    file_bytes=file_bytes,
+                    id=fileId,
+                    user_id=userId,
+                    file_type=fileType,
+                    url="",  # 直接上传的文件没有URL
+                    folder_id=folderId
+                )
+
+            temp_file_path = _unique_temp_path(file.filename)
             with open(temp_file_path, "wb") as buffer:
-                buffer.write(await file.read())
+                shutil.copyfileobj(file.file, buffer, DOWNLOAD_CHUNK_SIZE)
             logger.info(f"文件上传成功: {temp_file_path}")
-            
-            return process_and_vectorize_local_file(
+
+            use_stream = _use_stream_ingest(os.path.getsize(temp_file_path), streaming)
+            return await asyncio.to_thread(
+                process_and_vectorize_stream if use_stream else process_and_vectorize_local_file,
                 file_name=file.filename,
                 temp_file_path=temp_file_path,
                 id=fileId,
@@ -205,12 +772,15 @@ async def upload_and_vectorize_endpoint(
                 folder_id=folderId
             )
         elif url:
-            return process_file_sync(
+            return await asyncio.to_thread(
+                process_file_sync,
+                file_name=os.path.basename(urlparse(url).path),
                 id=fileId,
                 user_id=userId,
                 file_type=fileType,
                 url=url,
-                folder_id=folderId
+                folder_id=folderId,
+                streaming=streaming
             )
     except Exception as e:
         logger.error(f"上传和向量化失败: {str(e)}", exc_info=True)
@@ -241,24 +811,32 @@ def _chunk_text(text: str, max_chars: int = 1200, overlap: int = 200) -> List[st
     简单切分：先按段落，再对超长段落做定长切分。
     这样可避免单块文本过长导致的向量化超限。
     """
-    text = (text or "").strip()
-    if not text:
-        return []
+    return [chunk for chunk, _ in _chunk_text_spans(text, max_chars, overlap)]
 
-    # 先按空行分段
-    blocks = [b.strip() for b in text.split("\n\n") if b.strip()]
-    if not blocks:
-        blocks = [text]
 
-    chunks: List[str] = []
-    for b in blocks:
+def _chunk_text_spans(text: str, max_chars: int = 1200, overlap: int = 200) -> List[tuple]:
+    """
+    与_chunk_text的切分相同，同时返回每个分块在原文中的字符偏移
+    Returns:
+        [(chunk, {"char_start", "char_end"}), ...]
+    """
+    text = text or ""
+    chunks: List[tuple] = []
+    # 先按空行分段，记录每段去掉首尾空白后在原文中的位置
+    pos = 0
+    for raw in text.split("\n\n"):
+        b = raw.strip()
+        block_start = pos + len(raw) - len(raw.lstrip())
+        pos += len(raw) + 2
+        if not b:
+            continue
         if len(b) <= max_chars:
-            chunks.append(b)
+            chunks.append((b, {"char_start": block_start, "char_end": block_start + len(b)}))
         else:
             start = 0
             while start < len(b):
                 end = min(start + max_chars, len(b))
-                chunks.append(b[start:end])
+                chunks.append((b[start:end], {"char_start": block_start + start, "char_end": block_start + end}))
                 if end == len(b):
                     break
                 start = max(0, end - overlap)  # 轻微重叠，提升召回
@@ -287,9 +865,10 @@ def process_text_content(
         logger.error("ALI_API_KEY环境变量未设置")
         raise ValueError("ALI_API_KEY环境变量未设置")
 
-    documents = _chunk_text(text)
-    if not documents:
+    spans = _chunk_text_spans(text)
+    if not spans:
         raise ValueError("content 无有效文本")
+    documents = [chunk for chunk, _ in spans]
 
     logger.info("初始化 embedding 模型与 Chroma")
     embedder = embedding_utils.EmbeddingModel()
@@ -303,7 +882,8 @@ def process_text_content(
         file_type=file_type or "unknown",
         url=url or "",
         folder_id=folder_id or 0,
-        documents=documents
+        documents=documents,
+        provenance=[provenance for _, provenance in spans]
     )
 
     result = {
@@ -391,7 +971,9 @@ def process_text_list_content(
         file_type=file_type or "unknown",
         url=url or "",
         folder_id=folder_id or 0,
-        documents=documents
+        documents=documents,
+        # 列表中的文本视为以\n连接的全文，记录各自的字符偏移
+        provenance=[provenance for _, provenance in read_all_files.line_provenance(documents)]
     )
 
     result = {
@@ -407,19 +989,170 @@ def process_text_list_content(
     return result
 
 
+def process_text_list_ndjson(body: TextListVectorizeBody, documents) -> dict:
+    """
+    NDJSON流式上传的文本列表：body是校验过的header（content为空），documents是逐条产出文本的迭代器（数据还在接收中），
+    按窗口embedding并写入，进度可以通过 /vectorize/progress 查询
+    """
+    progress_key = f"{body.userId or 0}_{body.fileId}"
+    progress = {"status": "running", "file_name": body.fileName, "chunks": 0, "windows": 0,
+                "window_size": INGEST_WINDOW_SIZE, "started_at": time.time(), "error": ""}
+    _INGEST_PROGRESS[progress_key] = progress
+
+    def _on_window(chunks, windows):
+        progress.update({"chunks": chunks, "windows": windows})
+
+    try:
+        if not os.getenv("ALI_API_KEY"):
+            logger.error("ALI_API_KEY环境变量未设置")
+            raise ValueError("ALI_API_KEY环境变量未设置")
+        embedder = embedding_utils.EmbeddingModel()
+        chroma = embedding_utils.ChromaDB(embedder)
+        # 与JSON方式相同：列表中的文本视为以\n连接的全文，记录各自的字符偏移
+        summary = chroma.insert_file_vectors_stream(
+            file_name=body.fileName,
+            user_id=body.userId or 0,
+            file_id=body.fileId,
+            file_type=body.fileType or "unknown",
+            url=body.url or "",
+            folder_id=body.folderId or 0,
+            documents=read_all_files.line_provenance(documents),
+            window_size=INGEST_WINDOW_SIZE,
+            on_window=_on_window
+        )
+        if not summary["chunks"]:
+            raise ValueError("content 列表不能为空")
+    except Exception as e:
+        progress.update({"status": "failed", "error": str(e)})
+        raise
+    progress.update({"status": "done", "finished_at": time.time()})
+    return {
+        "id": body.fileId,
+        "file_name": body.fileName,
+        "userId": body.userId or 0,
+        "fileType": body.fileType or "unknown",
+        "url": body.url or "",
+        "folderId": body.folderId or 0,
+        "embedding_result": summary
+    }
+
+
+async def _vectorize_text_list_ndjson(request: Request) -> dict:
+    """
+    读取NDJSON请求体：第一行 {"type": "header", "fileId", "fileName", ...}，之后每行 {"text": "..."}。
+    接收和embedding同时进行：解析出的文本放进有界队列，由线程池中的流式入库消费，内存只保留几个窗口；
+    上传中途出错时通知消费线程失败，不会把半份文档当成完整结果。
+    header校验失败返回422（与JSON方式相同），某一行不是合法JSON或缺少text返回400
+    """
+    docs: queue.Queue = queue.Queue(maxsize=INGEST_WINDOW_SIZE * 4)
+    done = object()
+    aborted = object()
+    header = None
+    worker: Optional[asyncio.Future] = None
+
+    def _documents():
+        while True:
+            item = docs.get()
+            if item is done:
+                return
+            if item is aborted:
+                raise ValueError("NDJSON上传中断")
+            yield item
+
+    async def _put(item):
+        # 队列满说明embedding跟不上：在线程池中阻塞等待消费（不轮询），每NDJSON_PUT_TIMEOUT_SECONDS检查一次
+        # 消费线程是否已经结束（失败），结束了就不再等
+        try:
+            docs.put_nowait(item)
+            return
+        except queue.Full:
+            pass
+        loop = asyncio.get_running_loop()
+        while not worker.done():
+            try:
+                await loop.run_in_executor(None, lambda: docs.put(item, timeout=NDJSON_PUT_TIMEOUT_SECONDS))
+                return
+            except queue.Full:
+                continue
+
+    line_no = 0
+
+    async def _handle(line: bytes):
+        nonlocal header, worker, line_no
+        line_no += 1
+        if not line.strip():
+            return
+        try:
+            row = json.loads(line)
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            raise HTTPException(status_code=400, detail=f"NDJSON第{line_no}行不是合法的JSON: {str(e)}")
+        if header is None:
+            if not isinstance(row, dict) or row.get("type") != "header":
+                raise HTTPException(status_code=400, detail="NDJSON第一行必须是header")
+            try:
+                header = TextListVectorizeBody(**{**row, "content": []})
+            except ValidationError as e:
+                raise HTTPException(status_code=422, detail=str(e))
+            worker = asyncio.get_running_loop().run_in_executor(None, process_text_list_ndjson, header, _documents())
+            return
+        try:
+            text = row["text"] if isinstance(row, dict) else str(row)
+        except KeyError:
+            raise HTTPException(status_code=400, detail=f"NDJSON第{line_no}行缺少text")
+        if not isinstance(text, str):
+            raise HTTPException(status_code=400, detail=f"NDJSON第{line_no}行的text必须是字符串")
+        await _put(text)
+
+    buffer = b""
+    try:
+        async for piece in request.stream():
+            buffer += piece
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                await _handle(line)
+            if worker is not None and worker.done():
+                break
+        await _handle(buffer)
+        if worker is None:
+            raise HTTPException(status_code=400, detail="NDJSON请求体为空")
+    except BaseException:
+        if worker is not None:
+            await _put(aborted)
+            await asyncio.gather(worker, return_exceptions=True)
+        raise
+    await _put(done)
+    return await worker
+
+
 # ===== 纯文本列表向量化接口 =====
 @app.post("/vectorize/text_list")
-def vectorize_text_list_endpoint(body: TextListVectorizeBody):
+async def vectorize_text_list_endpoint(request: Request):
     """
     纯文本列表向量化：
     - 必填：content (List[str]), fileId, fileName
     - 可选：userId(默认0), fileType(None), url(""), folderId(0)
+    Content-Type为application/x-ndjson时按NDJSON流式上传处理（见 _vectorize_text_list_ndjson），边接收边embedding
     """
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("application/x-ndjson"):
+        try:
+            logger.info("收到NDJSON流式文本列表向量化请求")
+            return await _vectorize_text_list_ndjson(request)
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.error(f"NDJSON文本列表向量化失败: {str(e)}", exc_info=True)
+            raise HTTPException(status_code=500, detail=f"文本列表向量化失败: {str(e)}")
+    try:
+        body = TextListVectorizeBody(**await request.json())
+    except (ValidationError, ValueError) as e:
+        raise HTTPException(status_code=422, detail=str(e))
     try:
         logger.info(
             f"收到文本列表向量化请求: fileId={body.fileId}, fileName={body.fileName}, userId={body.userId}"
         )
-        return process_text_list_content(
+        return await asyncio.to_thread(
+            process_text_list_content,
             file_name=body.fileName,
             documents=body.content,
             id=body.fileId,
@@ -433,9 +1166,195 @@ def vectorize_text_list_endpoint(body: TextListVectorizeBody):
         raise HTTPException(status_code=500, detail=f"文本列表向量化失败: {str(e)}")
 
 
+# ===== collection 导出/导入（租户迁移、新节点预热） =====
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "500"))
+
+
+@app.get("/collections/{collection}/export")
+def export_collection_endpoint(collection: str, page_size: int = 1000, offset: int = 0, limit: Optional[int] = None):
+    """
+    以NDJSON流式导出collection（含原始向量），分页读取，内存占用与collection大小无关
+    - offset/limit: 只导出一段，用于断点续传
+    """
+    # 导出只读取已有向量，不需要embedding模型（也就不需要ALI_API_KEY）
+    chroma = embedding_utils.ChromaDB(None)
+    records = chroma.export_collection(collection, page_size=page_size, offset=offset, limit=limit)
+    try:
+        first = next(records)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    def _ndjson():
+        yield json.dumps(first, ensure_ascii=False) + "\n"
+        for record in records:
+            yield json.dumps(record, ensure_ascii=False) + "\n"
+
+    logger.info(f"开始导出collection: {collection}, offset={offset}, limit={limit}")
+    return StreamingResponse(_ndjson(), media_type="application/x-ndjson")
+
+
+@app.post("/collections/{collection}/import")
+async def import_collection_endpoint(collection: str, request: Request):
+    """
+    导入export接口产出的NDJSON（请求体流式读取），按批upsert，直接使用导出的向量，不重新embedding。
+    collection可以和导出时的名字不同；collection不存在时按header中的metadata创建。
+    """
+    # 直接使用导出的向量，不需要embedding模型
+    chroma = embedding_utils.ChromaDB(None)
+    collection_metadata = None
+    batch: List[dict] = []
+    imported = 0
+    buffer = b""
+
+    async def _flush():
+        nonlocal batch, imported
+        if batch:
+            imported += await asyncio.to_thread(chroma.import_records, collection, batch, collection_metadata)
+            batch = []
+
+    try:
+        async for piece in request.stream():
+            buffer += piece
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if not line.strip():
+                    continue
+                row = json.loads(line)
+                if row.get("type") == "header":
+                    collection_metadata = row.get("metadata")
+                    continue
+                batch.append(row)
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    await _flush()
+        if buffer.strip():
+            row = json.loads(buffer)
+            if row.get("type") != "header":
+                batch.append(row)
+        await _flush()
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"导入collection {collection} 失败，已导入 {imported} 条: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"导入失败，已导入 {imported} 条: {str(e)}")
+    logger.info(f"导入collection {collection} 完成，共 {imported} 条")
+    return {"collection": collection, "imported": imported}
+
+
+# ===== HNSW索引档位 =====
+class IndexProfileBody(BaseModel):
+    profile: Optional[str] = None
+    # 单独覆盖档位中的参数: M / construction_ef / search_ef / batch_size / sync_threshold
+    params: Optional[Dict[str, int]] = None
+    # 参数没变也强制重建
+    rebuild: Optional[bool] = False
+
+
+@app.get("/index/profiles")
+def list_index_profiles():
+    """
+    可用的HNSW档位及参数
+    """
+    return {"default_profile": embedding_utils.HNSW_DEFAULT_PROFILE, "profiles": embedding_utils.HNSW_PROFILES}
+
+
+@app.get("/collections/{collection}/index")
+def get_collection_index(collection: str):
+    """
+    collection当前的HNSW档位和参数
+    """
+    # 只读collection的metadata和配置（经get_chroma_client），不需要embedding模型（也就不需要ALI_API_KEY）
+    chroma = embedding_utils.ChromaDB(None)
+    try:
+        return chroma.get_index_config(collection)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+@app.put("/collections/{collection}/index")
+def set_collection_index(collection: str, body: IndexProfileBody):
+    """
+    设置collection的HNSW档位：不存在时按档位创建，只改search_ef时原地生效，其它参数变化时用已有向量重建索引（不重新embedding）
+    """
+    logger.info(f"设置collection {collection} 索引档位: {body}")
+    embedder = embedding_utils.EmbeddingModel()
+    chroma = embedding_utils.ChromaDB(embedder)
+    try:
+        return chroma.set_index_profile(collection, profile=body.profile, params=body.params, rebuild=bool(body.rebuild))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"设置collection {collection} 索引档位失败: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"设置索引档位失败: {str(e)}")
+
+
+# ===== 更换embedding模型后的在线迁移 =====
+class MigrationBody(BaseModel):
+    model: str
+    dimensions: int
+    batchSize: Optional[int] = None
+    # 限速，不填用 MIGRATION_MAX_CHUNKS_PER_MINUTE / MIGRATION_MAX_TOKENS_PER_MINUTE，0表示不限
+    maxChunksPerMinute: Optional[int] = None
+    maxTokensPerMinute: Optional[int] = None
+    # 切换完成后删除旧collection，默认保留用于回滚
+    dropSource: Optional[bool] = False
+
+
+@app.post("/collections/{collection}/migrate")
+def start_collection_migration(collection: str, body: MigrationBody):
+    """
+    后台把collection重新embedding到新模型/维度的影子collection，迁移期间检索仍读旧collection，完成后原子切换；
+    有暂停或失败的同目标任务时从游标继续
+    """
+    logger.info(f"收到迁移请求: {collection} -> {body}")
+    try:
+        return migrate_embeddings.start_migration(
+            collection, body.model, body.dimensions, batch_size=body.batchSize,
+            max_chunks_per_minute=body.maxChunksPerMinute, max_tokens_per_minute=body.maxTokensPerMinute,
+            drop_source=bool(body.dropSource))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/collections/{collection}/migrate")
+def get_collection_migration(collection: str):
+    """
+    迁移进度：游标、已迁移条数、token用量、状态
+    """
+    state = migrate_embeddings.migration_status(collection)
+    if state is None:
+        raise HTTPException(status_code=404, detail=f"collection {collection} 没有迁移任务")
+    return state
+
+
+@app.post("/collections/{collection}/migrate/pause")
+def pause_collection_migration(collection: str):
+    """
+    暂停迁移，之后再次POST /collections/{collection}/migrate 从游标继续
+    """
+    try:
+        return migrate_embeddings.pause_migration(collection)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+_WARMUP_STATE["import_times_ms"]["import_main"] = round((time.perf_counter() - _MODULE_IMPORT_START) * 1000, 1)
+
 if __name__ == "__main__":
     """
     主函数入口：启动FastAPI服务
+    单进程: python main.py
+    多worker: KNOWLEDGE_ROLE=writer python main.py --port 9901
+             KNOWLEDGE_ROLE=reader KNOWLEDGE_WRITER_URL=http://127.0.0.1:9901 python main.py --port 9900 --workers 4
     """
-    print("启动FastAPI服务...")
-    uvicorn.run(app, host="127.0.0.1", port=9900)
\ No newline at end of file
+    arg_parser = argparse.ArgumentParser(description="知识库服务")
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=9900)
+    arg_parser.add_argument("--workers", type=int, default=1, help="uvicorn worker数，>1时只能使用reader角色")
+    args = arg_parser.parse_args()
+    if args.workers > 1 and embedding_utils.KNOWLEDGE_ROLE != "reader":
+        raise SystemExit("多个worker同时写chromadb不安全，--workers>1时请设置KNOWLEDGE_ROLE=reader")
+    print(f"启动FastAPI服务... role={embedding_utils.KNOWLEDGE_ROLE}, workers={args.workers}")
+    if args.workers > 1:
+        uvicorn.run("main:app", host=args.host, port=args.port, workers=args.workers)
+    else:
+        uvicorn.run(app, host=args.host, port=args.port)
\ No newline at end of file
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Date  : 2025/9/28
+# @File  : migrate_embeddings.py
+# @Desc  : 更换embedding模型/维度后的在线迁移：后台把collection中已存的文本按限速重新embedding到影子collection，
+#          迁移期间检索仍读旧collection，完成后校验增量并原子切换别名；进度持久化，进程崩溃重启后从游标继续
+
+import os
+import re
+import json
+import time
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+import embedding_utils
+
+logger = logging.getLogger(__name__)
+
+# 迁移状态文件目录，每个collection一个json
+MIGRATION_DIR = os.getenv("MIGRATION_DIR", "cache/migrations")
+# 每批重新embedding的分块数
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", "64"))
+# 限速：每分钟最多embedding的分块数/token数，0表示不限
+MIGRATION_MAX_CHUNKS_PER_MINUTE = int(os.getenv("MIGRATION_MAX_CHUNKS_PER_MINUTE", "600"))
+MIGRATION_MAX_TOKENS_PER_MINUTE = int(os.getenv("MIGRATION_MAX_TOKENS_PER_MINUTE", "0"))
+
+_JOBS: Dict[str, "EmbeddingMigration"] = {}
+_JOBS_LOCK = threading.Lock()
+
+
+def _state_path(collection: str) -> str:
+    return os.path.join(MIGRATION_DIR, f"{collection}.json")
+
+
+def load_state(collection: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(_state_path(collection), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def shadow_name(collection: str, model: str, dimensions: int) -> str:
+    """
+    影子collection名，只能包含chromadb允许的字符
+    """
+    return re.sub(r"[^a-zA-Z0-9._-]", "-", f"{collection}__{model}_{dimensions}")[:512]
+
+
+class EmbeddingMigration(object):
+    """
+    一个collection的重新embedding任务
+    状态: running / paused / done / failed，游标cursor是源collection中已处理的条数
+    """
+    def __init__(self, state: Dict[str, Any], db_dir: str = "cache/chromadb"):
+        self.state = state
+        self.db_dir = db_dir
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def create(cls, collection: str, model: str, dimensions: int, db_dir: str = "cache/chromadb",
+               batch_size: Optional[int] = None, max_chunks_per_minute: Optional[int] = None,
+               max_tokens_per_minute: Optional[int] = None, drop_source: bool = False):
+        source = embedding_utils.resolve_collection(db_dir, collection)
+        client = embedding_utils.get_chroma_client(db_dir)
+        try:
+            source_col = client.get_collection(source)
+        except Exception:
+            raise ValueError(f"collection {collection} 不存在")
+        if embedding_utils.collection_embedding_identity(source_col.metadata) == (model, int(dimensions)):
+            raise ValueError(f"collection {collection} 已经使用 {model}/{dimensions}，无需迁移")
+        state = {
+            "collection": collection,
+            "source": source,
+            "shadow": shadow_name(collection, model, dimensions),
+            "model": model,
+            "dimensions": int(dimensions),
+            "batch_size": batch_size or MIGRATION_BATCH_SIZE,
+            "max_chunks_per_minute": MIGRATION_MAX_CHUNKS_PER_MINUTE if max_chunks_per_minute is None else max_chunks_per_minute,
+            "max_tokens_per_minute": MIGRATION_MAX_TOKENS_PER_MINUTE if max_tokens_per_minute is None else max_tokens_per_minute,
+            "drop_source": drop_source,
+            "status": "running",
+            "cursor": 0,
+            "migrated": 0,
+            "skipped": 0,
+            "reconciled": 0,
+            "total": source_col.count(),
+            "total_tokens": 0,
+            "started_at": time.time(),
+            "updated_at": time.time(),
+            "finished_at": None,
+            "error": "",
+        }
+        if state["shadow"] == source:
+            raise ValueError(f"影子collection与当前collection同名: {source}")
+        return cls(state, db_dir)
+
+    def save(self):
+        """
+        状态先写临时文件再原子替换，崩溃时不会留下半截文件
+        """
+        os.makedirs(MIGRATION_DIR, exist_ok=True)
+        self.state["updated_at"] = time.time()
+        path = _state_path(self.state["collection"])
+        tmp_file = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, ensure_ascii=False)
+        os.replace(tmp_file, path)
+
+    def start(self):
+        self.state["status"] = "running"
+        self.state["error"] = ""
+        self.save()
+        self._thread = threading.Thread(target=self.run, name=f"migrate-{self.state['collection']}", daemon=True)
+        self._thread.start()
+
+    def pause(self):
+        self._stop.set()
+
+    def is_alive(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def _throttle(self, run_start: float, chunks: int, tokens: int):
+        """
+        按本次运行开始以来的用量计算需要等待的时间，让分块数和token数都不超过每分钟预算
+        """
+        elapsed = time.perf_counter() - run_start
+        waits = [0.0]
+        if self.state["max_chunks_per_minute"]:
+            waits.append(chunks / self.state["max_chunks_per_minute"] * 60 - elapsed)
+        if self.state["max_tokens_per_minute"]:
+            waits.append(tokens / self.state["max_tokens_per_minute"] * 60 - elapsed)
+        self._stop.wait(max(waits))
+
+    def _embed_into(self, shadow, embedder, ids: List[str], documents: List[Optional[str]], metadatas: List[Any]) -> int:
+        """
+        重新embedding一批文本并upsert到影子collection（可重复执行），返回token用量；没有原文的记录无法迁移，跳过
+        """
+        keep = [i for i, doc in enumerate(documents) if doc]
+        self.state["skipped"] += len(ids) - len(keep)
+        if not keep:
+            return 0
+        texts = [documents[i] for i in keep]
+        vectors_result = embedder.do_embedding(texts=texts)
+        embeddings = embedding_utils.embeddings_array(vectors_result)
+        if len(embeddings) != len(texts):
+            raise ValueError(f"embedding数量不一致: {len(embeddings)} != {len(texts)}")
+        kept_metadatas = [metadatas[i] for i in keep]
+        shadow.upsert(
+            ids=[ids[i] for i in keep],
+            embeddings=embeddings,
+            documents=texts,
+            metadatas=kept_metadatas if all(kept_metadatas) else None,
+        )
+        return vectors_result.get("usage", {}).get("total_tokens", 0)
+
+    def _reconcile(self, source, shadow, embedder) -> int:
+        """
+        对比源和影子collection：迁移期间新增或被重新写入（原文/元数据变化）的记录重新embedding，源中已删除的记录从影子中删除
+        """
+        changed = 0
+        source_ids = set()
+        batch_size = max(self.state["batch_size"], 500)
+        offset = 0
+        while True:
+            page = source.get(limit=batch_size, offset=offset, include=["documents", "metadatas"])
+            if not page["ids"]:
+                break
+            offset += len(page["ids"])
+            source_ids.update(page["ids"])
+            existing = shadow.get(ids=page["ids"], include=["documents", "metadatas"])
+            existing_map = {i: (d, m) for i, d, m in zip(existing["ids"], existing["documents"], existing["metadatas"])}
+            stale = [k for k, doc_id in enumerate(page["ids"])
+                     if existing_map.get(doc_id) != (page["documents"][k], page["metadatas"][k])]
+            for begin in range(0, len(stale), self.state["batch_size"]):
+                part = stale[begin:begin + self.state["batch_size"]]
+                self.state["total_tokens"] += self._embed_into(
+                    shadow, embedder, [page["ids"][k] for k in part], [page["documents"][k] for k in part],
+                    [page["metadatas"][k] for k in part])
+                changed += len(part)
+        offset = 0
+        extra = []
+        while True:
+            page = shadow.get(limit=batch_size, offset=offset, include=[])
+            if not page["ids"]:
+                break
+            offset += len(page["ids"])
+            extra += [doc_id for doc_id in page["ids"] if doc_id not in source_ids]
+        for begin in range(0, len(extra), batch_size):
+            shadow.delete(ids=extra[begin:begin + batch_size])
+        return changed + len(extra)
+
+    def run(self):
+        collection = self.state["collection"]
+        try:
+            client = embedding_utils.get_chroma_client(self.db_dir)
+            source = client.get_collection(self.state["source"])
+            embedder = embedding_utils.get_embedder(self.state["model"], self.state["dimensions"])
+            # 影子collection沿用源collection的hnsw参数，记录新的embedding模型和维度
+            shadow_metadata = dict(source.metadata or {}, embedding_model=self.state["model"],
+                                   embedding_dimensions=self.state["dimensions"])
+            shadow = client.get_or_create_collection(self.state["shadow"], metadata=shadow_metadata)
+            logger.info(f"开始迁移 {collection}: {self.state['source']} -> {self.state['shadow']}，游标 {self.state['cursor']}")
+            run_start = time.perf_counter()
+            run_chunks = 0
+            run_tokens = 0
+            while not self._stop.is_set():
+                page = source.get(limit=self.state["batch_size"], offset=self.state["cursor"],
+                                  include=["documents", "metadatas"])
+                if not page["ids"]:
+                    break
+                tokens = self._embed_into(shadow, embedder, page["ids"], page["documents"], page["metadatas"])
+                self.state["cursor"] += len(page["ids"])
+                self.state["migrated"] += len(page["ids"])
+                self.state["total_tokens"] += tokens
+                self.state["total"] = max(self.state["total"], source.count())
+                self.save()
+                run_chunks += len(page["ids"])
+                run_tokens += tokens
+                self._throttle(run_start, run_chunks, run_tokens)
+            if self._stop.is_set():
+                self.state["status"] = "paused"
+                self.save()
+                logger.info(f"迁移 {collection} 已暂停，游标 {self.state['cursor']}")
+                return
+
+            # 先不挡写入做一遍校验，再在切换锁内做最后一遍（期间没有新写入时跳过），尽量缩短挡写入的时间
+            version = embedding_utils.get_collection_version(self.db_dir, collection)
+            self.state["reconciled"] += self._reconcile(source, shadow, embedder)
+            self.save()
+            with embedding_utils.collection_swap(self.db_dir, collection):
+                if embedding_utils.get_collection_version(self.db_dir, collection) != version:
+                    self.state["reconciled"] += self._reconcile(source, shadow, embedder)
+                embedding_utils.set_alias(self.db_dir, collection, self.state["shadow"])
+                embedding_utils.bump_collection_version(self.db_dir, collection)
+                embedding_utils.bump_write_version(self.db_dir)
+            if self.state["drop_source"]:
+                client.delete_collection(self.state["source"])
+            self.state["status"] = "done"
+            self.state["finished_at"] = time.time()
+            self.save()
+            logger.info(f"迁移 {collection} 完成，已切换到 {self.state['shadow']}: {self.state}")
+        except Exception as e:
+            logger.error(f"迁移 {collection} 失败，游标 {self.state['cursor']}: {str(e)}", exc_info=True)
+            self.state["status"] = "failed"
+            self.state["error"] = str(e)
+            self.save()
+
+
+def start_migration(collection: str, model: str, dimensions: int, db_dir: str = "cache/chromadb", **options) -> Dict[str, Any]:
+    """
+    启动迁移；该collection有未完成（暂停/失败）的同目标任务时从游标继续
+    """
+    with _JOBS_LOCK:
+        job = _JOBS.get(collection)
+        if job is not None and job.is_alive():
+            raise ValueError(f"collection {collection} 正在迁移中")
+        state = load_state(collection)
+        if (state and state["status"] in ("running", "paused", "failed")
+                and (state["model"], state["dimensions"]) == (model, int(dimensions))):
+            job = EmbeddingMigration(state, db_dir)
+        else:
+            job = EmbeddingMigration.create(collection, model, dimensions, db_dir, **options)
+        _JOBS[collection] = job
+        job.start()
+        return job.state
+
+
+def pause_migration(collection: str) -> Dict[str, Any]:
+    with _JOBS_LOCK:
+        job = _JOBS.get(collection)
+    if job is None or not job.is_alive():
+        raise ValueError(f"collection {collection} 没有正在运行的迁移")
+    job.pause()
+    return job.state
+
+
+def migration_status(collection: str) -> Optional[Dict[str, Any]]:
+    """
+    从状态文件读取进度，reader进程也可以查询
+    """
+    state = load_state(collection)
+    if state is None:
+        return None
+    total = max(state.get("total") or 0, 1)
+    return dict(state, progress=round(min(state["cursor"], total) / total, 4))
+
+
+def resume_migrations(db_dir: str = "cache/chromadb") -> List[str]:
+    """
+    进程启动时继续状态为running的迁移（上次进程崩溃或重启时中断的）
+    """
+    resumed = []
+    if not os.path.isdir(MIGRATION_DIR):
+        return resumed
+    for name in os.listdir(MIGRATION_DIR):
+        if not name.endswith(".json"):
+            continue
+        state = load_state(name[:-len(".json")])
+        if state and state.get("status") == "running":
+            with _JOBS_LOCK:
+                job = EmbeddingMigration(state, db_dir)
+                _JOBS[state["collection"]] = job
+                job.start()
+            resumed.append(state["collection"])
+    if resumed:
+        logger.info(f"继续未完成的迁移: {resumed}")
+    return resumed
@@ -12,22 +12,283 @@ import hashlib
 import os
 import pickle
 import asyncio
+import gzip
+import threading
+import time
 from functools import wraps
-import tika
-from tika import parser as tikaParser
 tika_server = r"./bin/tika-server.jar"
-assert os.path.exists(tika_server), "tika-server.jar not found"
 TIKA_SERVER_JAR = f"file:///{tika_server}"
 os.environ['TIKA_SERVER_JAR'] = TIKA_SERVER_JAR
+_TIKA_LOCK = threading.Lock()
+_tika_parser = None
+
+
+def init_tika():
+    """
+    第一次解析文件时才导入tika并启动JVM，服务启动时不强制要求tika-server.jar存在
+    Returns:
+        tika.parser模块
+    """
+    global _tika_parser
+    if _tika_parser is None:
+        with _TIKA_LOCK:
+            if _tika_parser is None:
+                tika_jar_path = TIKA_SERVER_JAR.replace('file:///', '')
+                assert os.path.exists(tika_jar_path), "tika jar包不存在"
+                import tika
+                from tika import parser as tikaParser
+                tika.initVM()
+                _tika_parser = tikaParser
+    return _tika_parser
+
+# 解析结果缓存：key为文件内容的sha256+解析器版本，gzip压缩后存本地磁盘
+PARSE_CACHE_DIR = os.getenv("PARSE_CACHE_DIR", os.path.join("cache", "parse_cache"))
+PARSE_CACHE_MAX_BYTES = int(os.getenv("PARSE_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+# 解析逻辑本身的版本，修改了解析/切分方式时加1，让旧缓存失效
+PARSE_LOGIC_VERSION = "1"
+
+
+def _parser_version():
+    """
+    解析器版本：tika-server.jar的md5 + 解析逻辑版本，更换jar后旧缓存自动失效
+    """
+    md5_file = "tika-server.jar.md5"
+    jar_md5 = ""
+    if os.path.exists(md5_file):
+        with open(md5_file, "r") as f:
+            jar_md5 = f.read().strip()
+    elif os.path.exists(tika_server):
+        stat = os.stat(tika_server)
+        jar_md5 = f"{stat.st_size}-{int(stat.st_mtime)}"
+    return f"{jar_md5[:12] or 'tika'}-{PARSE_LOGIC_VERSION}"
+
+
+PARSER_VERSION = _parser_version()
+
+
+class ParseCache(object):
+    """
+    文件解析结果的磁盘缓存，超过容量上限时按最近访问时间（mtime）淘汰最旧的文件
+    """
+    def __init__(self, cache_dir, max_bytes, parser_version):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.parser_version = parser_version
+        self._lock = threading.Lock()
+
+    def _path(self, sha256):
+        return os.path.join(self.cache_dir, f"{sha256}_{self.parser_version}.txt.gz")
+
+    def get(self, sha256):
+        path = self._path(sha256)
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                text = f.read()
+        except (FileNotFoundError, OSError, EOFError):
+            return None
+        # 更新mtime，作为LRU的访问时间
+        now = time.time()
+        try:
+            os.utime(path, (now, now))
+        except OSError:
+            pass
+        return text
+
+    def iter_lines(self, sha256):
+        """
+        逐行读取缓存的解析结果，不把全文读入内存；缓存不存在时抛FileNotFoundError
+        """
+        path = self._path(sha256)
+        f = gzip.open(path, "rt", encoding="utf-8")
+        now = time.time()
+        try:
+            os.utime(path, (now, now))
+        except OSError:
+            pass
+
+        def _lines():
+            with f:
+                for line in f:
+                    yield line.rstrip("\n")
+        return _lines()
+
+    def has_page_breaks(self, sha256, chunk_size=1024 * 1024):
+        """
+        缓存的解析结果中是否带换页符\f，直接扫描解压后的字节，不按行切分；缓存不存在时抛FileNotFoundError
+        """
+        with gzip.open(self._path(sha256), "rb") as f:
+            for piece in iter(lambda: f.read(chunk_size), b""):
+                if b"\f" in piece:
+                    return True
+        return False
+
+    def put(self, sha256, text):
+        if self.max_bytes <= 0:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(sha256)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            total = 0
+            if not os.path.isdir(self.cache_dir):
+                return
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith(".txt.gz"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+                total += stat.st_size
+            entries.sort()
+            for _, size, name in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                    total -= size
+                except FileNotFoundError:
+                    pass
+
+
+parse_cache = ParseCache(PARSE_CACHE_DIR, PARSE_CACHE_MAX_BYTES, PARSER_VERSION)
+
+
+def _sha256_file(file_path, chunk_size=1024 * 1024):
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for piece in iter(lambda: f.read(chunk_size), b""):
+            sha.update(piece)
+    return sha.hexdigest()
+
+
+def _parsed_text(parsed):
+    return parsed.get("content") or ""
+
+def _cache_parsed(sha256, parsed, content_text):
+    """
+    解析成功且有内容时才写入解析缓存，Tika解析失败或结果为空时不缓存，下次重新解析
+    """
+    if parsed.get("status", 200) != 200 or not content_text.strip():
+        print(f"解析失败或结果为空，不写入解析缓存, sha256: {sha256}, status: {parsed.get('status')}")
+        return
+    parse_cache.put(sha256, content_text)
+
 def read_file_content(file_path):
     assert os.path.exists(file_path), f"给定文件不存在: {file_path}"
-    tika_jar_path = TIKA_SERVER_JAR.replace('file:///', '')
-    assert os.path.exists(tika_jar_path), "tika jar包不存在"
-    tika.initVM()
-    parsed = tikaParser.from_file(file_path)
-    content_text = parsed["content"]
-    content = content_text.split("\n")
-    return content
+    sha256 = _sha256_file(file_path)
+    cached = parse_cache.get(sha256)
+    if cached is not None:
+        print(f"解析缓存命中: {file_path}, sha256: {sha256}")
+        return cached.split("\n")
+    parsed = init_tika().from_file(file_path)
+    content_text = _parsed_text(parsed)
+    _cache_parsed(sha256, parsed, content_text)
+    return content_text.split("\n")
+
+def read_buffer_content(data: bytes):
+    """
+    直接解析内存中的文件内容，不落临时文件
+    """
+    sha256 = hashlib.sha256(data).hexdigest()
+    cached = parse_cache.get(sha256)
+    if cached is not None:
+        print(f"解析缓存命中, sha256: {sha256}")
+        return cached.split("\n")
+    parsed = init_tika().from_buffer(data)
+    content_text = _parsed_text(parsed)
+    _cache_parsed(sha256, parsed, content_text)
+    return content_text.split("\n")
+
+def _iter_text_lines(text):
+    """
+    逐行产出text，不生成split后的整个列表
+    """
+    start = 0
+    while True:
+        end = text.find("\n", start)
+        if end == -1:
+            yield text[start:]
+            return
+        yield text[start:end]
+        start = end + 1
+
+def _stream_parsed_lines(sha256, parse):
+    """
+    流式入库用：解析一次，返回 (逐行的生成器, 是否带换页符)。
+    缓存命中时直接从gzip缓存逐行读取，换页符在缓存的原始字节上扫描，不重新解析；
+    未命中时Tika一次返回全文，在全文上判断换页符，写入解析缓存后从缓存逐行读取，全文字符串随即释放
+    """
+    try:
+        paged = parse_cache.has_page_breaks(sha256)
+        lines = parse_cache.iter_lines(sha256)
+        print(f"解析缓存命中, sha256: {sha256}")
+        return lines, paged
+    except (FileNotFoundError, OSError, EOFError):
+        pass
+    parsed = parse()
+    content_text = _parsed_text(parsed)
+    _cache_parsed(sha256, parsed, content_text)
+    del parsed
+    paged = "\f" in content_text
+    try:
+        return parse_cache.iter_lines(sha256), paged
+    except (FileNotFoundError, OSError):
+        # 缓存关闭、解析失败未缓存或刚写入就被淘汰，直接从内存逐行产出
+        return _iter_text_lines(content_text), paged
+
+def stream_file_lines(file_path):
+    """
+    流式读取文件的解析结果，用于超大文档的流式入库，返回 (逐行的生成器, 是否带换页符)
+    """
+    assert os.path.exists(file_path), f"给定文件不存在: {file_path}"
+    return _stream_parsed_lines(_sha256_file(file_path), lambda: init_tika().from_file(file_path))
+
+def stream_buffer_lines(data: bytes):
+    """
+    流式读取内存中文件的解析结果，返回 (逐行的生成器, 是否带换页符)
+    """
+    return _stream_parsed_lines(hashlib.sha256(data).hexdigest(), lambda: init_tika().from_buffer(data))
+
+def has_page_breaks(lines):
+    """
+    解析结果中是否带换页符\f（带换页符时才能给分块记录页码）
+    """
+    return any("\f" in line for line in lines)
+
+def line_provenance(lines, paged=False):
+    """
+    按行切分的文本，计算每行在全文（行之间以\n连接）中的字符偏移；paged=True时按换页符\f记录页码（从1开始）
+    逐行产出 (line, {"char_start", "char_end"[, "page"]})
+    """
+    offset = 0
+    page = 1
+    for line in lines:
+        provenance = {"char_start": offset, "char_end": offset + len(line)}
+        if paged:
+            # 行首的换页符属于新的一页，行中间/末尾的换页符从下一行开始算
+            leading = len(line) - len(line.lstrip("\f"))
+            page += leading
+            provenance["page"] = page
+            page += line.count("\f") - leading
+        offset += len(line) + 1
+        yield line, provenance
+
+def content_chunks(lines, paged=False):
+    """
+    流式和非流式入库共用的分块规则：一行作为一个分块，跳过空行（只含空白字符的行）；
+    字符偏移和页码按全文计算，跳过的空行也计入偏移
+    逐个产出 (分块文本, 出处dict)
+    """
+    return ((line, provenance) for line, provenance in line_provenance(lines, paged=paged) if line.strip())
 
 if __name__ == '__main__':
     content = read_file_content("/Users/admin/Downloads/多Agent进行PPT生成.docx")
@@ -228,8 +228,238 @@ A. 营业执照与相关资质复印件；B. 近三年无重大违法记录承
         data = resp.json()
         self.assertEqual(resp.status_code, 200)
         self.assertIn("embedding_result", data)
+        self.assertGreater(data["embedding_result"]["chunks"], 0)
+        self.assertNotIn("data", data["embedding_result"])
         print("Response:", data)
 
+    def test_deploy_info(self):
+        """
+        查看部署角色，多worker部署时reader和writer都应该返回
+        """
+        url = f"{self.base_url}/deploy_info"
+        resp = httpx.get(url, timeout=10.0)
+        resp.raise_for_status()
+        data = resp.json()
+        self.assertIn(data["role"], ["all", "writer", "reader"])
+        self.assertIn("write_version", data)
+        print("Response:", data)
+
+    def test_search_cache_stats(self):
+        """
+        相同的检索请求第二次应该命中缓存
+        """
+        data = {"userId": 23456, "query": "疾病", "keyword": "", "topk": 3}
+        before = httpx.get(f"{self.base_url}/search/cache_stats", timeout=10.0).json()
+        for _ in range(2):
+            httpx.post(f"{self.base_url}/search", json=data, timeout=20.0).raise_for_status()
+        after = httpx.get(f"{self.base_url}/search/cache_stats", timeout=10.0).json()
+        self.assertGreaterEqual(after["hits"], before["hits"] + 1)
+        print("Cache stats:", after)
+
+    def test_search_with_metadata_filter(self):
+        """
+        按fileId过滤检索，返回的结果都属于指定文件
+        """
+        data = {"userId": 2, "query": "培训", "topk": 3, "fileId": [5006, 987]}
+        resp = httpx.post(f"{self.base_url}/search", json=data, timeout=20.0)
+        resp.raise_for_status()
+        result = resp.json()
+        for meta in result["metadatas"][0]:
+            self.assertIn(meta["file_id"], [5006, 987])
+        print("Response:", result)
+
+    def test_export_and_import_collection(self):
+        """
+        导出user_2后导入到新的collection，条数一致
+        """
+        export_resp = httpx.get(f"{self.base_url}/collections/user_2/export", params={"page_size": 50}, timeout=60.0)
+        export_resp.raise_for_status()
+        lines = [json.loads(line) for line in export_resp.text.splitlines() if line.strip()]
+        self.assertEqual(lines[0]["type"], "header")
+        self.assertEqual(len(lines) - 1, lines[0]["total"])
+
+        import_resp = httpx.post(f"{self.base_url}/collections/user_2_copy/import", content=export_resp.content, timeout=60.0)
+        import_resp.raise_for_status()
+        self.assertEqual(import_resp.json()["imported"], lines[0]["total"])
+        print("Import result:", import_resp.json())
+
+    def test_readyz(self):
+        """
+        就绪探针返回各阶段的加载耗时
+        """
+        resp = httpx.get(f"{self.base_url}/readyz", timeout=10.0)
+        self.assertIn(resp.status_code, [200, 503])
+        data = resp.json()
+        self.assertIn("serving_search", data)
+        self.assertIn("fully_warmed", data)
+        self.assertIn("import_main", data["import_times_ms"])
+        print("Readyz:", data)
+
+    def test_get_file_vectors_npz(self):
+        """
+        显式获取文件向量，返回npz二进制
+        """
+        import io
+        import numpy as np
+        resp = httpx.get(f"{self.base_url}/vectors/2/5006", timeout=30.0)
+        resp.raise_for_status()
+        self.assertEqual(resp.headers["content-type"], "application/octet-stream")
+        npz = np.load(io.BytesIO(resp.content))
+        self.assertEqual(len(npz["ids"]), npz["embeddings"].shape[0])
+        print("Vectors shape:", npz["embeddings"].shape)
+
+    def test_search_neighbors(self):
+        """
+        命中分块的相邻分块扩展，按id读取，返回的分块带出处（ordinal、字符偏移）
+        """
+        url = f"{self.base_url}/search/neighbors"
+        payload = {"userId": 2, "ids": ["5006_1"], "window": 1}
+        resp = httpx.post(url, json=payload, timeout=30.0)
+        resp.raise_for_status()
+        data = resp.json()
+        print(json.dumps(data, ensure_ascii=False, indent=2))
+        self.assertEqual(data["results"][0]["id"], "5006_1")
+        for neighbor in data["results"][0]["neighbors"]:
+            self.assertIn(neighbor["offset"], (-1, 0, 1))
+            self.assertIn("ordinal", neighbor["metadata"])
+            self.assertIn("char_start", neighbor["metadata"])
+
+    def test_collection_index_profile(self):
+        """
+        查看collection的HNSW档位，只修改search_ef时原地生效
+        """
+        url = f"{self.base_url}/collections/user_2/index"
+        resp = httpx.get(url, timeout=30.0)
+        resp.raise_for_status()
+        data = resp.json()
+        print(json.dumps(data, ensure_ascii=False, indent=2))
+        self.assertEqual(data["metadata"]["hnsw:space"], "cosine")
+        resp = httpx.put(url, json={"profile": data["profile"], "params": {"search_ef": 128}}, timeout=60.0)
+        resp.raise_for_status()
+        self.assertIn(resp.json()["action"], ("updated", "unchanged"))
+        self.assertEqual(resp.json()["index"]["effective"]["ef_search"], 128)
+
+    def test_residency(self):
+        """
+        检索后collection被记为常驻，返回加载耗时和访问次数
+        """
+        httpx.post(f"{self.base_url}/search", json={"userId": 2, "query": "项目预算", "topk": 1}, timeout=30.0)
+        resp = httpx.get(f"{self.base_url}/residency", timeout=30.0)
+        resp.raise_for_status()
+        data = resp.json()
+        print(json.dumps(data, ensure_ascii=False, indent=2))
+        stats = {item["collection"]: item for item in data["collections"]}
+        self.assertIn("user_2", stats)
+        self.assertIsNotNone(stats["user_2"]["load_ms"])
+
+    def test_federated_search(self):
+        """
+        跨多个collection检索，结果按归一化score合并，每个collection有独立的状态
+        """
+        url = f"{self.base_url}/search/federated"
+        payload = {"query": "项目预算", "topk": 5, "targets": [{"userId": 2}, {"userId": 1}, {"collection": "not_exist_col"}]}
+        resp = httpx.post(url, json=payload, timeout=30.0)
+        resp.raise_for_status()
+        data = resp.json()
+        print(json.dumps(data, ensure_ascii=False, indent=2))
+        self.assertEqual(len(data["collections"]), 3)
+        self.assertEqual(data["collections"][2]["status"], "missing")
+        scores = [hit["score"] for hit in data["results"]]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+
+    def test_collection_migration_status(self):
+        """
+        collection记录了建库时的embedding模型；没有迁移任务时查询进度返回404
+        """
+        resp = httpx.get(f"{self.base_url}/collections/user_2/index", timeout=30.0)
+        resp.raise_for_status()
+        print(resp.json()["embedding"])
+        self.assertIn("model", resp.json()["embedding"])
+        resp = httpx.get(f"{self.base_url}/collections/not_exist_col/migrate", timeout=30.0)
+        self.assertEqual(resp.status_code, 404)
+
+    def test_vectorize_text_list_gzip_and_ndjson(self):
+        """
+        gzip压缩的JSON请求体，以及gzip压缩的NDJSON流式上传，都能正常入库；损坏返回400，解压后超限返回413
+        """
+        import gzip
+        url = f"{self.base_url}/vectorize/text_list"
+        texts = [f"第{i}条 投标人应提供一年免费质保及7x24小时服务响应。" for i in range(200)]
+        body = json.dumps({"content": texts, "fileId": 5045, "fileName": "gzip.txt", "userId": 2}, ensure_ascii=False)
+        resp = httpx.post(url, content=gzip.compress(body.encode("utf-8")), timeout=120.0,
+                          headers={"Content-Type": "application/json", "Content-Encoding": "gzip"})
+        resp.raise_for_status()
+        self.assertEqual(resp.json()["embedding_result"]["chunks"], 200)
+
+        lines = [json.dumps({"type": "header", "fileId": 5046, "fileName": "ndjson.txt", "userId": 2})]
+        lines += [json.dumps({"text": t}, ensure_ascii=False) for t in texts]
+        resp = httpx.post(url, content=gzip.compress("\n".join(lines).encode("utf-8")), timeout=120.0,
+                          headers={"Content-Type": "application/x-ndjson", "Content-Encoding": "gzip"})
+        resp.raise_for_status()
+        print(resp.json()["embedding_result"])
+        self.assertEqual(resp.json()["embedding_result"]["chunks"], 200)
+
+        resp = httpx.post(url, content=b"not gzip", timeout=30.0,
+                          headers={"Content-Type": "application/json", "Content-Encoding": "gzip"})
+        self.assertEqual(resp.status_code, 400)
+
+        # 解压后超过上限返回413，JSON、NDJSON和pydantic接口都一样；上限取服务端同名环境变量（默认2048MB，
+        # 测试服务建议用 REQUEST_MAX_DECOMPRESSED_MB=1 启动），压缩后的请求体只有上限的千分之一左右
+        import zlib
+        limit_mb = int(os.environ.get("REQUEST_MAX_DECOMPRESSED_MB", "2048"))
+
+        def _oversized(prefix: bytes) -> bytes:
+            compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+            parts = [compressor.compress(prefix)]
+            block = b"a" * (1024 * 1024)
+            for _ in range(limit_mb + 1):
+                parts.append(compressor.compress(block))
+            parts.append(compressor.flush())
+            return b"".join(parts)
+
+        header = json.dumps({"type": "header", "fileId": 5047, "fileName": "big.txt", "userId": 2}).encode("utf-8")
+        for path, content_type, prefix in [
+            ("/vectorize/text_list", "application/json", b'{"content": ["'),
+            ("/vectorize/text_list", "application/x-ndjson", header + b'\n{"text": "'),
+            ("/search", "application/json", b'{"userId": 2, "query": "'),
+        ]:
+            resp = httpx.post(f"{self.base_url}{path}", content=_oversized(prefix), timeout=300.0,
+                              headers={"Content-Type": content_type, "Content-Encoding": "gzip"})
+            self.assertEqual(resp.status_code, 413, f"{path} {content_type}: {resp.text}")
+
+    def test_vectorize_text_list_ndjson_bad_input(self):
+        """
+        NDJSON上传的输入错误与JSON方式一致返回4xx：header校验失败422，行不是JSON或缺少text返回400
+        """
+        url = f"{self.base_url}/vectorize/text_list"
+        headers = {"Content-Type": "application/x-ndjson"}
+        header = json.dumps({"type": "header", "fileId": 5048, "fileName": "bad.txt", "userId": 2})
+        cases = [
+            (json.dumps({"type": "header", "fileName": "bad.txt"}) + '\n{"text": "a"}', 422),
+            (header + "\n{not json}", 400),
+            (header + '\n{"txt": "a"}', 400),
+        ]
+        for body, status in cases:
+            resp = httpx.post(url, content=body.encode("utf-8"), headers=headers, timeout=30.0)
+            print(resp.status_code, resp.text)
+            self.assertEqual(resp.status_code, status)
+
+    def test_file_vectors_count_and_delete(self):
+        """
+        入库后count返回分块数，删除后为0
+        """
+        url = f"{self.base_url}/vectorize/text_list"
+        texts = [f"第{i}段 投标人应在交付时提交备品备件清单。" for i in range(5)]
+        resp = httpx.post(url, json={"content": texts, "fileId": 5047, "fileName": "count.txt", "userId": 2}, timeout=120.0)
+        resp.raise_for_status()
+        resp = httpx.get(f"{self.base_url}/vectors/2/5047/count", timeout=30.0)
+        resp.raise_for_status()
+        self.assertEqual(resp.json()["chunks"], 5)
+        resp = httpx.delete(f"{self.base_url}/vectors/2/5047", timeout=30.0)
+        resp.raise_for_status()
+        resp = httpx.get(f"{self.base_url}/vectors/2/5047/count", timeout=30.0)
+        self.assertEqual(resp.json()["chunks"], 0)
+
 if __name__ == "__main__":
     ts = KnowledgeBaseTestCase()
     ts.test_personal_db_search()
\ No newline at end of file
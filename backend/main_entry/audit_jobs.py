@@ -0,0 +1,448 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Date  : 2025/9/24
+# @File  : audit_jobs.py
+# @Desc  : 可续传的审计任务：审计在后台任务中运行，不再跟随HTTP连接结束；每个SSE事件编号后存入SQLite，
+#          断线重连时带上 Last-Event-ID 补发错过的事件，并继续跟随仍在运行的任务
+#          事件id格式为 {job_id}:{序号}，只凭 Last-Event-ID 就能找到对应的任务
+#          任务由固定大小的工作池执行：最多AUDIT_JOB_WORKERS个任务同时运行，其余按租户公平排队，
+#          队列满时拒绝新任务（QueueFullError，带建议的重试等待秒数）
+
+import os
+import math
+import json
+import time
+import heapq
+import asyncio
+import itertools
+from collections import defaultdict
+from typing import Any, AsyncGenerator, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+import aiosqlite
+
+AUDIT_JOBS_PATH = os.getenv("AUDIT_JOBS_PATH", os.path.join(os.path.dirname(__file__), "audit_jobs.sqlite"))
+# 结束超过该时长（秒）的任务及其事件在启动时清理
+AUDIT_JOB_RETENTION_SECONDS = float(os.getenv("AUDIT_JOB_RETENTION_SECONDS", str(24 * 3600)))
+# 等待新事件时，超过该时长（秒）没有事件就发送一个SSE注释保活，防止代理断开空闲连接
+AUDIT_JOB_HEARTBEAT_SECONDS = float(os.getenv("AUDIT_JOB_HEARTBEAT_SECONDS", "15"))
+# 同时运行的审计任务数（工作池大小），其余任务排队
+AUDIT_JOB_WORKERS = int(os.getenv("AUDIT_JOB_WORKERS", "4"))
+# 排队任务总数上限、单个租户排队任务上限，超过时拒绝新任务（HTTP 429）
+AUDIT_JOB_MAX_QUEUED = int(os.getenv("AUDIT_JOB_MAX_QUEUED", "100"))
+AUDIT_JOB_MAX_QUEUED_PER_TENANT = int(os.getenv("AUDIT_JOB_MAX_QUEUED_PER_TENANT", "20"))
+# 请求中的priority限制在 [-AUDIT_JOB_MAX_PRIORITY, AUDIT_JOB_MAX_PRIORITY]，只决定同一租户内任务的先后
+AUDIT_JOB_MAX_PRIORITY = int(os.getenv("AUDIT_JOB_MAX_PRIORITY", "5"))
+# 排队每满这么多秒，任务的有效优先级+1，低优先级任务不会一直等下去
+AUDIT_JOB_PRIORITY_AGING_SECONDS = float(os.getenv("AUDIT_JOB_PRIORITY_AGING_SECONDS", "300"))
+# 还没有任务完成时，估算排队时间所用的单个任务耗时（秒）
+AUDIT_JOB_ESTIMATE_SECONDS = float(os.getenv("AUDIT_JOB_ESTIMATE_SECONDS", "120"))
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLED = "cancelled"
+INTERRUPTED = "interrupted"
+
+_CONN = None
+_LOCK = asyncio.Lock()
+
+
+class QueueFullError(Exception):
+    """排队任务已满，retry_after为建议的重试等待秒数"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def clamp_priority(priority: int) -> int:
+    """把客户端传入的优先级限制在允许范围内"""
+    return max(-AUDIT_JOB_MAX_PRIORITY, min(AUDIT_JOB_MAX_PRIORITY, int(priority)))
+
+
+class AuditJob:
+    """
+    进程内排队中/运行中的任务。changed在每写入一个事件后被set并换成新的Event，订阅者据此等待新事件
+    """
+
+    def __init__(self, job_id: str, tenant: str, priority: int,
+                 frames_factory: Optional[Callable[[], AsyncIterator[str]]] = None):
+        self.job_id = job_id
+        self.tenant = tenant
+        self.priority = priority
+        self.frames_factory = frames_factory
+        self.status = QUEUED
+        self.seq = 0
+        self.changed = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        # _run已开始执行；create_task之后、第一次被调度之前为False，这期间取消不能用task.cancel()
+        self.entered = False
+        self.cancel_requested = False
+        self.enqueued_at = time.time()
+        self.order = 0
+        self.started_at: Optional[float] = None
+
+    def notify(self) -> None:
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+
+_JOBS: Dict[str, AuditJob] = {}
+
+
+class _Scheduler:
+    """
+    工作池调度：每个租户一个队列。有空闲槽位时先在租户之间选：正在运行任务最少的租户优先，
+    再相同则选最久没有被调度的（轮转），优先级不参与租户之间的选择，客户端传再大的priority也挤不掉别的租户；
+    选中租户后，在它的队列中取有效优先级（优先级+排队时长加成）最高的任务，相同则先进先出。
+    """
+
+    def __init__(self):
+        self.queues: Dict[str, List[Tuple[int, int, AuditJob]]] = {}
+        self.running: Dict[str, int] = defaultdict(int)
+        self.active = 0
+        self.counter = itertools.count()
+        self.last_served: Dict[str, int] = {}
+        self.avg_seconds = AUDIT_JOB_ESTIMATE_SECONDS
+
+    @property
+    def queued(self) -> int:
+        return sum(len(q) for q in self.queues.values())
+
+    def has_free_worker(self) -> bool:
+        return self.active < AUDIT_JOB_WORKERS and self.queued == 0
+
+    def retry_after(self) -> int:
+        """按平均任务耗时估算排到的等待秒数"""
+        return max(1, math.ceil(self.avg_seconds * (self.queued + 1) / max(1, AUDIT_JOB_WORKERS)))
+
+    def check_capacity(self, tenant: str) -> None:
+        if self.has_free_worker():
+            return
+        if self.queued >= AUDIT_JOB_MAX_QUEUED:
+            raise QueueFullError(f"审计任务排队已满（{self.queued}个）", self.retry_after())
+        if len(self.queues.get(tenant, [])) >= AUDIT_JOB_MAX_QUEUED_PER_TENANT:
+            raise QueueFullError(f"租户 {tenant} 排队的审计任务已满", self.retry_after())
+
+    def push(self, job: AuditJob) -> None:
+        job.order = next(self.counter)
+        heapq.heappush(self.queues.setdefault(job.tenant, []), (-job.priority, job.order, job))
+
+    def remove(self, job: AuditJob) -> bool:
+        queue = self.queues.get(job.tenant)
+        if not queue:
+            return False
+        remaining = [entry for entry in queue if entry[2] is not job]
+        if len(remaining) == len(queue):
+            return False
+        heapq.heapify(remaining)
+        if remaining:
+            self.queues[job.tenant] = remaining
+        else:
+            del self.queues[job.tenant]
+        return True
+
+    def _effective_priority(self, job: AuditJob, now: float) -> int:
+        if AUDIT_JOB_PRIORITY_AGING_SECONDS <= 0:
+            return job.priority
+        return job.priority + int((now - job.enqueued_at) // AUDIT_JOB_PRIORITY_AGING_SECONDS)
+
+    def pop_next(self) -> Optional[AuditJob]:
+        if self.active >= AUDIT_JOB_WORKERS or not self.queues:
+            return None
+        now = time.time()
+        tenant = min(self.queues, key=lambda t: (self.running.get(t, 0), self.last_served.get(t, -1)))
+        queue = self.queues[tenant]
+        # 排队时长加成会改变租户内的先后，单个租户最多AUDIT_JOB_MAX_QUEUED_PER_TENANT个任务，直接遍历
+        entry = max(queue, key=lambda e: (self._effective_priority(e[2], now), -e[1]))
+        queue.remove(entry)
+        heapq.heapify(queue)
+        if not queue:
+            del self.queues[tenant]
+        self.last_served[tenant] = next(self.counter)
+        return entry[2]
+
+    def position(self, job: AuditJob) -> int:
+        """
+        大致的排队位置（1表示下一个）：按租户轮转，同租户内每排在它前面一个任务，就要再等一轮（每个排队的租户各一个）；
+        再加上本轮中排在它的租户前面的租户数。不考虑排队时长加成和运行中任务结束的先后
+        """
+        key = (-job.priority, job.order)
+        ahead = sum(1 for neg_priority, order, _ in self.queues.get(job.tenant, []) if (neg_priority, order) < key)
+
+        def _tenant_key(t):
+            return self.running.get(t, 0), self.last_served.get(t, -1)
+        tenants_before = sum(1 for t in self.queues if t != job.tenant and _tenant_key(t) < _tenant_key(job.tenant))
+        return 1 + ahead * len(self.queues) + tenants_before
+
+    def started(self, job: AuditJob) -> None:
+        self.active += 1
+        self.running[job.tenant] += 1
+
+    def finished(self, job: AuditJob) -> None:
+        self.active -= 1
+        self.running[job.tenant] -= 1
+        if self.running[job.tenant] <= 0:
+            self.running.pop(job.tenant, None)
+        if job.started_at is not None and job.status == COMPLETED:
+            # 指数滑动平均，用于估算Retry-After
+            self.avg_seconds = 0.8 * self.avg_seconds + 0.2 * (time.time() - job.started_at)
+
+
+_SCHEDULER = _Scheduler()
+
+
+def format_event_id(job_id: str, seq: int) -> str:
+    return f"{job_id}:{seq}"
+
+
+def parse_event_id(event_id: Optional[str]) -> Tuple[Optional[str], int]:
+    """解析 Last-Event-ID，返回 (job_id, 序号)；格式不对时返回 (None, 0)"""
+    if not event_id or ":" not in event_id:
+        return None, 0
+    job_id, seq = event_id.rsplit(":", 1)
+    try:
+        return job_id, int(seq)
+    except ValueError:
+        return None, 0
+
+
+def _split_frame(frame: str) -> Tuple[str, str]:
+    """把 _sse_event 生成的一帧拆成 (event, data)"""
+    event, data = "message", ""
+    for line in frame.strip("\n").split("\n"):
+        if line.startswith("event: "):
+            event = line[len("event: "):]
+        elif line.startswith("data: "):
+            data = line[len("data: "):]
+    return event, data
+
+
+def _frame(job_id: str, seq: int, event: str, data: str) -> str:
+    return f"id: {format_event_id(job_id, seq)}\nevent: {event}\ndata: {data}\n\n"
+
+
+def _event(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def _get_conn():
+    global _CONN
+    if _CONN is None:
+        async with _LOCK:
+            if _CONN is None:
+                conn = await aiosqlite.connect(AUDIT_JOBS_PATH)
+                conn.row_factory = aiosqlite.Row
+                await conn.execute("PRAGMA journal_mode=WAL")
+                await conn.execute(
+                    "CREATE TABLE IF NOT EXISTS audit_jobs ("
+                    "job_id TEXT PRIMARY KEY, kind TEXT, status TEXT, request TEXT, "
+                    "last_event_id INTEGER DEFAULT 0, created_at REAL, updated_at REAL, "
+                    "tenant TEXT DEFAULT 'default', priority INTEGER DEFAULT 0)"
+                )
+                async with conn.execute("PRAGMA table_info(audit_jobs)") as cursor:
+                    columns = {row["name"] for row in await cursor.fetchall()}
+                if "tenant" not in columns:
+                    await conn.execute("ALTER TABLE audit_jobs ADD COLUMN tenant TEXT DEFAULT 'default'")
+                    await conn.execute("ALTER TABLE audit_jobs ADD COLUMN priority INTEGER DEFAULT 0")
+                await conn.execute(
+                    "CREATE TABLE IF NOT EXISTS audit_job_events ("
+                    "job_id TEXT, seq INTEGER, event TEXT, data TEXT, created_at REAL, PRIMARY KEY (job_id, seq))"
+                )
+                # 上次进程退出时排队中/没跑完的任务无法继续，标记为interrupted（已存的事件仍可补发）
+                await conn.execute("UPDATE audit_jobs SET status = ? WHERE status IN (?, ?)",
+                                   (INTERRUPTED, QUEUED, RUNNING))
+                expired = time.time() - AUDIT_JOB_RETENTION_SECONDS
+                await conn.execute("DELETE FROM audit_job_events WHERE job_id IN "
+                                   "(SELECT job_id FROM audit_jobs WHERE updated_at < ?)", (expired,))
+                await conn.execute("DELETE FROM audit_jobs WHERE updated_at < ?", (expired,))
+                await conn.commit()
+                _CONN = conn
+    return _CONN
+
+
+async def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """任务状态；排队中的任务多一个大致的排队位置position"""
+    conn = await _get_conn()
+    async with conn.execute("SELECT job_id, kind, status, tenant, priority, last_event_id, created_at, updated_at "
+                            "FROM audit_jobs WHERE job_id=?", (job_id,)) as cursor:
+        row = await cursor.fetchone()
+    if row is None:
+        return None
+    info = dict(row)
+    job = _JOBS.get(job_id)
+    if job is not None and job.status == QUEUED:
+        info["position"] = _SCHEDULER.position(job)
+    return info
+
+
+def stats() -> Dict[str, Any]:
+    """工作池概况"""
+    return {
+        "workers": AUDIT_JOB_WORKERS,
+        "running": _SCHEDULER.active,
+        "queued": _SCHEDULER.queued,
+        "queued_by_tenant": {tenant: len(queue) for tenant, queue in _SCHEDULER.queues.items()},
+        "running_by_tenant": dict(_SCHEDULER.running),
+        "avg_job_seconds": round(_SCHEDULER.avg_seconds, 1),
+    }
+
+
+async def _events_after(job_id: str, seq: int) -> List[Tuple[int, str, str]]:
+    conn = await _get_conn()
+    async with conn.execute("SELECT seq, event, data FROM audit_job_events WHERE job_id=? AND seq>? ORDER BY seq",
+                            (job_id, seq)) as cursor:
+        rows = await cursor.fetchall()
+    return [(row["seq"], row["event"], row["data"]) for row in rows]
+
+
+async def _append(job: AuditJob, frame: str) -> None:
+    event, data = _split_frame(frame)
+    job.seq += 1
+    now = time.time()
+    conn = await _get_conn()
+    await conn.execute("INSERT INTO audit_job_events (job_id, seq, event, data, created_at) VALUES (?, ?, ?, ?, ?)",
+                       (job.job_id, job.seq, event, data, now))
+    await conn.execute("UPDATE audit_jobs SET last_event_id=?, updated_at=? WHERE job_id=?", (job.seq, now, job.job_id))
+    await conn.commit()
+    job.notify()
+
+
+async def _set_status(job: AuditJob, status: str) -> None:
+    job.status = status
+    conn = await _get_conn()
+    await conn.execute("UPDATE audit_jobs SET status=?, updated_at=? WHERE job_id=?",
+                       (status, time.time(), job.job_id))
+    await conn.commit()
+
+
+async def _run(job: AuditJob) -> None:
+    job.entered = True
+    status = COMPLETED
+    frames = job.frames_factory()
+    job.frames_factory = None
+    try:
+        if job.cancel_requested:
+            # 还没开始执行就被取消，走下面的取消流程
+            raise asyncio.CancelledError()
+        await _set_status(job, RUNNING)
+        async for frame in frames:
+            await _append(job, frame)
+    except asyncio.CancelledError:
+        if not job.cancel_requested:
+            status = INTERRUPTED
+            raise
+        status = CANCELLED
+        await _append(job, _event("cancelled", {"job_id": job.job_id}))
+    except Exception as e:
+        status = FAILED
+        print(f"审计任务 {job.job_id} 失败: {e}")
+        await _append(job, _event("error", {"message": str(e)}))
+    finally:
+        # 在两帧之间被取消时生成器停在yield处，需要显式关闭，让它的finally（释放文档引用、取消审计子任务）执行
+        await frames.aclose()
+        await _set_status(job, status)
+        _JOBS.pop(job.job_id, None)
+        _SCHEDULER.finished(job)
+        job.notify()
+        _dispatch()
+
+
+def _dispatch() -> None:
+    """有空闲槽位时按调度规则启动排队的任务"""
+    while True:
+        job = _SCHEDULER.pop_next()
+        if job is None:
+            return
+        _SCHEDULER.started(job)
+        job.started_at = time.time()
+        job.task = asyncio.create_task(_run(job))
+
+
+async def submit_job(job_id: str, kind: str, request: Dict[str, Any],
+                     frames_factory: Callable[[], AsyncIterator[str]],
+                     tenant: str = "default", priority: int = 0) -> AuditJob:
+    """
+    登记任务并交给工作池：有空闲槽位时立即开始，否则排队并写入一个queued事件（带大致的排队位置）。
+    任务运行时frames_factory()产生的SSE帧逐一编号写入SQLite，任务的生命周期与HTTP连接无关。
+    排队已满时抛出QueueFullError。
+    """
+    priority = clamp_priority(priority)
+    _SCHEDULER.check_capacity(tenant)
+    conn = await _get_conn()
+    now = time.time()
+    await conn.execute("INSERT INTO audit_jobs (job_id, kind, status, request, created_at, updated_at, tenant, priority) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       (job_id, kind, QUEUED, json.dumps(request, ensure_ascii=False), now, now, tenant, priority))
+    await conn.commit()
+    job = AuditJob(job_id, tenant, priority, frames_factory)
+    _JOBS[job_id] = job
+    _SCHEDULER.push(job)
+    _dispatch()
+    if job.status == QUEUED and job.task is None:
+        await _append(job, _event("queued", {"job_id": job_id, "position": _SCHEDULER.position(job)}))
+    return job
+
+
+async def cancel_job(job_id: str) -> Optional[str]:
+    """
+    取消排队中或运行中的任务，返回取消后的状态；任务不在本进程中（已结束或不存在）时返回None
+    """
+    job = _JOBS.get(job_id)
+    if job is None:
+        return None
+    if job.task is None:
+        _SCHEDULER.remove(job)
+        await _append(job, _event("cancelled", {"job_id": job_id}))
+        await _set_status(job, CANCELLED)
+        _JOBS.pop(job_id, None)
+        job.notify()
+        return CANCELLED
+    job.cancel_requested = True
+    if job.entered:
+        job.task.cancel()
+    # 还没开始执行的任务不能task.cancel()（协程一步都没执行就结束，_run的finally不会执行，占着工作池的槽位），
+    # 由_run开始时检查cancel_requested走取消流程
+    await asyncio.gather(job.task, return_exceptions=True)
+    return job.status
+
+
+async def stream_job(job_id: str, after_seq: int = 0) -> AsyncGenerator[str, None]:
+    """
+    输出任务中序号大于after_seq的事件（带 id: 行），补发完已存的事件后继续跟随排队中/运行中的任务，
+    任务结束且事件全部发出后结束。客户端断开只结束本次订阅，不影响任务。
+    """
+    seq = after_seq
+    while True:
+        job = _JOBS.get(job_id)
+        changed = job.changed if job else None
+        rows = await _events_after(job_id, seq)
+        for seq, event, data in rows:
+            yield _frame(job_id, seq, event, data)
+        if rows:
+            continue
+        if job is None:
+            info = await get_job(job_id)
+            if info and info["status"] == INTERRUPTED:
+                # 不编号：任务没有跑完，重连后仍需从最后一个事件重新提交
+                yield _event("job_interrupted", info)
+            return
+        try:
+            await asyncio.wait_for(changed.wait(), timeout=AUDIT_JOB_HEARTBEAT_SECONDS)
+        except asyncio.TimeoutError:
+            yield ": keep-alive\n\n"
+
+
+async def close_audit_jobs() -> None:
+    """进程退出时取消仍在运行的任务（状态记为interrupted），排队中的任务直接丢弃，然后关闭数据库"""
+    global _CONN
+    _SCHEDULER.queues.clear()
+    tasks = [job.task for job in _JOBS.values() if job.task]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _JOBS.clear()
+    if _CONN is not None:
+        conn, _CONN = _CONN, None
+        await conn.close()
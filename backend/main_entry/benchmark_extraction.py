@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Date  : 2025/9/22
+# @File  : benchmark_extraction.py
+# @Desc  : 对比串行提取（共用thread_id）与并行提取（分组并行+编号校正）的耗时和编号准确率
+#          默认生成一份编号已知的长招标文本；也可以用 --file 指定真实招标文本（只统计耗时、条数和重复编号）
+#          会真实调用 OPENAI_MODEL 对应的模型
+# 用法: python benchmark_extraction.py --chapters 12 --items 10 --group-size 10
+#       python benchmark_extraction.py --file tender.txt
+
+import argparse
+import asyncio
+import time
+import uuid
+from collections import Counter
+from typing import List, Optional
+
+import extract_audit_requirment
+from extract_audit_requirment import extract_audit_requirements_iter, close_extract_cache
+
+_CN_NUM = "一二三四五六七八九十"
+
+_TOPICS = [
+    "系统需支持与HIS、LIS、PACS对接，接口遵循HL7/FHIR标准",
+    "提供数据审计与追踪功能，操作日志保存不少于5年",
+    "项目实施周期不超过90天，投标时提交详细进度计划",
+    "为采购人提供至少5天现场培训，并提交培训资料",
+    "提供7x24小时服务响应，关键问题4小时内到场处理",
+    "提供一年免费质保，并在交付时提交备品备件清单",
+    "投标人须具有合法资质，近三年内无重大违法记录",
+    "系统应通过国家信息安全等级保护三级测评",
+]
+
+
+def _chapter_name(i: int) -> str:
+    if i <= 10:
+        return _CN_NUM[i - 1]
+    return "十" + _CN_NUM[i - 11] if i < 20 else str(i)
+
+
+def build_tender(chapters: int, items: int, continued_every: int = 4):
+    """
+    生成编号已知的招标文本：第N章下有 N.1 ~ N.items 条要求，
+    每 continued_every 条有一条拆成两段（第二段没有编号，用于检验跨分组合并）。
+    返回 (text, expected_ids)
+    """
+    paragraphs: List[str] = []
+    expected: List[str] = []
+    for c in range(1, chapters + 1):
+        paragraphs.append(f"第{_chapter_name(c)}章 第{c}部分要求")
+        for i in range(1, items + 1):
+            sid = f"{c}.{i}"
+            topic = _TOPICS[(c * items + i) % len(_TOPICS)]
+            paragraphs.append(f"{sid} {topic}（第{c}章第{i}条）。")
+            if i % continued_every == 0:
+                paragraphs.append(f"上述第{sid}条要求须在投标文件中提供证明材料，并加盖公章。")
+            expected.append(sid)
+    return "\n\n".join(paragraphs), expected
+
+
+def score(expected: Optional[List[str]], got: List[str]) -> dict:
+    counts = Counter(got)
+    result = {
+        "items": len(got),
+        "duplicate_ids": sum(v - 1 for v in counts.values() if v > 1),
+    }
+    if expected:
+        hit = len(set(expected) & set(got))
+        pos = {sid: i for i, sid in enumerate(expected)}
+        ordered = [pos[sid] for sid in got if sid in pos]
+        result["id_recall"] = round(hit / len(expected), 4)
+        result["extra_items"] = sum(1 for sid in got if sid not in pos)
+        result["order_inversions"] = sum(1 for a, b in zip(ordered, ordered[1:]) if b < a)
+    return result
+
+
+async def run_once(text: str, group_size: int, parallel: bool) -> dict:
+    session_id = f"bench-{uuid.uuid4().hex}"
+    start = time.perf_counter()
+    first = None
+    got = []
+    async for item, meta in extract_audit_requirements_iter(text, session_id, group_size, parallel):
+        if first is None:
+            first = time.perf_counter() - start
+        got.append(item["section_id"])
+    return {"seconds": time.perf_counter() - start, "first_item_seconds": first or 0.0, "ids": got}
+
+
+async def main():
+    arg_parser = argparse.ArgumentParser(description="串行/并行要求提取对比")
+    arg_parser.add_argument("--file", help="真实招标文本路径，不传则生成编号已知的文本")
+    arg_parser.add_argument("--chapters", type=int, default=12)
+    arg_parser.add_argument("--items", type=int, default=10)
+    arg_parser.add_argument("--group-size", type=int, default=10)
+    args = arg_parser.parse_args()
+    # 对比的是模型调用耗时，不使用提取缓存
+    extract_audit_requirment.EXTRACT_CACHE = False
+
+    if args.file:
+        with open(args.file, encoding="utf-8") as f:
+            text = f.read()
+        expected = None
+    else:
+        text, expected = build_tender(args.chapters, args.items)
+        print(f"生成招标文本：{len(text)} 字，{len(expected)} 条要求")
+
+    for name, parallel in (("串行", False), ("并行", True)):
+        res = await run_once(text, args.group_size, parallel)
+        stats = score(expected, res["ids"])
+        print(f"{name}: 总耗时 {res['seconds']:.1f}s, 首条 {res['first_item_seconds']:.1f}s, {stats}")
+    await close_extract_cache()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
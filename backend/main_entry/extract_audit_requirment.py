@@ -7,6 +7,8 @@
 import os
 import re
 import json
+import time
+import hashlib
 import sqlite3
 import asyncio
 import aiosqlite
@@ -26,6 +28,16 @@ from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 
 dotenv.load_dotenv()
 
+# 并行提取：各分组同时调用模型（每组独立thread_id），结束后再统一校正编号
+EXTRACT_PARALLEL = os.getenv("EXTRACT_PARALLEL", "false").lower() in ("1", "true", "yes")
+# 并行提取时同时请求模型的分组数
+EXTRACT_CONCURRENCY = int(os.getenv("EXTRACT_CONCURRENCY", "4"))
+# 并行提取时每组附带的上文段落数（向前找的标题段落 + 紧挨着的上一段）
+EXTRACT_CONTEXT_PARAGRAPHS = int(os.getenv("EXTRACT_CONTEXT_PARAGRAPHS", "3"))
+# 分组提取结果缓存（与state.sqlite放在同一目录），相同分组不再重复调用模型
+EXTRACT_CACHE = os.getenv("EXTRACT_CACHE", "1") == "1"
+EXTRACT_CACHE_PATH = os.getenv("EXTRACT_CACHE_PATH", os.path.join(os.path.dirname(__file__), "extract_cache.sqlite"))
+
 # -----------------------------
 # 1) 消息裁剪（避免超长上下文）
 # -----------------------------
@@ -88,6 +100,92 @@ EXTRACT_INSTRUCTION = """你是一名“智能审计要求提取助手”。现
 4) 若原文没有明确编号，可根据层级/上下文合理推断并保持与之前片段的一致性（你拥有会话记忆）。
 5) 不要返回空数组；找不到时也要给出合理合并或“未编号”节，编号可采用连续编号如 "UN-1", "UN-2"。"""
 
+# 并行提取时附加的说明：片段前会给出上文（标题等），只用于判断编号和层级
+CONTEXT_INSTRUCTION = """6) “上文”只用于判断当前片段所属的章节和编号层级，不要从上文中提取要求。
+7) 若片段开头是上文某条要求的延续（没有新的编号），section_id 使用上文中那条要求的编号。"""
+
+# 提示词版本：提示词改动后旧缓存自动失效
+PROMPT_VERSIONS = {
+    "serial": hashlib.sha256(EXTRACT_INSTRUCTION.encode("utf-8")).hexdigest()[:12],
+    "parallel": hashlib.sha256((EXTRACT_INSTRUCTION + CONTEXT_INSTRUCTION).encode("utf-8")).hexdigest()[:12],
+}
+
+# -----------------------------
+# 3.1) 分组提取结果缓存（SQLite）
+# -----------------------------
+_CACHE_CONN = None
+_CACHE_LOCK = asyncio.Lock()
+
+def _sha256(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def _extract_model() -> str:
+    return os.getenv("OPENAI_MODEL", "gpt-4.1")
+
+def _cache_key(mode: str, chunk_text: str, prev_context: str) -> Tuple[str, str, str, str]:
+    """
+    缓存键：(模型, 提示词版本, 分组文本hash, 上文hash)
+    串行模式的上文是上一组的文本（模型靠会话记忆看到它），并行模式的上文是附带的上文窗口
+    """
+    return _extract_model(), PROMPT_VERSIONS[mode], _sha256(chunk_text), _sha256(prev_context)
+
+async def _get_cache_conn():
+    global _CACHE_CONN
+    if _CACHE_CONN is None:
+        async with _CACHE_LOCK:
+            if _CACHE_CONN is None:
+                conn = await aiosqlite.connect(EXTRACT_CACHE_PATH)
+                await conn.execute("PRAGMA journal_mode=WAL")
+                await conn.execute(
+                    "CREATE TABLE IF NOT EXISTS extract_cache ("
+                    "model TEXT, prompt_version TEXT, group_hash TEXT, context_hash TEXT, "
+                    "items TEXT NOT NULL, created_at REAL, hits INTEGER DEFAULT 0, "
+                    "PRIMARY KEY (model, prompt_version, group_hash, context_hash))"
+                )
+                await conn.commit()
+                _CACHE_CONN = conn
+    return _CACHE_CONN
+
+async def close_extract_cache() -> None:
+    """关闭缓存连接（aiosqlite的后台线程不关闭会阻止进程退出）"""
+    global _CACHE_CONN
+    if _CACHE_CONN is not None:
+        conn, _CACHE_CONN = _CACHE_CONN, None
+        await conn.close()
+
+async def _cache_get(key: Tuple[str, str, str, str]) -> Optional[List[Dict]]:
+    if not EXTRACT_CACHE:
+        return None
+    try:
+        conn = await _get_cache_conn()
+        where = "model=? AND prompt_version=? AND group_hash=? AND context_hash=?"
+        async with conn.execute(f"SELECT items FROM extract_cache WHERE {where}", key) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            return None
+        await conn.execute(f"UPDATE extract_cache SET hits = hits + 1 WHERE {where}", key)
+        await conn.commit()
+        return json.loads(row[0])
+    except Exception as e:
+        # 缓存不可用时直接调用模型
+        print(f"读取提取缓存失败: {e}")
+        return None
+
+async def _cache_put(key: Tuple[str, str, str, str], items: List[Dict]) -> None:
+    # 空结果多半是模型输出无法解析，不缓存
+    if not EXTRACT_CACHE or not items:
+        return
+    try:
+        conn = await _get_cache_conn()
+        await conn.execute(
+            "INSERT OR REPLACE INTO extract_cache (model, prompt_version, group_hash, context_hash, items, created_at, hits) "
+            "VALUES (?, ?, ?, ?, ?, ?, 0)",
+            (*key, json.dumps(items, ensure_ascii=False), time.time()),
+        )
+        await conn.commit()
+    except Exception as e:
+        print(f"写入提取缓存失败: {e}")
+
 # -----------------------------
 # 4) 文本分段：每10“段落”为一批
 # -----------------------------
@@ -136,14 +234,18 @@ def _parse_json_array_from_text(text: str) -> List[Dict]:
 # -----------------------------
 # 6) 调用Agent：单批片段 -> JSON数组
 # -----------------------------
-async def _extract_one_chunk(chunk_text: str, session_id: str) -> List[Dict]:
+async def _extract_one_chunk(chunk_text: str, session_id: str, context_text: str = "") -> List[Dict]:
     """
     给定一个片段+session_id（thread_id），调用agent并解析为[{"section_id","content"},...]
+    context_text：并行提取时附带的上文，只用于判断编号
     """
     agent = await _get_agent()
-    user_msg = HumanMessage(
-        content=f"{EXTRACT_INSTRUCTION}\n\n=== 片段开始 ===\n{chunk_text}\n=== 片段结束 ==="
-    )
+    if context_text:
+        content = (f"{EXTRACT_INSTRUCTION}\n{CONTEXT_INSTRUCTION}\n\n=== 上文 ===\n{context_text}\n"
+                   f"=== 片段开始 ===\n{chunk_text}\n=== 片段结束 ===")
+    else:
+        content = f"{EXTRACT_INSTRUCTION}\n\n=== 片段开始 ===\n{chunk_text}\n=== 片段结束 ==="
+    user_msg = HumanMessage(content=content)
     # 通过 configurable.thread_id 指定“会话ID”，让checkpointer记忆编号连续性
     state = await agent.ainvoke(
         {"messages": [user_msg]},
@@ -169,37 +271,212 @@ async def _extract_one_chunk(chunk_text: str, session_id: str) -> List[Dict]:
     return cleaned
 
 # -----------------------------
-# 7) 对外：异步生成器（逐条产出章节dict）
+# 7) 并行提取：上文窗口 + 编号校正
+# -----------------------------
+# 标题/编号段落：第一章、一、1.1、(1)、1) 等
+_HEADING_RE = re.compile(
+    r"^\s*(第[一二三四五六七八九十百零\d]+[章节部分篇条]|[一二三四五六七八九十]+[、.．]|\d+(\.\d+)*[、.．)）\s]|[（(]\d+[)）])"
+)
+_TOP_HEADING_RE = re.compile(r"^\s*(第[一二三四五六七八九十百零\d]+[章部分篇]|[一二三四五六七八九十]+[、.．])")
+_PLACEHOLDER_RE = re.compile(r"^UN-\d+$")
+
+def _header_context(paragraphs: List[str], start: int, window: int) -> str:
+    """
+    取第start段之前的上文（最多window段）：紧挨着的上一段 + 最近的章级标题 + 中间最近的几个编号段落。
+    """
+    if start <= 0 or window <= 0:
+        return ""
+    picked = [start - 1]
+    top = None
+    sub: List[int] = []
+    for i in range(start - 1, -1, -1):
+        if _TOP_HEADING_RE.match(paragraphs[i]):
+            top = i
+            break
+        if i < start - 1 and _HEADING_RE.match(paragraphs[i]):
+            sub.append(i)
+    if top is not None and top != start - 1 and window > 1:
+        picked.append(top)
+    picked.extend(sub[:max(0, window - len(picked))])
+    return "\n\n".join(paragraphs[i] for i in sorted(picked))
+
+def _norm_content(content: str) -> str:
+    """去掉空白和开头的编号，用于判断两条要求是否重复"""
+    m = _HEADING_RE.match(content)
+    if m:
+        content = content[m.end():]
+    return re.sub(r"\s+", "", content)
+
+def _same_section(a: str, b: str) -> bool:
+    """section_id相同，或任一方是占位编号（没有编号可比较）"""
+    return a == b or bool(_PLACEHOLDER_RE.match(a)) or bool(_PLACEHOLDER_RE.match(b))
+
+def _reconcile_boundary(prev_items: List[Dict], items: List[Dict], first_paragraph: str) -> List[Dict]:
+    """
+    校正相邻两组的边界，返回处理后的items（prev_items原地修改）：
+    - 开头与上一组最后一条内容相同且属于同一条款（section_id相同或是占位编号）的条目丢弃（模型从上文里又提取了一遍）；
+    - 首条与上一组最后一条section_id相同（占位编号不算，各组独立编号，相同只是巧合），
+      或首条是占位编号且本组第一段不是标题/编号（被分组切断的续写），合并到上一组最后一条。
+    """
+    if not prev_items or not items:
+        return items
+    last = prev_items[-1]
+    last_norm = _norm_content(last["content"])
+    while items and _norm_content(items[0]["content"]) == last_norm and _same_section(items[0]["section_id"], last["section_id"]):
+        items = items[1:]
+    if not items:
+        return items
+    first = items[0]
+    continued = _PLACEHOLDER_RE.match(first["section_id"]) and not _HEADING_RE.match(first_paragraph)
+    same_id = first["section_id"] == last["section_id"] and not _PLACEHOLDER_RE.match(first["section_id"])
+    if same_id or continued:
+        last["content"] = f"{last['content']}{first['content']}"
+        items = items[1:]
+    return items
+
+def _renumber_placeholders(items: List[Dict], counter: List[int]) -> None:
+    """各组独立提取时占位编号都从UN-1开始，这里按全局顺序重新编号"""
+    for it in items:
+        if _PLACEHOLDER_RE.match(it["section_id"]):
+            counter[0] += 1
+            it["section_id"] = f"UN-{counter[0]}"
+
+async def _extract_groups_parallel(
+    paragraphs: List[str],
+    group_size: int,
+    session_id: str,
+    concurrency: int,
+    context_paragraphs: int,
+) -> AsyncGenerator[Tuple[int, List[Dict], str], None]:
+    """
+    所有分组同时提交（最多concurrency个在请求模型），每组独立thread_id并附带上文窗口；
+    按分组顺序产出 (chunk_index, items, status)，status为 "ok" / "cached"（命中缓存，未调用模型） / "failed"。
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    starts = list(range(0, len(paragraphs), group_size))
+
+    async def _run(chunk_idx: int, start: int) -> Tuple[List[Dict], str]:
+        chunk_text = "\n\n".join(paragraphs[start:start + group_size])
+        context_text = _header_context(paragraphs, start, context_paragraphs)
+        key = _cache_key("parallel", chunk_text, context_text)
+        items = await _cache_get(key)
+        if items is not None:
+            return items, "cached"
+        async with semaphore:
+            items = await _extract_one_chunk(chunk_text, f"{session_id}-g{chunk_idx}", context_text)
+        # 在边界校正修改items之前缓存模型的原始结果
+        await _cache_put(key, items)
+        return items, "ok"
+
+    tasks = [asyncio.create_task(_run(i, start)) for i, start in enumerate(starts)]
+    try:
+        for chunk_idx, task in enumerate(tasks):
+            try:
+                yield (chunk_idx, *await task)
+            except Exception as e:
+                yield chunk_idx, [{"section_id": f"ERROR-{chunk_idx+1}", "content": f"提取失败：{e}"}], "failed"
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+def _emit_group(chunk_idx: int, items: List[Dict], status: str, counter: List[int]) -> List[Tuple[Dict, Dict]]:
+    """一组校正完的结果转为 (data, meta) 列表"""
+    if status != "failed":
+        _renumber_placeholders(items, counter)
+    total = len(items)
+    return [
+        (it, {"chunk_index": chunk_idx, "index_in_chunk": i, "total_in_chunk": total, "cached": status == "cached"})
+        for i, it in enumerate(items)
+    ]
+
+async def _extract_parallel_iter(
+    text: str,
+    session_id: str,
+    group_size: int,
+    concurrency: int,
+    context_paragraphs: int,
+) -> AsyncGenerator[Tuple[Dict, Dict], None]:
+    """
+    并行提取 + 确定性校正：一组的结果要等下一组返回、完成边界合并后才产出，
+    产出顺序、meta格式与串行模式一致。
+    """
+    paragraphs = _split_into_paragraphs(text)
+    counter = [0]
+    pending: Optional[Tuple[int, List[Dict], str]] = None
+    async for chunk_idx, items, status in _extract_groups_parallel(
+        paragraphs, group_size, session_id, concurrency, context_paragraphs
+    ):
+        if pending is not None and pending[2] != "failed" and status != "failed":
+            items = _reconcile_boundary(pending[1], items, paragraphs[chunk_idx * group_size])
+        if pending is not None:
+            for pair in _emit_group(*pending, counter):
+                yield pair
+        pending = (chunk_idx, items, status)
+    if pending is not None:
+        for pair in _emit_group(*pending, counter):
+            yield pair
+
+# -----------------------------
+# 8) 对外：异步生成器（逐条产出章节dict）
 # -----------------------------
 async def extract_audit_requirements_iter(
     text: str,
     session_id: str,
     group_size: int = 10,
+    parallel: Optional[bool] = None,
 ) -> AsyncGenerator[Tuple[Dict, Dict], None]:
     """
     将“超长审计要求文本”按每 group_size 段分批调用模型，并逐条产出章节。
+    parallel：None 时取 EXTRACT_PARALLEL；True 时各分组并行提取再校正编号（见 _extract_parallel_iter），
+              False 时串行提取，所有分组共用一个 thread_id 让模型保持编号连续。
     产出为 (data, meta)：
       - data: {"section_id","content"}
       - meta: {"chunk_index": int, "index_in_chunk": int, "total_in_chunk": int}
     """
+    if parallel is None:
+        parallel = EXTRACT_PARALLEL
+    if parallel:
+        async for pair in _extract_parallel_iter(
+            text, session_id, group_size, EXTRACT_CONCURRENCY, EXTRACT_CONTEXT_PARAGRAPHS
+        ):
+            yield pair
+        return
+
     paragraphs = _split_into_paragraphs(text)
     groups = _group_every_n(paragraphs, group_size)
 
+    # 命中缓存的分组不会进入会话历史；之后第一个需要调用模型的分组改为附带上文窗口，保证编号连续
+    prev_text = ""
+    thread_synced = True
     for chunk_idx, chunk_text in enumerate(groups):
-        try:
-            items = await _extract_one_chunk(chunk_text, session_id)
-        except Exception as e:
-            # 出错时也往外抛一个错误条目，便于前端展示
-            err = {"section_id": f"ERROR-{chunk_idx+1}", "content": f"提取失败：{e}"}
-            yield err, {"chunk_index": chunk_idx, "index_in_chunk": 0, "total_in_chunk": 1}
-            continue
+        key = _cache_key("serial", chunk_text, prev_text)
+        items = await _cache_get(key)
+        cached = items is not None
+        if cached:
+            thread_synced = False
+        else:
+            try:
+                context_text = "" if thread_synced else _header_context(
+                    paragraphs, chunk_idx * group_size, EXTRACT_CONTEXT_PARAGRAPHS)
+                items = await _extract_one_chunk(chunk_text, session_id, context_text)
+                thread_synced = True
+                await _cache_put(key, items)
+            except Exception as e:
+                # 出错时也往外抛一个错误条目，便于前端展示
+                err = {"section_id": f"ERROR-{chunk_idx+1}", "content": f"提取失败：{e}"}
+                yield err, {"chunk_index": chunk_idx, "index_in_chunk": 0, "total_in_chunk": 1, "cached": False}
+                prev_text = chunk_text
+                continue
+        prev_text = chunk_text
 
         total = len(items)
         for i, it in enumerate(items):
-            yield it, {"chunk_index": chunk_idx, "index_in_chunk": i, "total_in_chunk": total}
+            yield it, {"chunk_index": chunk_idx, "index_in_chunk": i, "total_in_chunk": total, "cached": cached}
 
 # -----------------------------
-# 8) 本地快速调试
+# 9) 本地快速调试
 # -----------------------------
 if __name__ == "__main__":
     import asyncio
@@ -224,5 +501,6 @@ if __name__ == "__main__":
     async def _run():
         async for data, meta in extract_audit_requirements_iter(sample_text, "debug-session-001", 3):
             print(meta, data)
+        await close_extract_cache()
 
     asyncio.run(_run())
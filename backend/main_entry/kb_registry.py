@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Date  : 2025/9/23
+# @File  : kb_registry.py
+# @Desc  : 按内容寻址的文档向量登记表：同样的 docs_contents 得到同一个知识库fileId，已入库的直接复用，
+#          引用计数记录有多少个审计正在使用，只有没人使用时才允许清理向量
+
+import os
+import time
+import hashlib
+import asyncio
+import weakref
+from typing import Any, Dict, List, Optional
+
+import aiosqlite
+
+KB_CONTENT_ADDRESSED = os.getenv("KB_CONTENT_ADDRESSED", "1") == "1"
+KB_REGISTRY_PATH = os.getenv("KB_REGISTRY_PATH", os.path.join(os.path.dirname(__file__), "kb_registry.sqlite"))
+
+_CONN = None
+_LOCK = asyncio.Lock()
+# 同一个(user_id, file_id)的检查/向量化/删除串行执行，并发的相同文档只向量化一次；
+# 弱引用保存，持有或等待锁的协程都释放后条目自动消失，不会随文档数量无限增长
+_KEY_LOCKS: "weakref.WeakValueDictionary[tuple, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def content_file_id(docs: List[str], mode: str) -> tuple:
+    """
+    由文档内容计算 (content_hash, file_id)。mode区分分块方式（text: 合并后按长度切分，text_list: 每段一个分块），
+    同样的文本用不同方式入库得到的分块不同，不能互相复用。
+    file_id取hash前13位十六进制（52bit），是正整数且在前端Number的安全范围内。
+    """
+    h = hashlib.sha256(mode.encode("utf-8"))
+    for doc in docs:
+        h.update(b"\x00")
+        h.update((doc or "").encode("utf-8"))
+    content_hash = h.hexdigest()
+    return content_hash, int(content_hash[:13], 16)
+
+
+def key_lock(user_id: Any, file_id: Any) -> asyncio.Lock:
+    key = (str(user_id), str(file_id))
+    lock = _KEY_LOCKS.get(key)
+    if lock is None:
+        lock = _KEY_LOCKS[key] = asyncio.Lock()
+    return lock
+
+
+async def _get_conn():
+    global _CONN
+    if _CONN is None:
+        async with _LOCK:
+            if _CONN is None:
+                conn = await aiosqlite.connect(KB_REGISTRY_PATH)
+                conn.row_factory = aiosqlite.Row
+                await conn.execute("PRAGMA journal_mode=WAL")
+                await conn.execute(
+                    "CREATE TABLE IF NOT EXISTS kb_documents ("
+                    "user_id TEXT, file_id TEXT, content_hash TEXT, mode TEXT, chunks INTEGER DEFAULT 0, "
+                    "status TEXT DEFAULT 'pending', refcount INTEGER DEFAULT 0, created_at REAL, last_used REAL, "
+                    "PRIMARY KEY (user_id, file_id))"
+                )
+                await conn.commit()
+                # 进程重启时没有正在进行的审计，上次遗留的引用计数清零
+                await conn.execute("UPDATE kb_documents SET refcount = 0 WHERE refcount != 0")
+                await conn.commit()
+                _CONN = conn
+    return _CONN
+
+
+async def get(user_id: Any, file_id: Any) -> Optional[Dict[str, Any]]:
+    conn = await _get_conn()
+    async with conn.execute("SELECT * FROM kb_documents WHERE user_id=? AND file_id=?",
+                            (str(user_id), str(file_id))) as cursor:
+        row = await cursor.fetchone()
+    return dict(row) if row else None
+
+
+async def acquire(user_id: Any, file_id: Any, content_hash: str, mode: str) -> None:
+    """引用计数+1，没有记录时新建（状态pending）"""
+    conn = await _get_conn()
+    now = time.time()
+    await conn.execute(
+        "INSERT INTO kb_documents (user_id, file_id, content_hash, mode, refcount, created_at, last_used) "
+        "VALUES (?, ?, ?, ?, 1, ?, ?) "
+        "ON CONFLICT(user_id, file_id) DO UPDATE SET refcount = refcount + 1, last_used = excluded.last_used",
+        (str(user_id), str(file_id), content_hash, mode, now, now),
+    )
+    await conn.commit()
+
+
+async def release(user_id: Any, file_id: Any) -> None:
+    """引用计数-1（不小于0），记录最后使用时间"""
+    conn = await _get_conn()
+    await conn.execute(
+        "UPDATE kb_documents SET refcount = MAX(refcount - 1, 0), last_used = ? WHERE user_id=? AND file_id=?",
+        (time.time(), str(user_id), str(file_id)),
+    )
+    await conn.commit()
+
+
+async def mark_ready(user_id: Any, file_id: Any, chunks: int) -> None:
+    conn = await _get_conn()
+    await conn.execute("UPDATE kb_documents SET status = 'ready', chunks = ? WHERE user_id=? AND file_id=?",
+                       (chunks, str(user_id), str(file_id)))
+    await conn.commit()
+
+
+async def mark_pending(user_id: Any, file_id: Any) -> None:
+    conn = await _get_conn()
+    await conn.execute("UPDATE kb_documents SET status = 'pending', chunks = 0 WHERE user_id=? AND file_id=?",
+                       (str(user_id), str(file_id)))
+    await conn.commit()
+
+
+async def remove_if_unused(user_id: Any, file_id: Any) -> bool:
+    """引用计数为0时删除登记记录并返回True，仍有审计在使用时返回False"""
+    conn = await _get_conn()
+    cursor = await conn.execute("DELETE FROM kb_documents WHERE user_id=? AND file_id=? AND refcount = 0",
+                                (str(user_id), str(file_id)))
+    await conn.commit()
+    return cursor.rowcount > 0
+
+
+async def list_idle(idle_seconds: float) -> List[Dict[str, Any]]:
+    """没有审计在使用、且超过idle_seconds未使用的文档"""
+    conn = await _get_conn()
+    async with conn.execute("SELECT * FROM kb_documents WHERE refcount = 0 AND last_used < ?",
+                            (time.time() - idle_seconds,)) as cursor:
+        rows = await cursor.fetchall()
+    return [dict(row) for row in rows]
+
+
+async def close_kb_registry() -> None:
+    global _CONN
+    if _CONN is not None:
+        conn, _CONN = _CONN, None
+        await conn.close()
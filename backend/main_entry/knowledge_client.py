@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Date  : 2025/9/22
+# @File  : knowledge_client.py
+# @Desc  : 调用知识库服务的共享客户端：连接池复用、大请求体gzip压缩、按数据量放大超时、文本列表NDJSON流式上传
+
+import os
+import gzip
+import json
+import zlib
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# 请求体超过该大小时gzip压缩（知识库服务的GzipRequestMiddleware负责解压）
+KS_GZIP_MIN_BYTES = int(os.getenv("KS_GZIP_MIN_BYTES", str(64 * 1024)))
+KS_GZIP_LEVEL = int(os.getenv("KS_GZIP_LEVEL", "5"))
+# 超时 = 基础超时 + 每MB（未压缩）增加的秒数，最多KS_TIMEOUT_MAX_SECONDS；embedding耗时与文本量成正比
+KS_TIMEOUT_BASE_SECONDS = float(os.getenv("KS_TIMEOUT_BASE_SECONDS", "60"))
+KS_TIMEOUT_PER_MB_SECONDS = float(os.getenv("KS_TIMEOUT_PER_MB_SECONDS", "20"))
+KS_TIMEOUT_MAX_SECONDS = float(os.getenv("KS_TIMEOUT_MAX_SECONDS", "3600"))
+# 文本列表超过该大小或条数时改用NDJSON流式上传，知识库边接收边按窗口embedding写入
+# （普通JSON方式一次写入全部分块，条数过多会超过chromadb的单批上限）
+KS_NDJSON_MIN_BYTES = int(os.getenv("KS_NDJSON_MIN_BYTES", str(8 * 1024 * 1024)))
+KS_NDJSON_MIN_ITEMS = int(os.getenv("KS_NDJSON_MIN_ITEMS", "2000"))
+# NDJSON上传时每攒够这么多字节压缩发送一次
+KS_NDJSON_CHUNK_BYTES = int(os.getenv("KS_NDJSON_CHUNK_BYTES", str(256 * 1024)))
+KS_MAX_CONNECTIONS = int(os.getenv("KS_MAX_CONNECTIONS", "50"))
+
+
+def scaled_timeout(payload_bytes: int) -> httpx.Timeout:
+    """按未压缩的数据量放大读写超时，连接超时保持较短"""
+    seconds = KS_TIMEOUT_BASE_SECONDS + KS_TIMEOUT_PER_MB_SECONDS * payload_bytes / (1024 * 1024)
+    seconds = min(seconds, KS_TIMEOUT_MAX_SECONDS)
+    return httpx.Timeout(seconds, connect=10.0)
+
+
+class KnowledgeClient:
+    """
+    知识库服务客户端，进程内共享一个带连接池的 httpx.AsyncClient。
+    httpx客户端绑定创建它的事件循环，换了事件循环会重新创建。
+    """
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip("/")
+        self._client: Optional[httpx.AsyncClient] = None
+        self._client_loop = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client.is_closed or self._client_loop is not loop:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=KS_TIMEOUT_BASE_SECONDS,
+                limits=httpx.Limits(max_connections=KS_MAX_CONNECTIONS),
+            )
+            self._client_loop = loop
+        return self._client
+
+    async def post_json(self, path: str, body: Dict[str, Any]) -> httpx.Response:
+        """
+        POST JSON，超过KS_GZIP_MIN_BYTES时gzip压缩请求体（大文本在线程中压缩，不阻塞事件循环）
+        """
+        raw = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        content = raw
+        if len(raw) >= KS_GZIP_MIN_BYTES:
+            content = await asyncio.to_thread(gzip.compress, raw, KS_GZIP_LEVEL)
+            headers["Content-Encoding"] = "gzip"
+            logger.info(f"知识库请求 {path} 压缩: {len(raw)} -> {len(content)} 字节")
+        return await self._get_client().post(path, content=content, headers=headers, timeout=scaled_timeout(len(raw)))
+
+    async def _ndjson_body(self, header: Dict[str, Any], texts: List[str]) -> AsyncIterator[bytes]:
+        """逐行生成NDJSON并流式gzip压缩，内存中只保留一个发送块"""
+        compressor = zlib.compressobj(KS_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        pending: List[bytes] = [json.dumps({"type": "header", **header}, ensure_ascii=False).encode("utf-8") + b"\n"]
+        size = len(pending[0])
+        for text in texts:
+            line = json.dumps({"text": text}, ensure_ascii=False).encode("utf-8") + b"\n"
+            pending.append(line)
+            size += len(line)
+            if size >= KS_NDJSON_CHUNK_BYTES:
+                out = compressor.compress(b"".join(pending))
+                pending, size = [], 0
+                if out:
+                    yield out
+                # 让出事件循环，避免大文档压缩时长时间占用
+                await asyncio.sleep(0)
+        yield compressor.compress(b"".join(pending)) + compressor.flush()
+
+    async def search(self, user_id: Any, query: str, topk: int = 3) -> Dict[str, Any]:
+        """POST /search，返回 {"ids", "documents", "metadatas", "distances"}（每个都是按query嵌套的列表）"""
+        resp = await self.post_json("/search", {"userId": user_id, "query": query, "keyword": "", "topk": topk})
+        resp.raise_for_status()
+        return resp.json()
+
+    async def vectorize_text(self, content: str, file_id: Any, user_id: Any, file_name: str) -> Dict[str, Any]:
+        """POST /vectorize/text，返回知识库的JSON结果"""
+        resp = await self.post_json("/vectorize/text", {
+            "content": content,
+            "fileId": file_id,
+            "userId": user_id,
+            "fileName": file_name
+        })
+        resp.raise_for_status()
+        return resp.json()
+
+    async def vectorize_text_list(self, texts: List[str], file_id: Any, user_id: Any, file_name: str,
+                                  stream: Optional[bool] = None) -> Dict[str, Any]:
+        """
+        POST /vectorize/text_list。stream为None时按数据量自动选择：
+        超过KS_NDJSON_MIN_BYTES用NDJSON流式上传（知识库边接收边embedding），否则普通JSON（可能gzip）。
+        """
+        header = {"fileId": file_id, "userId": user_id, "fileName": file_name}
+        payload_bytes = sum(len(t.encode("utf-8")) for t in texts)
+        if stream is None:
+            stream = payload_bytes >= KS_NDJSON_MIN_BYTES or len(texts) >= KS_NDJSON_MIN_ITEMS
+        if not stream:
+            resp = await self.post_json("/vectorize/text_list", {"content": texts, **header})
+            resp.raise_for_status()
+            return resp.json()
+        logger.info(f"NDJSON流式上传文本列表: {len(texts)} 条, {payload_bytes} 字节")
+        resp = await self._get_client().post(
+            "/vectorize/text_list",
+            content=self._ndjson_body(header, texts),
+            headers={"Content-Type": "application/x-ndjson", "Content-Encoding": "gzip"},
+            timeout=scaled_timeout(payload_bytes),
+        )
+        resp.raise_for_status()
+        return resp.json()
+
+    async def count_file_chunks(self, user_id: Any, file_id: Any) -> int:
+        """GET /vectors/{userId}/{fileId}/count，返回该文件已入库的分块数"""
+        resp = await self._get_client().get(f"/vectors/{user_id}/{file_id}/count")
+        resp.raise_for_status()
+        return int(resp.json().get("chunks", 0))
+
+    async def delete_file_vectors(self, user_id: Any, file_id: Any) -> None:
+        """DELETE /vectors/{userId}/{fileId}，删除该文件的全部向量"""
+        resp = await self._get_client().delete(f"/vectors/{user_id}/{file_id}")
+        resp.raise_for_status()
+
+    async def aclose(self) -> None:
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
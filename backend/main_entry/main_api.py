@@ -4,14 +4,17 @@ import uuid
 import os
 import dotenv
 from typing import Optional, AsyncGenerator, Dict, Any, List, Union
-from pydantic import BaseModel, Field
-from fastapi import FastAPI
+from pydantic import BaseModel, Field, field_validator
+from fastapi import FastAPI, HTTPException, Header
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
-from extract_audit_requirment import extract_audit_requirements_iter
-from audit_client import A2AAuditClientWrapper
-import httpx
+from extract_audit_requirment import extract_audit_requirements_iter, close_extract_cache
+from audit_client import A2AAuditClientWrapper, a2a_manager
+from knowledge_client import KnowledgeClient
+import verdict_cache
+import kb_registry
+import audit_jobs
 
 dotenv.load_dotenv()
 
@@ -20,6 +23,17 @@ AUDIT_AGENT = os.environ["AUDIT_AGENT"]
 
 # 知识库的API地址
 KNOWLEDGE_AGENT = os.environ["KNOWLEDGE_AGENT"]
+# 共享的知识库客户端（连接池、大请求体gzip、按数据量放大超时）
+knowledge_client = KnowledgeClient(KNOWLEDGE_AGENT)
+
+# 阶段B并发审计：单个请求默认同时审计的要求条数，以及单个请求允许设置的上限
+AUDIT_CONCURRENCY = int(os.getenv("AUDIT_CONCURRENCY", "4"))
+AUDIT_MAX_CONCURRENCY = int(os.getenv("AUDIT_MAX_CONCURRENCY", "16"))
+# 整个进程同时调用审计Agent的上限（所有请求共享），保护LLM配额
+AUDIT_GLOBAL_CONCURRENCY = int(os.getenv("AUDIT_GLOBAL_CONCURRENCY", "32"))
+_AUDIT_GLOBAL_SEMAPHORE = asyncio.Semaphore(AUDIT_GLOBAL_CONCURRENCY)
+# /api/audit 默认是否使用流水线模式（边向量化、边提取、边审计）
+AUDIT_PIPELINE = os.getenv("AUDIT_PIPELINE", "false").lower() in ("1", "true", "yes")
 
 app = FastAPI(title="智能审计", version="1.0.0")
 
@@ -39,6 +53,7 @@ class ExtractRequest(BaseModel):
     text: str
     session_id: Optional[str] = None
     group_size: Optional[int] = 10  # 默认每10段一批
+    parallel: Optional[bool] = None  # 各分组并行提取再校正编号，不传用EXTRACT_PARALLEL
 
 # 批量审计请求模型
 class BatchAuditRequest(BaseModel):
@@ -46,9 +61,21 @@ class BatchAuditRequest(BaseModel):
     docs_contents: List[str] = Field(..., min_items=1, description="需要被审计的文档内容（可多份）")
     # 可选：透传/或由后端生成
     user_id: int = Field(0, description="知识库向量化所需的用户ID，未提供则用0")
-    file_id: Optional[int] = Field(None, description="知识库向量化的fileId，不传则后端生成")
+    file_id: Optional[int] = Field(None, description="知识库向量化的fileId，不传则按文档内容生成（相同文档复用已入库的向量）")
     file_name: Optional[str] = Field(None, description="知识库fileName，不传则后端生成")
     group_size: Optional[int] = Field(10, description="提取要求时的分组大小，被审计的文档分块的大小，分成10行一个块")
+    concurrency: Optional[int] = Field(None, description="阶段B同时审计的要求条数，不传用AUDIT_CONCURRENCY，最大AUDIT_MAX_CONCURRENCY")
+    ordered: bool = Field(False, description="True时审计事件按index顺序输出，False时按完成先后输出")
+    use_cache: bool = Field(True, description="证据没变时复用审计结论缓存，False时强制重新审计（结果仍会写入缓存）")
+    tenant_id: Optional[str] = Field(None, description="租户，排队时按租户公平调度；不传时取user_id")
+    priority: int = Field(0, description="任务优先级，只决定同一租户内的先后，越大越先执行；超出±AUDIT_JOB_MAX_PRIORITY时截断")
+    pipeline: Optional[bool] = Field(None, description="流水线模式：向量化与提取同时进行，每提取出一条要求就排队审计，不传用AUDIT_PIPELINE")
+    parallel_extract: Optional[bool] = Field(None, description="各分组并行提取要求再校正编号，不传用EXTRACT_PARALLEL")
+
+    @field_validator("priority")
+    @classmethod
+    def _clamp_priority(cls, value: int) -> int:
+        return audit_jobs.clamp_priority(value)
 
 class AuditOneRequest(BaseModel):
     one_requirement: str = Field(..., description="单条审计要求")
@@ -60,8 +87,18 @@ class PreSplitBatchAuditRequest(BaseModel):
     docs_contents: List[str] = Field(..., min_items=1, description="需要被审计的文档内容")
     # 可选：透传/或由后端生成
     user_id: int = Field(0, description="知识库向量化所需的用户ID，未提供则用0")
-    file_id: Optional[int] = Field(None, description="知识库向量化的fileId，不传则后端生成")
+    file_id: Optional[int] = Field(None, description="知识库向量化的fileId，不传则按文档内容生成（相同文档复用已入库的向量）")
     file_name: Optional[str] = Field(None, description="知识库fileName，不传则后端生成")
+    concurrency: Optional[int] = Field(None, description="阶段B同时审计的要求条数，不传用AUDIT_CONCURRENCY，最大AUDIT_MAX_CONCURRENCY")
+    ordered: bool = Field(False, description="True时审计事件按index顺序输出，False时按完成先后输出")
+    use_cache: bool = Field(True, description="证据没变时复用审计结论缓存，False时强制重新审计（结果仍会写入缓存）")
+    tenant_id: Optional[str] = Field(None, description="租户，排队时按租户公平调度；不传时取user_id")
+    priority: int = Field(0, description="任务优先级，只决定同一租户内的先后，越大越先执行；超出±AUDIT_JOB_MAX_PRIORITY时截断")
+
+    @field_validator("priority")
+    @classmethod
+    def _clamp_priority(cls, value: int) -> int:
+        return audit_jobs.clamp_priority(value)
 
 # -----------------------------
 # SSE 工具函数
@@ -90,7 +127,7 @@ async def api_extract_audit_requirements(req: ExtractRequest):
         yield _sse_event("session", {"session_id": session_id})
 
         # 逐条章节推送
-        async for item, meta in extract_audit_requirements_iter(req.text, session_id, group_size):
+        async for item, meta in extract_audit_requirements_iter(req.text, session_id, group_size, req.parallel):
             print(f"提取的要求信息内容是: {item}, 对应的meta信息是: {meta}")
             yield _sse_event("section", {"data": item, "meta": meta})
 
@@ -140,60 +177,365 @@ def _join_docs(docs: List[str]) -> str:
     sep = "\n\n----- DOC SPLIT -----\n\n"
     return sep.join(docs)
 
-@app.post("/api/audit")
-async def api_audit(req: BatchAuditRequest):
+async def _vectorize_text(docs: List[str], file_id: Any, user_id: Any, file_name: str) -> Dict[str, Any]:
+    """合并文档后调用知识库 /vectorize/text，返回 vectorize_ok 事件的数据"""
+    kb_json = await knowledge_client.vectorize_text(_join_docs(docs), file_id, user_id, file_name)
+    print(f"文档向量化返回的结果: {kb_json.get('embedding_result', kb_json)}")
+    return {
+        "file_id": kb_json.get("id", file_id),
+        "user_id": kb_json.get("userId", user_id),
+        "embedding_result": bool(kb_json.get("embedding_result", None))
+    }
+
+async def _vectorize_text_list(docs: List[str], file_id: Any, user_id: Any, file_name: str) -> Dict[str, Any]:
+    """每段文档作为一个分块调用知识库 /vectorize/text_list，返回 vectorize_ok 事件的数据"""
+    kb_json = await knowledge_client.vectorize_text_list(docs, file_id, user_id, file_name)
+    return {
+        "file_id": kb_json.get("id", file_id),
+        "user_id": kb_json.get("userId", user_id),
+        "embedding_result": bool(kb_json.get("embedding_result", None))
+    }
+
+def _resolve_kb_ids(req: Union["BatchAuditRequest", "PreSplitBatchAuditRequest"], mode: str):
     """
-    批量审计入口（两阶段）：
-    阶段A：提取全部审计要求 -> 一次性以 requirements_ready 事件返回给前端
-    阶段B：再开始逐条审计 -> audit_begin / audit_delta / audit_end
-    事件顺序：
-       - session
-       - vectorize_ok
-       - requirements_ready (total, items=[{index, requirement, meta}])
-       - audit_begin (index, requirement)
-       - audit_delta (index, chunk)
-       - audit_end   (index, full_text)
-       - done
+    确定知识库的 (file_id, user_id, file_name, content_hash)。
+    请求指定了file_id时照旧使用，content_hash为None；否则开启内容寻址时由文档内容hash得到file_id，
+    关闭时随机生成。
     """
-    session_id = uuid.uuid4().hex
-    group_size = req.group_size or 10
-    file_id = req.file_id or int(uuid.uuid4().int % 1_000_000_000)
+    content_hash = None
+    if req.file_id:
+        file_id = req.file_id
+    elif kb_registry.KB_CONTENT_ADDRESSED:
+        content_hash, file_id = kb_registry.content_file_id(req.docs_contents, mode)
+    else:
+        file_id = int(uuid.uuid4().int % 1_000_000_000)
     file_name = req.file_name or f"audit_{file_id}.txt"
     user_id = req.user_id or file_id
+    return file_id, user_id, file_name, content_hash
 
-    headers = {
-        "Cache-Control": "no-cache",
-        "Connection": "keep-alive",
-        "X-Accel-Buffering": "no",
-    }
+async def _ensure_vectorized(docs: List[str], file_id: Any, user_id: Any, file_name: str,
+                             content_hash: Optional[str], vectorize) -> Dict[str, Any]:
+    """
+    向量化文档，返回 vectorize_ok 事件的数据（内容寻址时多一个reused字段）。
+    content_hash为None时直接调用vectorize；否则登记表中已就绪、且知识库里的分块数与登记一致时跳过向量化，
+    不一致（入库中断、向量被删）时先清掉残留分块再重新向量化。调用方需先 kb_registry.acquire。
+    """
+    if content_hash is None:
+        return await vectorize(docs, file_id, user_id, file_name)
+    async with kb_registry.key_lock(user_id, file_id):
+        entry = await kb_registry.get(user_id, file_id)
+        chunks = await knowledge_client.count_file_chunks(user_id, file_id)
+        if entry and entry["status"] == "ready" and chunks and chunks == entry["chunks"]:
+            print(f"文档 {file_id} 已入库（{chunks} 个分块），跳过向量化")
+            return {"file_id": file_id, "user_id": user_id, "embedding_result": True, "reused": True}
+        if chunks:
+            await knowledge_client.delete_file_vectors(user_id, file_id)
+        await kb_registry.mark_pending(user_id, file_id)
+        payload = await vectorize(docs, file_id, user_id, file_name)
+        if payload.get("embedding_result"):
+            await kb_registry.mark_ready(user_id, file_id, await knowledge_client.count_file_chunks(user_id, file_id))
+        return {**payload, "reused": False}
+
+async def _delete_kb_document(user_id: Any, file_id: Any) -> bool:
+    """没有审计在使用时删除文档向量和登记记录，返回是否删除"""
+    async with kb_registry.key_lock(user_id, file_id):
+        entry = await kb_registry.get(user_id, file_id)
+        if entry and entry["refcount"] > 0:
+            return False
+        await knowledge_client.delete_file_vectors(user_id, file_id)
+        if not await kb_registry.remove_if_unused(user_id, file_id):
+            await kb_registry.mark_pending(user_id, file_id)
+        return True
+
+def _resolve_concurrency(concurrency: Optional[int]) -> int:
+    """请求里的并发数规范化到 [1, AUDIT_MAX_CONCURRENCY]"""
+    value = concurrency or AUDIT_CONCURRENCY
+    return max(1, min(int(value), AUDIT_MAX_CONCURRENCY))
+
+async def _lookup_verdict(prompt: str, file_id: Any):
+    """
+    预检索证据并查询审计结论缓存，返回 (缓存键, 证据指纹, 缓存的结论)；
+    没有证据或缓存不可用时返回 (None, None, None)，按正常流程审计
+    """
+    try:
+        search_result = await knowledge_client.search(file_id, prompt, verdict_cache.VERDICT_EVIDENCE_TOPK)
+        fingerprint = verdict_cache.evidence_fingerprint(search_result)
+        if fingerprint is None:
+            return None, None, None
+        key = verdict_cache.verdict_key(prompt, fingerprint)
+        return key, fingerprint, await verdict_cache.get_verdict(key)
+    except Exception as e:
+        print(f"审计结论缓存预检索失败，按正常流程审计: {e}")
+        return None, None, None
+
+async def _audit_one(req_item: Dict[str, Any], session_id: str, file_id: Any,
+                     semaphore: asyncio.Semaphore, queue: asyncio.Queue,
+                     ready: Optional[asyncio.Future] = None, use_cache: bool = True) -> None:
+    """
+    审计一条要求，事件(index, event, data)放入queue。
+    ready不为空时先等它完成（流水线模式下等知识库向量化完成），失败则直接audit_error。
+    先拿单请求的信号量：开启审计结论缓存时在信号量内预检索证据（一个请求同时发出的检索不超过其并发数），
+    命中缓存立即返回（audit_end带cached=true），不占用全局并发名额；未命中再拿全局信号量，拿到后才发audit_begin；audit_end一定会发。
+    每条要求单独一个A2A会话(contextId)，并发时互不串历史。
+    """
+    idx = req_item["index"]
+    prompt = req_item["requirement"]
+    meta = req_item.get("meta", {})
+    if ready is not None:
+        try:
+            # shield：这条审计被取消时不连带取消共享的向量化任务
+            await asyncio.shield(ready)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await queue.put((idx, "audit_begin", {"index": idx, "requirement": prompt, "meta": meta}))
+            await queue.put((idx, "audit_error", {"index": idx, "message": f"知识库未就绪：{e}"}))
+            await queue.put((idx, "audit_end", {"index": idx, "result": "", "cached": False}))
+            return
+    async with semaphore:
+        cache_key, fingerprint = None, None
+        if verdict_cache.VERDICT_CACHE:
+            cache_key, fingerprint, cached_result = await _lookup_verdict(prompt, file_id)
+            if cached_result is not None and use_cache:
+                await queue.put((idx, "audit_begin", {"index": idx, "requirement": prompt, "meta": meta, "cached": True}))
+                await queue.put((idx, "audit_end", {"index": idx, "result": cached_result, "cached": True}))
+                return
+        async with _AUDIT_GLOBAL_SEMAPHORE:
+            await queue.put((idx, "audit_begin", {"index": idx, "requirement": prompt, "meta": meta}))
+            full_text_parts: List[str] = []
+            failed = False
+            try:
+                audit_wrapper = A2AAuditClientWrapper(session_id=session_id + str(idx), agent_url=AUDIT_AGENT)
+                # 开始审计，prompt审计要求， file_id投标书
+                async for chunk_data in audit_wrapper.generate(user_question=prompt, file_id=str(file_id)):
+                    chunk_type = chunk_data.get("type")
+                    if chunk_type == "error":
+                        raise RuntimeError(f"审计Agent返回错误: {chunk_data.get('message', '')}")
+                    if chunk_type == "final":
+                        # final只是结束标记，不属于审计结论
+                        continue
+                    metadata = chunk_data.get("metadata")
+                    if metadata:
+                        print(f"metadata: {metadata}")
+                    piece = chunk_data.get("text")
+                    if not piece:
+                        print(f"返回的chunk数据不是text，不进行累加: {chunk_data}")
+                        continue
+                    full_text_parts.append(piece)
+            except Exception as e:
+                failed = True
+                await queue.put((idx, "audit_error", {"index": idx, "message": str(e)}))
+            finally:
+                full_text = "".join(full_text_parts).strip()
+                await queue.put((idx, "audit_end", {"index": idx, "result": full_text, "cached": False}))
+    # 只缓存完整完成的审计结论，写缓存时不再占用并发名额
+    if cache_key and full_text and not failed:
+        try:
+            await verdict_cache.put_verdict(cache_key, prompt, fingerprint, full_text)
+        except Exception as e:
+            print(f"写入审计结论缓存失败: {e}")
+
+class _AuditFanout:
+    """
+    阶段B的并发调度：submit() 随时提交要求（流水线模式下边提取边提交），
+    emit() 推送非审计事件（vectorize_ok / requirement / requirements_ready，立即输出），
+    close() 表示不会再提交，frames() 产出SSE帧直到所有已提交的要求都 audit_end。
+    ordered=False：审计事件按完成先后输出；
+    ordered=True：按index顺序输出，后面先完成的条目先缓存，等前面的audit_end发出后再补发。
+    """
+
+    def __init__(self, session_id: str, file_id: Any, concurrency: Optional[int] = None,
+                 ordered: bool = False, ready: Optional[asyncio.Future] = None, use_cache: bool = True):
+        self.session_id = session_id
+        self.file_id = file_id
+        self.ordered = ordered
+        self.ready = ready
+        self.use_cache = use_cache
+        self.semaphore = asyncio.Semaphore(_resolve_concurrency(concurrency))
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.tasks: List[asyncio.Task] = []
+        self.indexes: List[int] = []
+        self.closed = False
+
+    def submit(self, req_item: Dict[str, Any]) -> None:
+        self.indexes.append(req_item["index"])
+        self.tasks.append(asyncio.create_task(
+            _audit_one(req_item, self.session_id, self.file_id, self.semaphore, self.queue, self.ready, self.use_cache)
+        ))
+
+    async def emit(self, event: str, data: Any) -> None:
+        await self.queue.put((None, event, data))
+
+    async def close(self) -> None:
+        self.closed = True
+        # 唤醒frames()检查是否可以结束
+        await self.queue.put((None, None, None))
+
+    async def frames(self) -> AsyncGenerator[str, None]:
+        buffered: Dict[int, List[str]] = {}
+        finished = set()
+        cursor = 0
+        try:
+            while not (self.closed and len(finished) == len(self.indexes)):
+                idx, event, data = await self.queue.get()
+                if event is None:
+                    continue
+                frame = _sse_event(event, data)
+                if idx is None or not self.ordered:
+                    if event == "audit_end":
+                        finished.add(idx)
+                    yield frame
+                    continue
+                if event == "audit_end":
+                    finished.add(idx)
+                buffered.setdefault(idx, []).append(frame)
+                while cursor < len(self.indexes):
+                    for frame in buffered.pop(self.indexes[cursor], []):
+                        yield frame
+                    if self.indexes[cursor] not in finished:
+                        break
+                    cursor += 1
+        finally:
+            await self.aclose()
+
+    async def aclose(self) -> None:
+        """客户端断开时取消还没完成的审计任务"""
+        for task in self.tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+async def _audit_requirements_stream(requirements: List[Dict[str, Any]], session_id: str, file_id: Any,
+                                     concurrency: Optional[int] = None, ordered: bool = False,
+                                     use_cache: bool = True) -> AsyncGenerator[str, None]:
+    """
+    阶段B：最多concurrency条要求同时审计，输出audit_begin / audit_error / audit_end的SSE帧。
+    """
+    fanout = _AuditFanout(session_id, file_id, concurrency, ordered, use_cache=use_cache)
+    for req_item in requirements:
+        fanout.submit(req_item)
+    await fanout.close()
+    async for frame in fanout.frames():
+        yield frame
+
+async def _pipelined_audit_stream(req: BatchAuditRequest, session_id: str, file_id: Any, user_id: Any,
+                                  file_name: str, group_size: int, requirements: List[Dict[str, Any]],
+                                  content_hash: Optional[str] = None) -> AsyncGenerator[str, None]:
+    """
+    流水线模式：向量化和要求提取同时开始，每提取出一条要求就推送requirement事件并提交审计，
+    审计任务等知识库向量化完成后才真正调用审计Agent；提取全部结束后补发requirements_ready汇总。
+    提取出的要求追加到requirements里，供调用方统计total。
+    """
+    kb_task = asyncio.create_task(_ensure_vectorized(req.docs_contents, file_id, user_id, file_name,
+                                                     content_hash, _vectorize_text))
+    fanout = _AuditFanout(session_id, file_id, req.concurrency, req.ordered, ready=kb_task, use_cache=req.use_cache)
+
+    async def _vectorize():
+        try:
+            await fanout.emit("vectorize_ok", await asyncio.shield(kb_task))
+        except Exception as e:
+            await fanout.emit("vectorize_error", {"file_id": file_id, "message": str(e)})
+
+    async def _extract():
+        idx = 0
+        async for item, meta in extract_audit_requirements_iter(req.requirements_content, session_id, group_size,
+                                                                req.parallel_extract):
+            req_item = {
+                "index": idx,
+                "requirement": _normalize_requirement(item),
+                "meta": meta
+            }
+            requirements.append(req_item)
+            await fanout.emit("requirement", req_item)
+            fanout.submit(req_item)
+            idx += 1
+        await fanout.emit("requirements_ready", {
+            "total": len(requirements),
+            "items": requirements
+        })
+
+    async def _produce():
+        try:
+            await asyncio.gather(_vectorize(), _extract())
+        finally:
+            await fanout.close()
+
+    producer = asyncio.create_task(_produce())
+    try:
+        async for frame in fanout.frames():
+            yield frame
+        # 提取失败时把异常抛给调用方
+        await producer
+    finally:
+        for task in (producer, kb_task):
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(producer, kb_task, return_exceptions=True)
+
+def _job_request(req: BaseModel, file_id: Any, user_id: Any) -> Dict[str, Any]:
+    """任务登记时保存的请求参数，不保存大段的文档/要求原文"""
+    return {"file_id": file_id, "user_id": user_id,
+            **req.model_dump(exclude={"docs_contents", "requirements_content", "file_id", "user_id"})}
+
+def _job_stream_response(job_id: str, after_seq: int, headers: Dict[str, str]) -> StreamingResponse:
+    return StreamingResponse(audit_jobs.stream_job(job_id, after_seq), media_type="text/event-stream",
+                             headers={**headers, "X-Audit-Job-Id": job_id})
+
+async def _resume_response(last_event_id: Optional[str], headers: Dict[str, str]) -> Optional[StreamingResponse]:
+    """
+    请求带了 Last-Event-ID 且对应的任务存在时，补发之后的事件并继续跟随任务，不重新审计；否则返回None
+    """
+    job_id, seq = audit_jobs.parse_event_id(last_event_id)
+    if job_id is None or await audit_jobs.get_job(job_id) is None:
+        return None
+    print(f"审计任务 {job_id} 断线重连，从事件 {seq} 之后继续")
+    return _job_stream_response(job_id, seq, headers)
+
+_SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",
+}
+
+def _audit_job(req: BatchAuditRequest):
+    """
+    构造 /api/audit 的审计任务，返回 (session_id, 登记的请求参数, SSE帧生成函数)
+    """
+    session_id = uuid.uuid4().hex
+    group_size = req.group_size or 10
+    pipeline = AUDIT_PIPELINE if req.pipeline is None else req.pipeline
+    file_id, user_id, file_name, content_hash = _resolve_kb_ids(req, "text")
 
     async def _event_stream() -> AsyncGenerator[str, None]:
+        if content_hash is not None:
+            await kb_registry.acquire(user_id, file_id, content_hash, "text")
+        try:
+            async for frame in _audit_event_stream():
+                yield frame
+        finally:
+            if content_hash is not None:
+                await kb_registry.release(user_id, file_id)
+
+    async def _audit_event_stream() -> AsyncGenerator[str, None]:
         # 1) 先回 session
         yield _sse_event("session", {"session_id": session_id, "file_id": str(file_id)})
 
-        # 2) 文档向量化（一次，给审计用）
-        docs_merged = _join_docs(req.docs_contents)
-        kb_url = f"{KNOWLEDGE_AGENT.rstrip('/')}/vectorize/text"
-        kb_body = {
-            "content": docs_merged,
-            "fileId": file_id,
-            "userId": user_id,
-            "fileName": file_name
-        }
-        async with httpx.AsyncClient(timeout=httpx.Timeout(60.0)) as client:
-            kb_resp = await client.post(kb_url, json=kb_body)
-            print(f"文档向量化返回的结果: {kb_resp}")
-            kb_json = kb_resp.json()
-            yield _sse_event("vectorize_ok", {
-                "file_id": kb_json.get("id", file_id),
-                "user_id": kb_json.get("userId", user_id),
-                "embedding_result": bool(kb_json.get("embedding_result", None))
-            })
+        requirements: List[Dict[str, Any]] = []
+        if pipeline:
+            async for frame in _pipelined_audit_stream(req, session_id, file_id, user_id, file_name,
+                                                       group_size, requirements, content_hash):
+                yield frame
+            yield _sse_event("done", {"message": "completed", "session_id": session_id, "total": len(requirements)})
+            return
+
+        # 2) 文档向量化（一次，给审计用；相同文档已入库时直接复用）
+        yield _sse_event("vectorize_ok", await _ensure_vectorized(req.docs_contents, file_id, user_id, file_name,
+                                                                  content_hash, _vectorize_text))
 
         # 3) 阶段A：先完整提取所有审计要求（不立刻审计）
-        requirements: List[Dict[str, Any]] = []
         idx = 0
-        async for item, meta in extract_audit_requirements_iter(req.requirements_content, session_id, group_size):
+        async for item, meta in extract_audit_requirements_iter(req.requirements_content, session_id, group_size,
+                                                                req.parallel_extract):
             prompt = _normalize_requirement(item)
             requirements.append({
                 "index": idx,
@@ -208,43 +550,109 @@ async def api_audit(req: BatchAuditRequest):
             "items": requirements
         })
 
-        # 4) 阶段B：现在才开始逐条审计
-        audit_wrapper = A2AAuditClientWrapper(session_id=session_id, agent_url=AUDIT_AGENT)
+        # 4) 阶段B：并发审计，最多concurrency条同时进行
+        async for frame in _audit_requirements_stream(requirements, session_id, file_id, req.concurrency, req.ordered,
+                                                    req.use_cache):
+            yield frame
 
-        for req_item in requirements:
-            idx = req_item["index"]
-            prompt = req_item["requirement"]
-            meta = req_item.get("meta", {})
+        # 全部结束
+        yield _sse_event("done", {"message": "completed", "session_id": session_id, "total": len(requirements)})
 
-            # 通知前端：开始某条
-            yield _sse_event("audit_begin", {"index": idx, "requirement": prompt, "meta": meta})
+    return session_id, _job_request(req, file_id, user_id), _event_stream
 
-            full_text_parts: List[str] = []
-            try:
-                async for chunk_data in audit_wrapper.generate(user_question=prompt, file_id=str(file_id)):
-                    # 透传增量
-                    # yield _sse_event("audit_delta", {"index": idx, "chunk": chunk_data})
+def _audit_pre_split_job(req: PreSplitBatchAuditRequest):
+    """
+    构造 /api/audit_pre_split 的审计任务，返回 (session_id, 登记的请求参数, SSE帧生成函数)
+    """
+    session_id = uuid.uuid4().hex
+    file_id, user_id, file_name, content_hash = _resolve_kb_ids(req, "text_list")
 
-                    # 累加文本
-                    piece = chunk_data.get("text")
-                    if not piece:
-                        print(f"返回的chunk数据不是text，不进行累加: {chunk_data}")
-                        continue
-                    full_text_parts.append(piece)
-            except Exception as e:
-                yield _sse_event("audit_error", {"index": idx, "message": str(e)})
-            finally:
-                full_text = "".join(full_text_parts).strip()
-                yield _sse_event("audit_end", {"index": idx, "result": full_text})
+    async def _event_stream() -> AsyncGenerator[str, None]:
+        if content_hash is not None:
+            await kb_registry.acquire(user_id, file_id, content_hash, "text_list")
+        try:
+            async for frame in _audit_event_stream():
+                yield frame
+        finally:
+            if content_hash is not None:
+                await kb_registry.release(user_id, file_id)
+
+    async def _audit_event_stream() -> AsyncGenerator[str, None]:
+        # 1) 先回 session
+        yield _sse_event("session", {"session_id": session_id, "file_id": str(file_id)})
+
+        # 2) 文档向量化（一次，给审计用；相同文档已入库时直接复用）
+        yield _sse_event("vectorize_ok", await _ensure_vectorized(req.docs_contents, file_id, user_id, file_name,
+                                                                  content_hash, _vectorize_text_list))
+
+        # 3) 阶段A：直接使用传入的审计要求
+        requirements = [
+            {"index": idx, "requirement": req_text, "meta": {}}
+            for idx, req_text in enumerate(req.requirements)
+        ]
+
+        # 将“全部提取结果”一次性通知前端
+        yield _sse_event("requirements_ready", {
+            "total": len(requirements),
+            "items": requirements
+        })
+
+        # 4) 阶段B：并发审计，最多concurrency条同时进行
+        async for frame in _audit_requirements_stream(requirements, session_id, file_id, req.concurrency, req.ordered,
+                                                    req.use_cache):
+            yield frame
 
         # 全部结束
         yield _sse_event("done", {"message": "completed", "session_id": session_id, "total": len(requirements)})
 
-    return StreamingResponse(_event_stream(), media_type="text/event-stream", headers=headers)
+    return session_id, _job_request(req, file_id, user_id), _event_stream
+
+async def _submit_audit_job(kind: str, req: Union[BatchAuditRequest, PreSplitBatchAuditRequest], build) -> str:
+    """
+    把审计任务交给工作池，返回任务id（即session_id）；排队已满时返回429，Retry-After为估算的等待秒数
+    """
+    session_id, request, frames_factory = build(req)
+    tenant = req.tenant_id or (str(req.user_id) if req.user_id else "default")
+    try:
+        await audit_jobs.submit_job(session_id, kind, request, frames_factory, tenant=tenant, priority=req.priority)
+    except audit_jobs.QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    return session_id
+
+@app.post("/api/audit")
+async def api_audit(req: BatchAuditRequest, last_event_id: Optional[str] = Header(None)):
+    """
+    批量审计入口（两阶段）：
+    阶段A：提取全部审计要求 -> 一次性以 requirements_ready 事件返回给前端
+    阶段B：再并发审计（concurrency条同时进行，ordered控制输出顺序） -> audit_begin / audit_delta / audit_end
+    事件顺序：
+       - session
+       - vectorize_ok
+       - requirements_ready (total, items=[{index, requirement, meta}])
+       - audit_begin (index, requirement)
+       - audit_delta (index, chunk)
+       - audit_end   (index, full_text)
+       - done
+    pipeline=True 时为流水线模式（见 _pipelined_audit_stream）：
+       - session
+       - requirement (index, requirement, meta)，每提取出一条推送一次，随后即排队审计
+       - vectorize_ok / vectorize_error
+       - audit_begin / audit_end，与后续 requirement 事件交错
+       - requirements_ready (total, items)，提取全部结束后的汇总
+       - done
+    审计作为任务在后台运行（任务id即session_id），每个事件带 id: {session_id}:{序号}；
+    断线后带 Last-Event-ID 重新请求，会补发错过的事件并继续跟随仍在运行的任务，不会重新审计。
+    任务由工作池执行，没有空闲槽位时先推送queued事件排队；排队已满时返回429。
+    """
+    resumed = await _resume_response(last_event_id, _SSE_HEADERS)
+    if resumed is not None:
+        return resumed
+    session_id = await _submit_audit_job("audit", req, _audit_job)
+    return _job_stream_response(session_id, 0, _SSE_HEADERS)
 
 
 @app.post("/api/audit_pre_split")
-async def api_audit_pre_split(req: PreSplitBatchAuditRequest):
+async def api_audit_pre_split(req: PreSplitBatchAuditRequest, last_event_id: Optional[str] = Header(None)):
     """
     批量审计入口（预分片）：
     - requirements: 已经拆分好的要求列表
@@ -257,87 +665,115 @@ async def api_audit_pre_split(req: PreSplitBatchAuditRequest):
        - audit_delta (index, chunk)
        - audit_end   (index, full_text)
        - done
+    与 /api/audit 一样作为任务运行（工作池排队、429），支持 Last-Event-ID 断线续传。
     """
-    session_id = uuid.uuid4().hex
-    file_id = req.file_id or int(uuid.uuid4().int % 1_000_000_000)
-    file_name = req.file_name or f"audit_{file_id}.txt"
-    user_id = req.user_id or file_id
-
-    headers = {
-        "Cache-Control": "no-cache",
-        "Connection": "keep-alive",
-        "X-Accel-Buffering": "no",
-    }
-
-    async def _event_stream() -> AsyncGenerator[str, None]:
-        # 1) 先回 session
-        yield _sse_event("session", {"session_id": session_id, "file_id": str(file_id)})
+    resumed = await _resume_response(last_event_id, _SSE_HEADERS)
+    if resumed is not None:
+        return resumed
+    session_id = await _submit_audit_job("audit_pre_split", req, _audit_pre_split_job)
+    return _job_stream_response(session_id, 0, _SSE_HEADERS)
 
-        # 2) 文档向量化（一次，给审计用）
-        kb_url = f"{KNOWLEDGE_AGENT.rstrip('/')}/vectorize/text_list"
-        kb_body = {
-            "content": req.docs_contents,
-            "fileId": file_id,
-            "userId": user_id,
-            "fileName": file_name
-        }
-        async with httpx.AsyncClient(timeout=httpx.Timeout(60.0)) as client:
-            kb_resp = await client.post(kb_url, json=kb_body)
-            kb_resp.raise_for_status()
-            kb_json = kb_resp.json()
-            yield _sse_event("vectorize_ok", {
-                "file_id": kb_json.get("id", file_id),
-                "user_id": kb_json.get("userId", user_id),
-                "embedding_result": bool(kb_json.get("embedding_result", None))
-            })
 
+@app.post("/api/audit/jobs", status_code=202)
+async def api_submit_audit_job(req: BatchAuditRequest):
+    """
+    提交 /api/audit 审计任务但不等待，返回任务id；之后通过 /api/audit/jobs/{job_id} 查询状态、
+    /api/audit/jobs/{job_id}/events 订阅事件（与 /api/audit 的事件相同）
+    """
+    job_id = await _submit_audit_job("audit", req, _audit_job)
+    return await audit_jobs.get_job(job_id)
 
-        # 3) 阶段A：直接使用传入的审计要求
-        requirements = [
-            {"index": idx, "requirement": req_text, "meta": {}}
-            for idx, req_text in enumerate(req.requirements)
-        ]
 
-        # 将“全部提取结果”一次性通知前端
-        yield _sse_event("requirements_ready", {
-            "total": len(requirements),
-            "items": requirements
-        })
+@app.post("/api/audit_pre_split/jobs", status_code=202)
+async def api_submit_audit_pre_split_job(req: PreSplitBatchAuditRequest):
+    """
+    提交 /api/audit_pre_split 审计任务但不等待，返回任务id
+    """
+    job_id = await _submit_audit_job("audit_pre_split", req, _audit_pre_split_job)
+    return await audit_jobs.get_job(job_id)
 
-        # 4) 阶段B：现在才开始逐条审计
-        for req_item in requirements:
-            idx = req_item["index"]
-            prompt = req_item["requirement"]
-            meta = req_item.get("meta", {})
 
-            # 通知前端：开始某条
-            yield _sse_event("audit_begin", {"index": idx, "requirement": prompt, "meta": meta})
+@app.get("/api/audit/jobs")
+async def api_audit_job_stats():
+    """
+    工作池概况：槽位数、运行中/排队中的任务数（按租户）、平均任务耗时
+    """
+    return audit_jobs.stats()
 
-            full_text_parts: List[str] = []
-            try:
-                # 先初始化Agent
-                audit_wrapper = A2AAuditClientWrapper(session_id=session_id+str(idx), agent_url=AUDIT_AGENT)
-                # 开始审计，prompt审计要求， file_id投标书
-                async for chunk_data in audit_wrapper.generate(user_question=prompt, file_id=str(file_id)):
-                    metadata = chunk_data.get("metadata")
-                    if metadata:
-                        print(f"metadata: {metadata}")
-                    piece = chunk_data.get("text")
-                    if not piece:
-                        print(f"返回的chunk数据不是text，不进行累加: {chunk_data}")
-                        continue
-                    full_text_parts.append(piece)
-            except Exception as e:
-                yield _sse_event("audit_error", {"index": idx, "message": str(e)})
-            finally:
-                full_text = "".join(full_text_parts).strip()
-                yield _sse_event("audit_end", {"index": idx, "result": full_text})
 
-        # 全部结束
-        yield _sse_event("done", {"message": "completed", "session_id": session_id, "total": len(requirements)})
+@app.get("/api/audit/jobs/{job_id}")
+async def api_audit_job_status(job_id: str):
+    """
+    审计任务状态：status为queued / running / completed / failed / cancelled / interrupted，
+    last_event_id为已产生的事件数，排队中的任务带大致的排队位置position
+    """
+    job = await audit_jobs.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"审计任务 {job_id} 不存在")
+    return job
 
-    return StreamingResponse(_event_stream(), media_type="text/event-stream", headers=headers)
+@app.get("/api/audit/jobs/{job_id}/events")
+async def api_audit_job_events(job_id: str, after: int = 0, last_event_id: Optional[str] = Header(None)):
+    """
+    订阅审计任务的事件（SSE）：补发序号大于after的事件，任务仍在运行时继续跟随。
+    浏览器EventSource自动重连时带的 Last-Event-ID 优先于after。
+    """
+    if await audit_jobs.get_job(job_id) is None:
+        raise HTTPException(status_code=404, detail=f"审计任务 {job_id} 不存在")
+    header_job_id, seq = audit_jobs.parse_event_id(last_event_id)
+    if header_job_id == job_id:
+        after = seq
+    return _job_stream_response(job_id, after, _SSE_HEADERS)
+
+@app.post("/api/audit/jobs/{job_id}/cancel")
+async def api_cancel_audit_job(job_id: str):
+    """
+    取消排队中或运行中的审计任务，订阅者会收到cancelled事件；任务已结束时返回409
+    """
+    job = await audit_jobs.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"审计任务 {job_id} 不存在")
+    status = await audit_jobs.cancel_job(job_id)
+    if status is None:
+        raise HTTPException(status_code=409, detail=f"审计任务 {job_id} 已结束（{job['status']}）")
+    return await audit_jobs.get_job(job_id)
+
+class KbCleanupRequest(BaseModel):
+    idle_seconds: float = Field(86400, description="清理超过该时长（秒）未被使用的内容寻址文档")
+
+@app.delete("/api/kb/{file_id}")
+async def api_kb_delete(file_id: int, user_id: Optional[int] = None):
+    """
+    删除一份文档的知识库向量（user_id不传时与审计时一样取file_id）；仍有审计在使用时返回409
+    """
+    user_id = user_id or file_id
+    if not await _delete_kb_document(user_id, file_id):
+        raise HTTPException(status_code=409, detail=f"文档 {file_id} 正在被审计使用，稍后再删除")
+    return {"file_id": file_id, "user_id": user_id, "deleted": True}
 
+@app.post("/api/kb/cleanup")
+async def api_kb_cleanup(req: KbCleanupRequest):
+    """
+    清理没有审计在使用、且超过idle_seconds未使用的内容寻址文档，返回删除的file_id列表
+    """
+    deleted = []
+    for entry in await kb_registry.list_idle(req.idle_seconds):
+        try:
+            if await _delete_kb_document(entry["user_id"], entry["file_id"]):
+                deleted.append(entry["file_id"])
+        except Exception as e:
+            print(f"清理文档 {entry['file_id']} 失败: {e}")
+    return {"deleted": deleted}
+
+@app.on_event("shutdown")
+async def _close_shared_clients():
+    # 先中断仍在运行的审计任务，再关闭共享的A2A连接池、知识库连接池、提取/结论缓存和文档登记表
+    await audit_jobs.close_audit_jobs()
+    await a2a_manager.aclose()
+    await knowledge_client.aclose()
+    await close_extract_cache()
+    await verdict_cache.close_verdict_cache()
+    await kb_registry.close_kb_registry()
 
 # -----------------------------
 # 健康检查
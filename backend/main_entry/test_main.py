@@ -45,7 +45,10 @@ class AuditApiTestCase(unittest.IsolatedAsyncioTestCase):
                 event = line.split(":", 1)[1].strip()
             elif line.startswith("data:"):
                 data_lines.append(line.split(":", 1)[1].strip())
-            # ignore other SSE fields (id:, retry:) for now
+            elif line.startswith("id:"):
+                # 记录最后一个事件id，断线续传的用例用它作为 Last-Event-ID
+                self.last_event_id = line.split(":", 1)[1].strip()
+            # ignore other SSE fields (retry:) for now
 
         # flush (in case stream ended without a blank line)
         if data_lines:
@@ -193,5 +196,384 @@ class AuditApiTestCase(unittest.IsolatedAsyncioTestCase):
         self.assertTrue(got_vector_ok, "should receive vectorize_ok event")
         self.assertGreaterEqual(got_begin, 1, "should audit at least 1 requirement")
         self.assertEqual(got_begin, got_end, "each begin should have a matching end")
+    async def test_audit_pre_split_concurrent_ordered(self):
+        """
+        预分片批量审计 + 并发：concurrency=3, ordered=True，
+        audit_end 应按 index 顺序到达，且 begin/end 成对
+        """
+        url = f"{self.base_url}/api/audit_pre_split"
+        payload = {
+            "requirements": [
+                "系统需支持HIS、LIS、PACS对接，并遵循HL7/FHIR标准。",
+                "必须提供数据审计与追踪，日志留存至少5年。",
+                "实施周期不超过90天，提交详细进度计划。",
+                "提供至少5天培训及配套培训资料。",
+            ],
+            "docs_contents": [
+                "系统对接：提供标准化API，支持FHIR/HL7接口；接口网关统一鉴权与审计。",
+                "日志与审计：应用、接口、数据库审计三层日志，留存5年以上，支持检索导出。",
+                "进度与培训：整体周期75天，提供培训5天并交付讲义与题库。",
+            ],
+            "user_id": 2,
+            "file_id": 6001002,
+            "concurrency": 3,
+            "ordered": True,
+        }
+        headers = {
+            "accept": "text/event-stream",
+            "content-type": "application/json",
+        }
+
+        begins = []
+        ends = []
+        start = time.time()
+        async with AsyncClient(timeout=Timeout(None)) as client:
+            async with client.stream("POST", url, headers=headers, json=payload) as resp:
+                self.assertEqual(resp.status_code, 200)
+                async for (event, data) in self._aiter_sse(resp):
+                    print(f"[CONCURRENT] event: {event}, data: {data}")
+                    if event == "audit_begin":
+                        begins.append(data["index"])
+                    elif event == "audit_end":
+                        ends.append(data["index"])
+                    elif event == "done":
+                        break
+        print(f"并发审计4条数据耗时: {time.time() - start:.2f}s")
+        self.assertEqual(ends, list(range(4)), "ordered=True 时 audit_end 按 index 顺序输出")
+        self.assertEqual(sorted(begins), sorted(ends), "each begin should have a matching end")
+    async def test_audit_pre_split_verdict_cache(self):
+        """
+        同一份要求和文档审计两次，第二次应全部命中审计结论缓存（cached=true）且结果一致；
+        use_cache=false 时强制重新审计
+        """
+        url = f"{self.base_url}/api/audit_pre_split"
+        payload = {
+            "requirements": [
+                "提供一年免费质保，并在交付时提交备品备件清单。",
+                "提供7x24小时服务响应，关键问题4小时内到场处理。",
+            ],
+            "docs_contents": [
+                "售后服务：质保期一年，交付时提交备品备件清单。",
+                "服务响应：7x24小时热线，重大故障4小时内到场。",
+            ],
+            "user_id": 2,
+            "file_id": 6001003,
+            "concurrency": 2,
+            "ordered": True,
+        }
+        headers = {
+            "accept": "text/event-stream",
+            "content-type": "application/json",
+        }
+
+        async def run(body):
+            ends = []
+            async with AsyncClient(timeout=Timeout(None)) as client:
+                async with client.stream("POST", url, headers=headers, json=body) as resp:
+                    self.assertEqual(resp.status_code, 200)
+                    async for (event, data) in self._aiter_sse(resp):
+                        print(f"[VERDICT_CACHE] event: {event}, data: {data}")
+                        if event == "audit_end":
+                            ends.append(data)
+                        elif event == "done":
+                            break
+            return ends
+
+        first = await run(payload)
+        start = time.time()
+        second = await run(payload)
+        print(f"第二次审计耗时: {time.time() - start:.2f}s")
+        self.assertTrue(all(d["result"] for d in first), "first run should produce verdicts")
+        self.assertTrue(all(d.get("cached") for d in second), "second run should hit the verdict cache")
+        self.assertEqual([d["result"] for d in first], [d["result"] for d in second])
+
+        forced = await run({**payload, "use_cache": False})
+        self.assertFalse(any(d.get("cached") for d in forced), "use_cache=false should re-audit")
+
+    async def test_audit_pre_split_reuse_vectors(self):
+        """
+        不传file_id时按文档内容生成file_id：同样的docs_contents第二次审计得到相同的file_id，且vectorize_ok.reused=true
+        """
+        url = f"{self.base_url}/api/audit_pre_split"
+        payload = {
+            "requirements": ["提供至少5天培训及配套培训资料。"],
+            "docs_contents": [
+                "培训方案：现场培训5天，交付讲义与题库。",
+                "售后服务：质保期一年，7x24小时响应。",
+            ],
+            "concurrency": 1,
+        }
+        headers = {
+            "accept": "text/event-stream",
+            "content-type": "application/json",
+        }
+
+        async def run():
+            async with AsyncClient(timeout=Timeout(None)) as client:
+                async with client.stream("POST", url, headers=headers, json=payload) as resp:
+                    self.assertEqual(resp.status_code, 200)
+                    async for (event, data) in self._aiter_sse(resp):
+                        print(f"[REUSE] event: {event}, data: {data}")
+                        if event == "vectorize_ok":
+                            return data
+
+        first = await run()
+        start = time.time()
+        second = await run()
+        print(f"第二次向量化耗时: {time.time() - start:.2f}s")
+        self.assertEqual(first["file_id"], second["file_id"])
+        self.assertTrue(second["reused"], "same docs_contents should reuse the vectors")
+
+        async with AsyncClient(timeout=Timeout(30)) as client:
+            resp = await client.delete(f"{self.base_url}/api/kb/{second['file_id']}")
+            self.assertEqual(resp.status_code, 200)
+
+    async def test_audit_pre_split_resume(self):
+        """
+        收到第一个audit_end后断开连接，带 Last-Event-ID 重新请求：
+        只补发之后的事件（不重复session/requirements_ready），最终收到全部audit_end和done
+        """
+        url = f"{self.base_url}/api/audit_pre_split"
+        payload = {
+            "requirements": [
+                "系统需支持HIS、LIS、PACS对接，并遵循HL7/FHIR标准。",
+                "必须提供数据审计与追踪，日志留存至少5年。",
+                "提供至少5天培训及配套培训资料。",
+            ],
+            "docs_contents": [
+                "系统对接：提供标准化API，支持FHIR/HL7接口。",
+                "日志与审计：三层日志，留存5年以上；培训5天并交付讲义与题库。",
+            ],
+            "user_id": 2,
+            "file_id": 6001004,
+            "concurrency": 1,
+            "ordered": True,
+        }
+        headers = {
+            "accept": "text/event-stream",
+            "content-type": "application/json",
+        }
+
+        ends = []
+        async with AsyncClient(timeout=Timeout(None)) as client:
+            async with client.stream("POST", url, headers=headers, json=payload) as resp:
+                self.assertEqual(resp.status_code, 200)
+                job_id = resp.headers["x-audit-job-id"]
+                async for (event, data) in self._aiter_sse(resp):
+                    print(f"[RESUME-1] event: {event}, data: {data}")
+                    if event == "audit_end":
+                        ends.append(data["index"])
+                        break
+        last_event_id = self.last_event_id
+        self.assertTrue(last_event_id.startswith(f"{job_id}:"))
+
+        events = []
+        async with AsyncClient(timeout=Timeout(None)) as client:
+            async with client.stream("POST", url, headers={**headers, "Last-Event-ID": last_event_id},
+                                     json=payload) as resp:
+                self.assertEqual(resp.status_code, 200)
+                async for (event, data) in self._aiter_sse(resp):
+                    print(f"[RESUME-2] event: {event}, data: {data}")
+                    events.append(event)
+                    if event == "audit_end":
+                        ends.append(data["index"])
+                    elif event == "done":
+                        break
+        self.assertNotIn("session", events, "resumed stream should only replay missed events")
+        self.assertEqual(ends, [0, 1, 2])
+
+        async with AsyncClient(timeout=Timeout(30)) as client:
+            resp = await client.get(f"{self.base_url}/api/audit/jobs/{job_id}")
+            self.assertEqual(resp.json()["status"], "completed")
+
+    async def test_audit_job_submit_stream_cancel(self):
+        """
+        任务接口：提交后立即返回202和job_id，订阅事件直到done，状态为completed；
+        已结束的任务不能取消（409），刚提交的任务可以取消
+        """
+        payload = {
+            "requirements": ["提供一年免费质保，并在交付时提交备品备件清单。"],
+            "docs_contents": ["售后服务：质保期一年，交付时提交备品备件清单。"],
+            "user_id": 2,
+            "file_id": 6001005,
+            "tenant_id": "unittest",
+            "priority": 1,
+        }
+        async with AsyncClient(timeout=Timeout(None)) as client:
+            resp = await client.post(f"{self.base_url}/api/audit_pre_split/jobs", json=payload)
+            self.assertEqual(resp.status_code, 202)
+            job = resp.json()
+            print(f"[JOB] submitted: {job}")
+            self.assertIn(job["status"], ("queued", "running"))
+
+            events = []
+            async with client.stream("GET", f"{self.base_url}/api/audit/jobs/{job['job_id']}/events") as resp:
+                self.assertEqual(resp.status_code, 200)
+                async for (event, data) in self._aiter_sse(resp):
+                    print(f"[JOB] event: {event}, data: {data}")
+                    events.append(event)
+                    if event == "done":
+                        break
+            self.assertIn("audit_end", events)
+
+            resp = await client.get(f"{self.base_url}/api/audit/jobs/{job['job_id']}")
+            self.assertEqual(resp.json()["status"], "completed")
+            resp = await client.post(f"{self.base_url}/api/audit/jobs/{job['job_id']}/cancel")
+            self.assertEqual(resp.status_code, 409)
+
+            resp = await client.post(f"{self.base_url}/api/audit_pre_split/jobs", json=payload)
+            resp = await client.post(f"{self.base_url}/api/audit/jobs/{resp.json()['job_id']}/cancel")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json()["status"], "cancelled")
+
+    async def test_audit_batch_pipeline(self):
+        """
+        流水线批量审计：pipeline=True，
+        每条 requirement 事件先于它的 audit_begin，最后仍有 requirements_ready 汇总
+        """
+        url = f"{self.base_url}/api/audit"
+        payload = {
+            "requirements_content": """第一章 技术与接口
+1) 系统需支持HIS、LIS、PACS对接，并遵循HL7/FHIR标准。
+2) 必须提供数据审计与追踪，日志留存至少5年。""",
+            "docs_contents": ["系统对接：提供标准化API，支持FHIR/HL7接口；日志留存5年以上。"],
+            "user_id": 2,
+            "file_id": 6001003,
+            "pipeline": True,
+            "concurrency": 2,
+        }
+        headers = {
+            "accept": "text/event-stream",
+            "content-type": "application/json",
+        }
+
+        extracted = []
+        begins = []
+        ends = 0
+        summary = None
+        first_verdict = None
+        start = time.time()
+        async with AsyncClient(timeout=Timeout(None)) as client:
+            async with client.stream("POST", url, headers=headers, json=payload) as resp:
+                self.assertEqual(resp.status_code, 200)
+                async for (event, data) in self._aiter_sse(resp):
+                    print(f"[PIPELINE] event: {event}, data: {data}")
+                    if event == "requirement":
+                        extracted.append(data["index"])
+                    elif event == "audit_begin":
+                        self.assertIn(data["index"], extracted, "audit_begin 应在对应的 requirement 事件之后")
+                        begins.append(data["index"])
+                    elif event == "audit_end":
+                        ends += 1
+                        if first_verdict is None:
+                            first_verdict = time.time() - start
+                    elif event == "requirements_ready":
+                        summary = data
+                    elif event == "done":
+                        break
+        print(f"首条审计结果耗时: {first_verdict}s, 总耗时: {time.time() - start:.2f}s")
+        self.assertIsNotNone(summary, "should receive requirements_ready summary")
+        self.assertEqual(summary["total"], len(extracted))
+        self.assertEqual(len(begins), ends, "each begin should have a matching end")
+    async def test_extract_parallel_reconciled(self):
+        """
+        并行提取：parallel=True, group_size=3，
+        section 按 chunk_index 顺序推送，且编号不重复
+        """
+        url = f"{self.base_url}/api/extract_audit_requirements"
+        text = """第一章 总则
+
+1.1 本项目为XX医院信息系统升级改造，需满足国家、行业、地方及院内相关标准。
+
+1.2 投标人须具有合法资质，近三年内无重大违法记录。
+
+第二章 技术要求
+
+2.1 系统需支持HIS、LIS、PACS等对接，遵循HL7/FHIR标准。
+
+2.2 需提供数据审计与追踪功能，
+
+日志保存不少于5年。
+
+第三章 售后服务
+
+3.1 提供7x24小时服务响应，关键问题4小时内到场处理。
+
+3.2 提供一年质保及备品备件清单。"""
+        payload = {
+            "text": text,
+            "group_size": 3,
+            "session_id": f"unittest-{uuid.uuid4().hex}",
+            "parallel": True,
+        }
+        headers = {
+            "accept": "text/event-stream",
+            "content-type": "application/json",
+        }
+
+        chunk_indexes = []
+        section_ids = []
+        start = time.time()
+        async with AsyncClient(timeout=Timeout(None)) as client:
+            async with client.stream("POST", url, headers=headers, json=payload) as resp:
+                self.assertEqual(resp.status_code, 200)
+                async for (event, data) in self._aiter_sse(resp):
+                    print(f"event: {event}, data: {data}")
+                    if event == "section":
+                        chunk_indexes.append(data["meta"]["chunk_index"])
+                        section_ids.append(data["data"]["section_id"])
+        print(f"并行提取耗时: {time.time() - start:.2f}s, section_ids: {section_ids}")
+        self.assertEqual(chunk_indexes, sorted(chunk_indexes), "section 应按 chunk_index 顺序推送")
+        self.assertEqual(len(section_ids), len(set(section_ids)), "校正后编号不应重复")
+class AuditVerdictCacheErrorTestCase(unittest.IsolatedAsyncioTestCase):
+    """
+    进程内测试（不依赖运行中的服务）：审计Agent返回错误时，这条审计发audit_error且结论不写入缓存；
+    正常完成时只缓存审计正文，不包含final结束标记
+    """
+
+    async def _run(self, main_api, generate):
+        from unittest import mock
+        put_verdict = mock.AsyncMock()
+
+        async def search(user_id, query, topk=3):
+            return {"ids": [[f"{user_id}_1"]], "documents": [["售后服务：质保期一年。"]]}
+
+        with mock.patch.object(main_api.A2AAuditClientWrapper, "generate", generate), \
+                mock.patch.object(main_api.knowledge_client, "search", search), \
+                mock.patch.object(main_api.verdict_cache, "VERDICT_CACHE", True), \
+                mock.patch.object(main_api.verdict_cache, "get_verdict", mock.AsyncMock(return_value=None)), \
+                mock.patch.object(main_api.verdict_cache, "put_verdict", put_verdict):
+            events = []
+            reqs = [{"index": 0, "requirement": "提供一年免费质保。", "meta": {}}]
+            async for frame in main_api._audit_requirements_stream(reqs, f"unittest-{uuid.uuid4().hex}", 6001004):
+                event = frame.split("\n", 1)[0].split(":", 1)[1].strip()
+                events.append((event, json.loads(frame.split("data: ", 1)[1])))
+        return events, put_verdict
+
+    async def test_agent_error_not_cached(self):
+        os.environ.setdefault("AUDIT_AGENT", "http://127.0.0.1:10000")
+        os.environ.setdefault("KNOWLEDGE_AGENT", "http://127.0.0.1:9900")
+        import main_api
+
+        async def failing(self, user_question, language="English", file_id=""):
+            yield {"type": "text", "text": "部分结论"}
+            yield {"type": "error", "message": "Internal error"}
+
+        events, put_verdict = await self._run(main_api, failing)
+        names = [e for e, _ in events]
+        self.assertIn("audit_error", names)
+        self.assertFalse(events[names.index("audit_end")][1]["cached"])
+        put_verdict.assert_not_awaited()
+
+        async def ok(self, user_question, language="English", file_id=""):
+            yield {"type": "text", "text": "满足要求"}
+            yield {"type": "final", "text": "对话结束"}
+
+        events, put_verdict = await self._run(main_api, ok)
+        end = dict(events)["audit_end"]
+        self.assertEqual(end["result"], "满足要求")
+        put_verdict.assert_awaited_once()
+        self.assertEqual(put_verdict.await_args.args[3], "满足要求")
+
 if __name__ == "__main__":
     unittest.main()
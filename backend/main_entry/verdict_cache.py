@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Date  : 2025/9/23
+# @File  : verdict_cache.py
+# @Desc  : 审计结论缓存：键为（规范化后的审计要求, 证据指纹），证据没变时直接复用上次的审计结论
+#          证据指纹来自审计前的一次预检索（与审计Agent检索同一个知识库），由命中分块的序号和内容hash组成
+
+import os
+import re
+import time
+import asyncio
+import hashlib
+import unicodedata
+from typing import Any, Dict, Optional
+
+import aiosqlite
+
+VERDICT_CACHE = os.getenv("VERDICT_CACHE", "1") == "1"
+VERDICT_CACHE_PATH = os.getenv("VERDICT_CACHE_PATH", os.path.join(os.path.dirname(__file__), "verdict_cache.sqlite"))
+# 审计Agent的提示词/模型变化后改这个版本号，旧结论全部失效
+VERDICT_CACHE_VERSION = os.getenv("VERDICT_CACHE_VERSION", "v1")
+# 预检索取的证据条数，比审计Agent单次检索的topk大，覆盖它可能看到的分块
+VERDICT_EVIDENCE_TOPK = int(os.getenv("VERDICT_EVIDENCE_TOPK", "8"))
+# 缓存有效期（秒），0表示不过期
+VERDICT_CACHE_TTL_SECONDS = float(os.getenv("VERDICT_CACHE_TTL_SECONDS", "0"))
+
+_CONN = None
+_LOCK = asyncio.Lock()
+
+_TRAILING_PUNCT = "。；;，,.!！ "
+
+
+def normalize_requirement(text: str) -> str:
+    """全角半角统一、去掉所有空白和结尾标点、英文小写，编号/排版不同的同一条款得到相同文本"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    text = re.sub(r"\s+", "", text)
+    return text.rstrip(_TRAILING_PUNCT)
+
+
+def evidence_fingerprint(search_result: Dict[str, Any]) -> Optional[str]:
+    """
+    由 /search 的结果计算证据指纹：命中分块的 (序号, 内容hash) 排序后取hash。
+    分块id是 {fileId}_{ordinal}，只用ordinal，同一份文档换了fileId重新入库指纹不变。
+    没有检索到任何证据时返回None（此时不使用缓存，避免不同文档共用结论）。
+    """
+    ids = (search_result.get("ids") or [[]])[0]
+    documents = (search_result.get("documents") or [[]])[0]
+    if not ids:
+        return None
+    parts = []
+    for chunk_id, document in zip(ids, documents):
+        ordinal = str(chunk_id).rsplit("_", 1)[-1]
+        parts.append(f"{ordinal}:{hashlib.sha256((document or '').encode('utf-8')).hexdigest()}")
+    return hashlib.sha256("\n".join(sorted(parts)).encode("utf-8")).hexdigest()
+
+
+def verdict_key(requirement: str, fingerprint: str) -> str:
+    raw = f"{VERDICT_CACHE_VERSION}\n{normalize_requirement(requirement)}\n{fingerprint}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+async def _get_conn():
+    global _CONN
+    if _CONN is None:
+        async with _LOCK:
+            if _CONN is None:
+                conn = await aiosqlite.connect(VERDICT_CACHE_PATH)
+                await conn.execute("PRAGMA journal_mode=WAL")
+                await conn.execute(
+                    "CREATE TABLE IF NOT EXISTS verdict_cache ("
+                    "key TEXT PRIMARY KEY, requirement TEXT, fingerprint TEXT, result TEXT NOT NULL, "
+                    "created_at REAL, hits INTEGER DEFAULT 0)"
+                )
+                await conn.commit()
+                _CONN = conn
+    return _CONN
+
+
+async def get_verdict(key: str) -> Optional[str]:
+    conn = await _get_conn()
+    async with conn.execute("SELECT result, created_at FROM verdict_cache WHERE key=?", (key,)) as cursor:
+        row = await cursor.fetchone()
+    if row is None:
+        return None
+    if VERDICT_CACHE_TTL_SECONDS and time.time() - row[1] > VERDICT_CACHE_TTL_SECONDS:
+        return None
+    await conn.execute("UPDATE verdict_cache SET hits = hits + 1 WHERE key=?", (key,))
+    await conn.commit()
+    return row[0]
+
+
+async def put_verdict(key: str, requirement: str, fingerprint: str, result: str) -> None:
+    conn = await _get_conn()
+    await conn.execute(
+        "INSERT OR REPLACE INTO verdict_cache (key, requirement, fingerprint, result, created_at, hits) "
+        "VALUES (?, ?, ?, ?, ?, 0)",
+        (key, requirement, fingerprint, result, time.time()),
+    )
+    await conn.commit()
+
+
+async def close_verdict_cache() -> None:
+    global _CONN
+    if _CONN is not None:
+        conn, _CONN = _CONN, None
+        await conn.close()